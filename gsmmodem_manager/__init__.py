@@ -6,4 +6,18 @@
 # Copyright (c) 2016-2018 Pod Group Ltd
 # Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
 
-from lib import signal_quality, GSMModem, HuaweiModem, HuaweiMS2131, HuaweiMS2372h, HuaweiE3372
\ No newline at end of file
+import sys
+
+from .lib import signal_quality, GSMModem, HuaweiModem, HuaweiMS2131, HuaweiMS2372h, HuaweiE3372
+from .pool import ModemPool, PoolResult, PoolTimeout
+from .scheduler import ModemScheduler, ScheduledRequest, SchedulerTimeout, SchedulerCancelled
+from .latency import LatencyProfiles
+from .metrics import Metrics
+from .sampler import Sampler, RingBuffer
+from .discovery import ModemRegistry, UsbModem
+from .recorder import Recorder, Recording, Replayer
+from .watchdog import ModemWatchdog, Recovery
+from .sms import Sms, SmsSender
+
+if sys.version_info >= (3, 5): # asyncio modems
+    from .aio import AsyncGSMModem, AsyncHuaweiModem, AsyncHuaweiMS2131, AsyncHuaweiMS2372h, AsyncHuaweiE3372, AsyncSampler
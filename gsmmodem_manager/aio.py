@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import asyncio
+import logging
+import serial
+
+from .lib import GSMModem, HuaweiModem, HuaweiMS2131, HuaweiMS2372h, HuaweiE3372
+from .sampler import Sampler
+from .framer import LineFramer
+from .recorder import TX
+
+
+class SerialTransport(object):
+    """Non blocking serial port watched by the asyncio event loop.
+    Incoming data is split in lines as soon as the port turns readable,
+    and URCs are dispatched right away."""
+
+    def __init__(self, devicefile, baudrate, urc=None):
+        """- urc: UrcDispatcher for the unsolicited result codes"""
+        self.__conf = {'devicefile': devicefile, 'baudrate': baudrate}
+        self.__urc = urc
+        self.pending = None # Command waiting for response
+        self.__ser = None
+        self.__framer, self.__txbuf = LineFramer(), b""
+        self.__lines = None
+        self.__writing = False
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def open(self):
+        if self.__ser is None:
+            # timeout=0 opens the port in non blocking mode
+            self.__ser = serial.Serial(self.__conf['devicefile'], self.__conf['baudrate'], timeout=0, dsrdtr=True, rtscts=True)
+        elif not self.__ser.is_open:
+            self.__ser.open()
+
+        self.__lines = asyncio.Queue()
+        self.__framer.clear()
+        asyncio.get_event_loop().add_reader(self.__ser.fileno(), self._on_readable)
+
+    def close(self):
+        if self.is_open():
+            asyncio.get_event_loop().remove_reader(self.__ser.fileno())
+            if self.__writing:
+                asyncio.get_event_loop().remove_writer(self.__ser.fileno())
+                self.__txbuf, self.__writing = b"", False
+            self.__ser.close()
+
+    def is_open(self):
+        return self.__ser is not None and self.__ser.is_open
+
+    def _on_readable(self):
+        # Straight from the file descriptor: pyserial would select() on it, which
+        # does not work with descriptors over 1024, so no hundreds of modems
+        try:
+            if self.__framer.read(self.__ser.fileno()) == 0:
+                raise serial.SerialException('Port readable with no data, disconnected?')
+        except (serial.SerialException, OSError) as e:
+            # Otherwise the loop would call us back for ever
+            self._logger.error('Serial port closed: ' + repr(e))
+            self.close()
+            error = e if isinstance(e, serial.SerialException) else serial.SerialException(repr(e))
+            self.__lines.put_nowait(error) # Whoever awaits a line fails right away
+            return
+        for msg in self.__framer.lines():
+            if self.__urc is not None and self.__urc.is_unsolicited(msg, self.pending):
+                self.__urc.dispatch(msg)
+            else:
+                self.__lines.put_nowait(msg)
+
+    @property
+    def recorder(self):
+        return self.__framer.recorder
+
+    @recorder.setter
+    def recorder(self, recorder):
+        """recorder.Recorder of the traffic, or None"""
+        self.__framer.recorder = recorder
+
+    def write(self, data):
+        data = data.encode('ascii')
+        if self.recorder is not None:
+            self.recorder.record(TX, data)
+        self.__txbuf += data
+        self._on_writable()
+
+    def _on_writable(self):
+        # Same as reading, pyserial write would select() on the file descriptor
+        try:
+            sent = os.write(self.__ser.fileno(), self.__txbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        self.__txbuf = self.__txbuf[sent:]
+
+        # Whatever the port didn't take is written once it is writable again
+        if self.__txbuf and not self.__writing:
+            asyncio.get_event_loop().add_writer(self.__ser.fileno(), self._on_writable)
+            self.__writing = True
+        elif not self.__txbuf and self.__writing:
+            asyncio.get_event_loop().remove_writer(self.__ser.fileno())
+            self.__writing = False
+
+    async def readline(self, timeout):
+        """Next non empty line. Raises asyncio.TimeoutError if none arrives in time,
+        or serial.SerialException if the port was closed on a read failure"""
+        msg = await asyncio.wait_for(self.__lines.get(), max(timeout, 0))
+        if isinstance(msg, Exception):
+            self.__lines.put_nowait(msg) # For the next readers too, until reopened
+            raise msg
+        return msg
+
+    def pop_partial(self):
+        """Takes out the incomplete line received so far"""
+        return self.__framer.pop_partial()
+
+    def discard(self):
+        """Takes out the lines received so far, out of any command"""
+        lines = []
+        while not self.__lines.empty():
+            msg = self.__lines.get_nowait()
+            if isinstance(msg, Exception):
+                self.__lines.put_nowait(msg)
+                break
+            lines.append(msg)
+        return lines
+
+
+class AsyncGSMModem(GSMModem):
+    """asyncio counterpart of GSMModem. Every AT method returns an awaitable
+    with the same (status, command, response) result as the blocking one.
+    The port is opened on first use or with connect(), whatever lazy says."""
+
+    def __init__(self, devicefile, baudrate, timeout=25, lazy=True):
+        super(AsyncGSMModem, self).__init__(devicefile, baudrate, timeout, lazy=True)
+        self._transport = None
+        # Created by connect, bound to the running event loop
+        self._lock = self._urc_event = None
+        self._urc.subscribe('', lambda line: self._urc_event.set()) # URCs are dispatched from the event loop
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
+
+    def __enter__(self): # connect is a coroutine here
+        raise TypeError('Use "async with" with ' + self.__class__.__name__)
+
+    async def connect(self, retries=10, sleeptime=0.5):
+        """Open the serial port and handshake with the modem.
+        - retries: max number of handshake probes
+        - sleeptime: deadline in seconds for each probe"""
+        self.invalidate_cache() # It may be a different modem or SIM card by now
+        if self._lock is None:
+            self._lock, self._urc_event = asyncio.Lock(), asyncio.Event()
+        if self._transport is None:
+            conf = self.get_serial_conf()
+            self._transport = SerialTransport(conf['devicefile'], conf['baudrate'], self._urc)
+            self._transport.recorder = self._recorder
+        if not self._transport.is_open():
+            self._transport.open()
+
+        return await self.handshake(retries, sleeptime)
+
+    async def _send_command(self, command, sleeptime=2):
+        sleeptime = self._command_deadline(command, sleeptime)
+        loop = asyncio.get_event_loop()
+        await self.__drain()
+        start = loop.time()
+        response, first_line = await self.__send_command(command, start + sleeptime)
+        end = loop.time()
+        if not len(response) or not self._is_final_response(response[-1]):
+            self._late = end + self.LATE_RESPONSE_TIMEOUT
+        self._record_latency(command, sleeptime, end - start, response)
+        self._record_metrics(command, response, start, first_line, end)
+        return response
+
+    async def __drain(self):
+        """Discard the lines left by previous commands. After a timeout, wait for its
+        final result code first, up to the _late deadline. URCs are dispatched already"""
+        loop = asyncio.get_event_loop()
+        lines = self._transport.discard()
+        try:
+            while self._late is not None and not any(self._is_final_response(msg) for msg in lines):
+                lines = [await self._transport.readline(self._late - loop.time())]
+                self._logger.debug('Discarded late line: ' + lines[0])
+        except asyncio.TimeoutError:
+            pass
+        self._late = None
+
+    async def __send_command(self, command, deadline):
+        """Response lines and when the first one arrived, None if none did"""
+        self._transport.pending = command
+        self._transport.write(self._command_data(command))
+        loop = asyncio.get_event_loop()
+
+        ret, first_line = [], None
+        try:
+            while True:
+                try:
+                    msg = await self._transport.readline(deadline - loop.time())
+                except asyncio.TimeoutError:
+                    # No final result code in time, return whatever was received
+                    msg = self._transport.pop_partial()
+                    if msg != "":
+                        ret.append(msg)
+                    return ret, first_line
+
+                if not ret:
+                    first_line = loop.time()
+                ret.append(msg)
+                if self._is_final_response(msg):
+                    return ret, first_line # Anything after it is kept for the next command
+        finally:
+            self._transport.pending = None
+
+    def _dispatch_urcs(self):
+        pass # The transport dispatches them from the event loop as they arrive
+
+    async def _wait_urc(self, timeout):
+        """Wait up to timeout seconds until an URC is received"""
+        self._urc_event.clear()
+        try:
+            await asyncio.wait_for(self._urc_event.wait(), max(timeout, 0))
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run_operation(self, operation):
+        """asyncio driver for at_operation methods. Commands on the same modem
+        never interleave, but other operations can run while this one waits."""
+        if self._transport is None or not self._transport.is_open(): # The port is opened on first use
+            await self.connect()
+
+        step = next(operation)
+        while len(step) != 3: # Anything but the (status, command, response) result is a command
+            if step[0] is None:
+                response = await self._wait_urc(step[1])
+                step = operation.send(response)
+                continue
+            async with self._lock:
+                while True:
+                    response = await self._send_command(*step)
+                    step = operation.send(response)
+                    # After a prompt the modem waits for the message, nothing else can be sent meanwhile
+                    if len(step) == 3 or step[0] is None or response[-1:] != [self.PROMPT]:
+                        break
+        operation.close()
+        return step
+
+    def set_recorder(self, recorder):
+        self._recorder = recorder
+        if self._transport is not None:
+            self._transport.recorder = recorder
+
+    def close_connection(self):
+        self.invalidate_cache()
+        if self._transport is not None:
+            self._transport.close()
+
+    def open_connection(self):
+        self.invalidate_cache()
+        if self._transport is not None:
+            self._transport.open()
+
+
+class AsyncHuaweiModem(AsyncGSMModem, HuaweiModem):
+    """asyncio counterpart of HuaweiModem"""
+
+
+class AsyncHuaweiMS2131(AsyncHuaweiModem, HuaweiMS2131):
+    """asyncio counterpart of HuaweiMS2131"""
+
+
+class AsyncHuaweiMS2372h(AsyncHuaweiModem, HuaweiMS2372h):
+    """asyncio counterpart of HuaweiMS2372h"""
+
+
+class AsyncHuaweiE3372(AsyncHuaweiModem, HuaweiE3372):
+    """asyncio counterpart of HuaweiE3372"""
+
+
+class AsyncSampler(Sampler):
+    """asyncio counterpart of Sampler, for AsyncGSMModem modems. Sampling goes on
+    while run is awaited, until its task is cancelled."""
+
+    async def poll(self):
+        """Take a sample now"""
+        csq = None if self.urc else await self.modem.get_signal_quality()
+        self._record(csq, await self.modem.get_registration_info())
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        self._subscribe()
+        try:
+            next_poll = loop.time()
+            while True:
+                try:
+                    await self.poll()
+                except Exception as e:
+                    self._logger.error('Sampling failed: ' + repr(e))
+                # Slow polls do not shift the cadence, missed ones are skipped
+                next_poll += self.interval * (1 + int(max(loop.time() - next_poll, 0) // self.interval))
+                await asyncio.sleep(max(next_poll - loop.time(), 0))
+        finally:
+            self._unsubscribe()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Benchmark of command latency and fleet throughput, against emulated modems
+or real hardware. Results are written as JSON, to compare between releases.
+
+    python -m gsmmodem_manager.bench --emulator --model E3372 --output bench.json
+    python -m gsmmodem_manager.bench --device /dev/ttyUSB0 --model MS2131
+"""
+
+import sys
+import time
+import json
+import platform
+
+from .lib import HuaweiMS2131, HuaweiMS2372h, HuaweiE3372
+from .pool import ModemPool
+
+MODEMS = {'MS2131': HuaweiMS2131, 'MS2372h': HuaweiMS2372h, 'E3372': HuaweiE3372}
+
+# Methods not changing the modem configuration, with their arguments
+READ_METHODS = [
+    ('handshake', ()), ('get_manufacturer', ()), ('get_model', ()), ('get_revision', ()),
+    ('get_serial_number', ()), ('get_imei', ()), ('get_imsi', ()), ('get_iccid', ()), ('get_identity', ()),
+    ('get_operator', ()), ('get_registration_info', ()), ('get_pdp_context', ()), ('get_signal_quality', ()),
+    ('get_apn', ()), ('get_access_technology', ()),
+]
+
+# Methods changing it, only benchmarked when asked to. Arguments are filled in by write_methods
+WRITE_METHODS = ['set_echo', 'set_apn', 'set_access_technology', 'set_operator', 'register',
+                 'activate_pdp_context', 'deactivate_pdp_context', 'reset_modem_default']
+
+FLEET_OPERATION = ('get_imsi', 'get_signal_quality', 'get_registration_info')
+
+
+def percentile(samples, p):
+    """Nearest rank percentile of sorted samples"""
+    return samples[min(int(len(samples) * p / 100.0), len(samples) - 1)]
+
+
+def distribution(samples):
+    samples = sorted(samples)
+    return {'count': len(samples), 'min': samples[0], 'max': samples[-1], 'mean': sum(samples) / len(samples),
+            'p50': percentile(samples, 50), 'p95': percentile(samples, 95), 'p99': percentile(samples, 99)}
+
+
+def write_methods(modem, plmn):
+    args = {'set_echo': (False,), 'set_apn': (1, 'internet'), 'set_access_technology': (modem.ACT_UMTS,),
+            'set_operator': (plmn,)}
+    return [(name, args.get(name, ())) for name in WRITE_METHODS]
+
+
+def bench_methods(modem, methods, rounds):
+    """Latency distribution of each method, in seconds. Failed calls are counted apart."""
+    modem.CACHE_TTL = 0 # Otherwise identity getters would hardly touch the serial port
+    results = {}
+    for name, args in methods:
+        samples, failures = [], 0
+        for _ in range(rounds):
+            start = time.time()
+            status = getattr(modem, name)(*args)[0]
+            samples.append(time.time() - start)
+            failures += not status
+        results[name] = dict(distribution(samples), failures=failures)
+    return results
+
+
+def bench_act_op(modem, act, plmn, rounds):
+    """End to end time of the access technology and operator switch sequence of tests/test.py"""
+    steps = [('set_access_technology', (act,)), ('set_operator', (plmn,)), ('register', ()),
+             ('activate_pdp_context', ()), ('get_access_technology', ()), ('get_operator', ()),
+             ('get_signal_quality', ()), ('get_registration_info', ()), ('deactivate_pdp_context', ())]
+    totals, failures = [], 0
+    for _ in range(rounds):
+        start = time.time()
+        for name, args in steps:
+            if not getattr(modem, name)(*args)[0]:
+                failures += 1
+                break
+        totals.append(time.time() - start)
+    return dict(distribution(totals), failures=failures, act=act, plmn=plmn)
+
+
+def bench_fleet(modem_class, baudrate, devicefiles, rounds):
+    """Throughput of a ModemPool sweeping all the devicefiles"""
+    def operation(modem):
+        return [getattr(modem, name)()[0] for name in FLEET_OPERATION]
+
+    with ModemPool.from_devicefiles(modem_class, devicefiles, baudrate, max_workers=len(devicefiles)) as pool:
+        pool.collect('handshake') # Ports opened and handshaked out of the measure
+
+        start, commands, failures = time.time(), 0, 0
+        for _ in range(rounds):
+            for res in pool.run(operation):
+                commands += len(FLEET_OPERATION)
+                failures += res.error is not None or not all(res.result)
+        elapsed = time.time() - start
+
+    return {'modems': len(devicefiles), 'commands': commands, 'failures': failures, 'seconds': elapsed,
+            'commands_per_second': commands / elapsed}
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark of command latency and fleet throughput')
+    parser.add_argument('--model', default='E3372', choices=sorted(MODEMS))
+    parser.add_argument('--baudrate', default=115200, type=int)
+    parser.add_argument('--device', action='append', default=[], help='device file, repeat for a fleet')
+    parser.add_argument('--emulator', action='store_true', help='use emulated modems instead of devices')
+    parser.add_argument('--latency', type=float, default=0.01, help='emulated command latency')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--writes', action='store_true', help='benchmark methods changing the configuration too. Always on with --emulator')
+    parser.add_argument('--plmn', default='21401', help='operator for set_operator and the ACT/operator sequence')
+    parser.add_argument('--fleet', type=int, default=[1, 4, 16, 64], nargs='*', help='fleet sizes, emulator only')
+    parser.add_argument('--output', help='JSON file, stdout by default')
+    args = parser.parse_args(argv)
+
+    if not args.emulator and not args.device:
+        parser.error('either --emulator or --device is needed')
+
+    emulators = []
+    def devicefiles(n):
+        if not args.emulator:
+            return args.device[:n]
+        from .emulator import ModemEmulator
+        while len(emulators) < n:
+            emulators.append(ModemEmulator(args.model, args.latency, registration_delay=args.latency))
+        return [emulator.devicefile for emulator in emulators[:n]]
+
+    modem_class = MODEMS[args.model]
+    results = {'timestamp': time.time(), 'python': platform.python_version(), 'model': args.model,
+               'emulator': args.emulator, 'rounds': args.rounds}
+    if args.emulator:
+        results['emulator_latency'] = args.latency
+
+    modem = modem_class(devicefiles(1)[0], args.baudrate)
+    methods = list(READ_METHODS)
+    if args.writes or args.emulator:
+        methods += write_methods(modem, args.plmn)
+        results['act_op'] = bench_act_op(modem, modem.ACT_UMTS, args.plmn, args.rounds)
+    results['methods'] = bench_methods(modem, methods, args.rounds)
+    modem.close_connection()
+
+    sizes = args.fleet if args.emulator else [len(args.device)]
+    results['fleet'] = [bench_fleet(modem_class, args.baudrate, devicefiles(n), args.rounds) for n in sizes]
+
+    for emulator in emulators:
+        emulator.close()
+
+    for name, stats in sorted(results['methods'].items()):
+        sys.stderr.write('%-24s p50 %.4fs p95 %.4fs p99 %.4fs failures %d\n' % (name, stats['p50'], stats['p95'], stats['p99'], stats['failures']))
+    for fleet in results['fleet']:
+        sys.stderr.write('fleet of %-4d %.1f commands/s\n' % (fleet['modems'], fleet['commands_per_second']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=1, sort_keys=True)
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Multiplexing of several logical channels over one serial port, as per
+3GPP TS 27.010 basic option. Each channel is served behind a pseudo-terminal,
+as the Linux n_gsm line discipline does, so any modem class can be used on it."""
+
+import os
+import tty
+import time
+import errno
+import fcntl
+import select
+import threading
+import logging
+from collections import namedtuple
+
+import serial
+
+from .framer import write_all
+
+FLAG = 0xF9
+SABM, UA, DM, DISC, UIH, UI = 0x2F, 0x63, 0x0F, 0x43, 0xEF, 0x03
+PF = 0x10 # Poll/final bit of the control field
+_CONTROLS = (SABM, UA, DM, DISC, UIH, UI)
+
+# Frame received. control is without the P/F bit
+Frame = namedtuple('Frame', ['dlci', 'control', 'cr', 'pf', 'info'])
+
+
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xE0 if crc & 1 else crc >> 1 # Reversed x^8 + x^2 + x + 1
+        table.append(crc)
+    return table
+
+_CRC_TABLE = _crc_table()
+
+
+def fcs(data):
+    """Frame check sequence of data, a bytearray"""
+    crc = 0xFF
+    for byte in data:
+        crc = _CRC_TABLE[crc ^ byte]
+    return 0xFF - crc
+
+
+def encode_frame(dlci, control, info=b'', cr=True, pf=None):
+    """Frame as bytes. SABM, DISC, UA and DM frames have the P/F bit set unless told otherwise
+    - cr: command/response bit. Set on commands from the initiator, and responses from the responder"""
+    if pf is None:
+        pf = control not in (UIH, UI)
+    info = bytearray(info)
+    header = bytearray([(dlci << 2) | (cr << 1) | 1, control | (PF if pf else 0)])
+    if len(info) < 128:
+        header.append((len(info) << 1) | 1)
+    else:
+        header.extend([(len(info) << 1) & 0xFE, len(info) >> 7])
+    checked = header if control in (UIH, UI) else header + info # Only the header is checked on UIH and UI frames
+    return bytes(bytearray([FLAG]) + header + info + bytearray([fcs(checked), FLAG]))
+
+
+class FrameDecoder(object):
+    """Incremental decoder. Frames are delimited by their length, not by the flags,
+    as the basic option does not escape flags in the information field. Corrupted
+    frames are discarded up to the next flag."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Returns the list of Frame completed with data"""
+        buf = self._buffer
+        buf.extend(data)
+        frames = []
+        while True:
+            start = buf.find(bytearray([FLAG]))
+            if start < 0:
+                del buf[:]
+                break
+            while start + 1 < len(buf) and buf[start + 1] == FLAG: # Closing flag of the previous frame
+                start += 1
+            del buf[:start]
+            if len(buf) < 4:
+                break
+
+            address, control = buf[1], buf[2]
+            kind = control & ~PF
+            if not address & 1 or kind not in _CONTROLS: # Not a frame, look for the next flag
+                del buf[:1]
+                continue
+
+            length, header = buf[3] >> 1, 4
+            if not buf[3] & 1: # Two length bytes
+                if len(buf) < 5:
+                    break
+                length, header = length | (buf[4] << 7), 5
+            end = header + length
+            if len(buf) < end + 2:
+                break
+
+            checked = buf[1:header] if kind in (UIH, UI) else buf[1:end]
+            if buf[end + 1] != FLAG or fcs(checked) != buf[end]:
+                del buf[:1] # Corrupted, look for the next flag
+                continue
+
+            frames.append(Frame(address >> 2, kind, bool(address & 2), bool(control & PF), bytes(buf[header:end])))
+            del buf[:end + 1] # The closing flag may open the next frame
+        return frames
+
+
+class CmuxError(Exception):
+    """The modem refused to multiplex or to open a channel"""
+
+
+class Multiplexer(object):
+    """Switches a modem to CMUX mode and serves each channel behind a pseudo-terminal.
+    Open devicefile(dlci) with any modem class, or use modem(dlci), so long commands
+    on a channel do not hold back the rest, i.e. status polls or URC monitoring."""
+
+    COMMAND = 'AT+CMUX=0' # Basic option, default parameters
+    FRAME_SIZE = 31 # Default N1 of the basic option
+    TIMEOUT = 3 # Seconds to wait for the modem to answer
+    BUFFER_SIZE = 4096 # Bytes kept for a channel while its pty is full. Nobody reads it beyond that
+
+    def __init__(self, devicefile, baudrate, channels=2, modem_class=None):
+        """- channels: number of channels, DLCI 1 to channels
+        - modem_class: default class of the modem objects returned by modem()"""
+        self.__conf = {'devicefile': devicefile, 'baudrate': baudrate}
+        self.modem_class = modem_class
+        self.dlcis = list(range(1, channels + 1))
+        self._ser = None
+        self._ptys = {} # dlci -> (master fd, slave fd, slave devicefile)
+        self._masters = {} # master fd -> dlci
+        self._pending = {} # dlci -> bytearray not written to its pty yet
+        self._poll = None
+        self._decoder = FrameDecoder()
+        self._answers = {} # dlci -> Event set on UA or DM, and the control received
+        self._thread, self._running = None, False
+        self._wakeup_r, self._wakeup_w = None, None
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def is_open(self):
+        """False once closed, or if the serial port failed"""
+        return self._running
+
+    def devicefile(self, dlci):
+        return self._ptys[dlci][2]
+
+    def modem(self, dlci, modem_class=None, **kwargs):
+        """modem_class instance on channel dlci. The port is opened on first use"""
+        kwargs.setdefault('lazy', True)
+        return (modem_class or self.modem_class)(self.devicefile(dlci), self.__conf['baudrate'], **kwargs)
+
+    def open(self):
+        """Switch the modem to CMUX mode and open the channels"""
+        conf = self.__conf
+        self._ser = serial.Serial(conf['devicefile'], conf['baudrate'], timeout=0.1, dsrdtr=True, rtscts=True)
+        self._ser.write((self.COMMAND + '\r\n').encode('ascii'))
+        response, deadline = b'', time.time() + self.TIMEOUT
+        while b'OK' not in response and b'ERROR' not in response and time.time() < deadline:
+            response += self._ser.read(64)
+        if b'OK' not in response:
+            self._ser.close()
+            raise CmuxError(self.COMMAND + ' failed with: ' + repr(response))
+
+        for dlci in self.dlcis:
+            master, slave = os.openpty()
+            tty.setraw(master)
+            tty.setraw(slave)
+            fcntl.fcntl(master, fcntl.F_SETFL, fcntl.fcntl(master, fcntl.F_GETFL) | os.O_NONBLOCK)
+            self._ptys[dlci] = (master, slave, os.ttyname(slave))
+            self._masters[master] = dlci
+            self._pending[dlci] = bytearray()
+
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._poll = select.poll()
+        for fd in [self._ser.fileno(), self._wakeup_r] + list(self._masters):
+            self._poll.register(fd, select.POLLIN)
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+        for dlci in [0] + self.dlcis: # The control channel first
+            self._establish(dlci, SABM)
+
+    def close(self):
+        """Close the channels and switch the modem back to AT commands"""
+        if self._thread is None:
+            return
+        if self._running: # Unless the serial port failed
+            for dlci in self.dlcis + [0]: # DISC on the control channel closes down the multiplexer
+                try:
+                    self._establish(dlci, DISC)
+                except CmuxError as e:
+                    self._logger.warning(str(e))
+
+            self._running = False
+            os.write(self._wakeup_w, b'.')
+        self._thread.join()
+        self._thread = None
+        for master, slave, _ in self._ptys.values():
+            os.close(master)
+            os.close(slave)
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
+        self._ptys.clear()
+        self._masters.clear()
+        self._pending.clear()
+        self._ser.close()
+
+    def _establish(self, dlci, control):
+        """Send SABM or DISC on dlci, and wait for UA"""
+        answer = self._answers[dlci] = [threading.Event(), None]
+        self._write_all(self._ser.fileno(), encode_frame(dlci, control))
+        if not answer[0].wait(self.TIMEOUT) or answer[1] != UA:
+            raise CmuxError(('SABM' if control == SABM else 'DISC') + ' on DLCI ' + str(dlci) + ' not acknowledged')
+
+    def _write_all(self, fd, data):
+        write_all(fd, data, self.TIMEOUT)
+
+    def _loop(self):
+        port = self._ser.fileno()
+        while self._running:
+            for fd, event in self._poll.poll():
+                try:
+                    if fd == port:
+                        data = os.read(port, 4096) if event & select.POLLIN else b''
+                        if not data: # Hung up or unplugged, it would be readable for ever
+                            raise OSError(errno.EIO, 'Serial port hung up')
+                        for frame in self._decoder.feed(data):
+                            self._on_frame(frame)
+                    elif fd in self._masters:
+                        if event & select.POLLOUT:
+                            self._flush(self._masters[fd])
+                        data = self._read_channel(fd) if event & ~select.POLLOUT else None
+                        if data:
+                            self._write_all(port, encode_frame(self._masters[fd], UIH, data))
+                    else:
+                        os.read(fd, 64)
+                except OSError as e:
+                    if e.errno == errno.EAGAIN:
+                        continue
+                    self._logger.error('CMUX failed, closing it: ' + repr(e))
+                    self._running = False # Channels are useless without the port
+                    for answer in self._answers.values(): # Nobody waits for an answer in vain
+                        answer[0].set()
+                    return
+
+    def _read_channel(self, fd):
+        """Data written to a channel pty, None if there is none"""
+        try:
+            return os.read(fd, self.FRAME_SIZE)
+        except OSError as e:
+            if e.errno == errno.EIO: # While the pty slave is closed
+                time.sleep(0.01) # Nobody on the channel yet, do not spin
+                return None
+            if e.errno == errno.EAGAIN:
+                return None
+            raise
+
+    def _deliver(self, dlci, data):
+        """Write data to the pty of dlci without blocking the loop, so a channel nobody
+        reads does not hold back the rest. What does not fit is kept up to BUFFER_SIZE"""
+        pending = self._pending[dlci]
+        if len(pending) + len(data) > self.BUFFER_SIZE:
+            self._logger.warning('CMUX channel ' + str(dlci) + ' full, ' + str(len(data)) + ' bytes dropped')
+            return
+        pending.extend(data)
+        self._flush(dlci)
+
+    def _flush(self, dlci):
+        master, pending = self._ptys[dlci][0], self._pending[dlci]
+        try:
+            while pending:
+                del pending[:os.write(master, bytes(pending))]
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EIO):
+                raise
+        # Woken up when the pty has room for the rest
+        self._poll.modify(master, select.POLLIN | select.POLLOUT if pending else select.POLLIN)
+
+    def _on_frame(self, frame):
+        if frame.control in (UA, DM):
+            answer = self._answers.get(frame.dlci)
+            if answer is not None:
+                answer[1] = frame.control
+                answer[0].set()
+        elif frame.control in (UIH, UI) and frame.dlci in self._ptys:
+            self._deliver(frame.dlci, frame.info)
+        elif frame.control == DISC: # The modem closed the channel
+            self._write_all(self._ser.fileno(), encode_frame(frame.dlci, UA, cr=False))
+        elif frame.control == SABM:
+            self._write_all(self._ser.fileno(), encode_frame(frame.dlci, DM, cr=False))
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Discovery of the USB modems plugged in, and of the modem class to use with
+each of them, from sysfs. Models sharing a USB product ID are told apart with
+AT+GMM. A netlink watcher keeps the registry up to date on hot-plug."""
+
+import os
+import time
+import inspect
+import errno
+import socket
+import struct
+import threading
+import logging
+from collections import namedtuple
+
+from .lib import GSMModem
+from .pool import ModemPool
+
+# Modem plugged in. devpath is its name in /sys/bus/usb/devices, i.e. '1-1.2'.
+# ttys are its tty device files ordered by interface, devicefile the one for AT commands.
+UsbModem = namedtuple('UsbModem', ['devpath', 'vendor_id', 'product_id', 'serial', 'ttys', 'devicefile', 'modem_class'])
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL, UEVENT_UDEV = 1, 2 # Netlink multicast groups. udev ones come once /dev nodes exist
+
+
+def _is_async(cls):
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None) # python 3.5+
+    return iscoroutinefunction is not None and iscoroutinefunction(cls.connect)
+
+
+def modem_classes(base=GSMModem):
+    """base and all its subclasses, but AsyncGSMModem ones, which share the USB ids
+    of their blocking counterparts"""
+    classes = [base]
+    for subclass in base.__subclasses__():
+        classes += [cls for cls in modem_classes(subclass) if cls not in classes and not _is_async(cls)]
+    return classes
+
+
+def parse_uevent(data):
+    """Properties of a kernel or udev netlink message, as a dictionary"""
+    if data.startswith(b'libudev\0'):
+        properties_off = struct.unpack('I', data[16:20])[0]
+        data = data[properties_off:]
+    else:
+        data = data.split(b'\0', 1)[-1] # action@devpath
+    return dict(field.decode('utf-8', 'replace').split('=', 1) for field in data.split(b'\0') if b'=' in field)
+
+
+class ModemRegistry(object):
+    """Modems plugged in, indexed by their devpath. Modem classes are looked up by
+    VENDOR_ID and PRODUCT_ID, and the ones sharing them, like the MS2131 and the
+    MS2372h, by their PRODUCT in the AT+GMM answer. Probes run in parallel and
+    are cached by USB serial number, so a modem is probed once even if it is
+    replugged or its tty names change."""
+
+    PROBE_TIMEOUT = 10 # Seconds per modem, handshake included
+    SETTLE = 0.5 # Seconds from a uevent to the rescan
+
+    def __init__(self, baudrate=115200, sysfs='/sys', dev='/dev', classes=None):
+        """- sysfs, dev: roots of the sysfs and device file trees, to work on fake ones
+        - classes: modem classes to look up, all GSMModem subclasses by default"""
+        self.baudrate = baudrate
+        self.sysfs, self.dev = sysfs, dev
+        self.modems = {} # devpath -> UsbModem
+        self._classes, self._vendors = {}, {}
+        for cls in classes or modem_classes():
+            if cls.VENDOR_ID and cls.PRODUCT_ID:
+                self._classes.setdefault((cls.VENDOR_ID, cls.PRODUCT_ID), []).append(cls)
+            elif cls.VENDOR_ID: # Vendor base class, for its unknown products
+                self._vendors.setdefault(cls.VENDOR_ID, cls)
+        self._probes = {} # (vendor id, product id, serial or devpath) -> class
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._watcher, self._socket = None, None
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def __iter__(self):
+        return iter(sorted(self.modems.values()))
+
+    def __len__(self):
+        return len(self.modems)
+
+    def candidates(self, vendor_id, product_id):
+        """Modem classes for a USB device, empty if it is no known modem"""
+        if (vendor_id, product_id) in self._classes:
+            return list(self._classes[(vendor_id, product_id)])
+        return [self._vendors[vendor_id]] if vendor_id in self._vendors else []
+
+    def subscribe(self, callback):
+        """callback('add' or 'remove', UsbModem) on every change found by scan"""
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _read(self, path, base=None):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except (IOError, OSError):
+            return None
+        return int(value, base) if base is not None else value
+
+    def _usb_devices(self):
+        """(devpath, vendor id, product id, serial, ttys) of every USB device with tty nodes"""
+        root = os.path.join(self.sysfs, 'bus', 'usb', 'devices')
+        try:
+            names = sorted(os.listdir(root))
+        except OSError:
+            return []
+
+        devices = []
+        for name in names:
+            if ':' in name: # Interfaces are listed on their own
+                continue
+            path = os.path.join(root, name)
+            vendor_id, product_id = self._read(os.path.join(path, 'idVendor'), 16), self._read(os.path.join(path, 'idProduct'), 16)
+            if vendor_id is None or product_id is None:
+                continue
+
+            ttys = []
+            interfaces = [entry for entry in os.listdir(path) if entry.startswith(name + ':')]
+            for interface in sorted(interfaces, key=lambda entry: [int(n) for n in entry.split(':')[1].split('.')]):
+                interface = os.path.join(path, interface)
+                # usb-serial drivers add interface/ttyUSB0, cdc-acm interface/tty/ttyACM0
+                nodes = os.listdir(os.path.join(interface, 'tty')) if os.path.isdir(os.path.join(interface, 'tty')) else []
+                nodes += [entry for entry in os.listdir(interface) if entry.startswith('tty') and entry != 'tty']
+                ttys += [os.path.join(self.dev, node) for node in sorted(nodes)]
+            if ttys:
+                devices.append((name, vendor_id, product_id, self._read(os.path.join(path, 'serial')), ttys))
+        return devices
+
+    def scan(self):
+        """Look for the modems plugged in, updating modems and notifying subscribers.
+        Returns the list of UsbModem"""
+        with self._lock:
+            found, ambiguous = {}, []
+            for devpath, vendor_id, product_id, serial, ttys in self._usb_devices():
+                candidates = self.candidates(vendor_id, product_id)
+                if not candidates:
+                    continue
+                port = min(candidates[0].AT_PORT, len(ttys) - 1)
+                modem = UsbModem(devpath, vendor_id, product_id, serial, ttys, ttys[port], candidates[0])
+                known, key = self.modems.get(devpath), (vendor_id, product_id, serial or devpath)
+                if known is not None and known[:6] == modem[:6] and (len(candidates) == 1 or key in self._probes):
+                    modem = known # Unchanged, no need to probe it again. Failed probes are retried
+                elif len(candidates) > 1:
+                    probed = self._probes.get(key)
+                    if probed is not None:
+                        modem = modem._replace(modem_class=probed)
+                    else:
+                        ambiguous.append(modem)
+                found[devpath] = modem
+
+            for modem in self._probe(ambiguous):
+                found[modem.devpath] = modem
+
+            added = [modem for devpath, modem in found.items() if self.modems.get(devpath) != modem]
+            removed = [modem for devpath, modem in self.modems.items() if found.get(devpath) != modem]
+            self.modems = found
+
+        for action, modems in (('remove', removed), ('add', added)):
+            for modem in sorted(modems):
+                self._logger.info('Modem ' + action + ': ' + modem.devicefile + ' ' + modem.modem_class.__name__)
+                for callback in list(self._subscribers):
+                    try:
+                        callback(action, modem)
+                    except Exception as e:
+                        self._logger.error('Registry subscriber failed: ' + repr(e))
+        return sorted(found.values())
+
+    def _probe(self, modems):
+        """Resolve the class of modems sharing IDs with AT+GMM, all at once"""
+        if not modems:
+            return []
+
+        probes = dict((modem.modem_class(modem.devicefile, self.baudrate, lazy=True), modem) for modem in modems)
+        resolved = []
+        with ModemPool(probes) as pool:
+            for res in pool.run('get_model', timeout=self.PROBE_TIMEOUT):
+                modem = probes[res.modem]
+                candidates = self.candidates(modem.vendor_id, modem.product_id)
+                if res.error is None and res.result[0]:
+                    model = str(res.result[2]).lower()
+                    matches = [cls for cls in candidates if cls.PRODUCT.lower() in model]
+                    if matches:
+                        self._probes[(modem.vendor_id, modem.product_id, modem.serial or modem.devpath)] = matches[0]
+                        resolved.append(modem._replace(modem_class=matches[0]))
+                        continue
+                    self._logger.warning('Unknown model ' + model + ' on ' + modem.devicefile)
+                else:
+                    self._logger.warning('Model probe failed on ' + modem.devicefile + ': ' + str(res.error or res.result))
+                resolved.append(modem) # The first candidate, not cached so it is probed again next scan
+        return resolved
+
+    def modem(self, modem, **kwargs):
+        """Instance of the modem class of modem, an UsbModem or its devpath. The port is opened on first use"""
+        if not isinstance(modem, UsbModem):
+            modem = self.modems[modem]
+        kwargs.setdefault('lazy', True)
+        return modem.modem_class(modem.devicefile, self.baudrate, **kwargs)
+
+    def pool(self, max_workers=8):
+        """ModemPool of the modems found by the last scan"""
+        return ModemPool([self.modem(modem) for modem in self], max_workers)
+
+    def watch(self, group=UEVENT_UDEV):
+        """Scan now, and again on every USB or tty uevent, on a thread until stop.
+        Subscribers are notified from that thread.
+        - group: UEVENT_UDEV, or UEVENT_KERNEL where udev is not running"""
+        if self._watcher is not None:
+            return
+        self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self._socket.bind((0, group))
+        self._socket.settimeout(self.SETTLE)
+        self.scan()
+        self._watcher = threading.Thread(target=self._watch)
+        self._watcher.daemon = True
+        self._watcher.start()
+
+    def stop(self):
+        watcher, self._watcher = self._watcher, None
+        if watcher is not None and watcher is not threading.current_thread():
+            watcher.join()
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _watch(self):
+        pending = None # Time of the first uevent not scanned yet
+        while self._watcher is threading.current_thread():
+            try:
+                uevent = parse_uevent(self._socket.recv(65536))
+                if uevent.get('SUBSYSTEM') in ('usb', 'tty', 'usb-serial') and pending is None:
+                    pending = time.time()
+            except socket.timeout:
+                pass
+            except (socket.error, OSError) as e:
+                if e.errno not in (errno.EINTR, errno.ENOBUFS): # ENOBUFS when events were lost, rescan anyway
+                    self._logger.error('Registry watcher stopped: ' + repr(e))
+                    self._watcher = None
+                    return
+                pending = pending or time.time()
+
+            # Dongles come up as several uevents, and switch from storage to modem mode
+            if pending is not None and time.time() - pending >= self.SETTLE:
+                pending = None
+                try:
+                    self.scan()
+                except Exception as e:
+                    self._logger.error('Registry scan failed: ' + repr(e))
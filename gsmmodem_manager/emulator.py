@@ -0,0 +1,610 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Virtual Huawei modems behind pseudo-terminals, to exercise and benchmark
+GSMModem through the real serial port code without hardware.
+
+    python -m gsmmodem_manager.emulator --model E3372 --count 4
+"""
+
+import os
+import tty
+import time
+import heapq
+import random
+import select
+import threading
+import itertools
+import logging
+
+from .latency import command_key
+from .sms import encode_deliver, decode_pdu
+from .cmux import FrameDecoder, encode_frame, SABM, UA, DM, DISC, UIH, UI
+
+
+class _Hub(object):
+    """Single thread serving every emulator: reads their commands and writes the
+    responses when due, so hundreds of them don't need hundreds of threads."""
+
+    def __init__(self):
+        self._poll = select.poll()
+        self._emulators = {} # master fd -> emulator
+        self._timers = [] # heap of (due, seq, callback)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._poll.register(self._wakeup_r, select.POLLIN)
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+        thread = threading.Thread(target=self._loop)
+        thread.daemon = True
+        thread.start()
+
+    def register(self, emulator):
+        with self._lock:
+            self._emulators[emulator._master] = emulator
+            self._poll.register(emulator._master, select.POLLIN)
+        self._wakeup()
+
+    def unregister(self, emulator):
+        with self._lock:
+            if self._emulators.pop(emulator._master, None) is not None:
+                self._poll.unregister(emulator._master)
+
+    def schedule(self, delay, callback):
+        with self._lock:
+            heapq.heappush(self._timers, (time.time() + delay, next(self._seq), callback))
+        self._wakeup()
+
+    def _wakeup(self):
+        os.write(self._wakeup_w, b'.')
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                timeout = max(self._timers[0][0] - time.time(), 0) * 1000 if self._timers else None
+
+            for fd, event in self._poll.poll(timeout):
+                if fd == self._wakeup_r:
+                    os.read(self._wakeup_r, 1024)
+                    continue
+                emulator = self._emulators.get(fd)
+                if emulator is None:
+                    continue
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:
+                    continue
+                try: # A bug on one emulator must not stop the rest
+                    emulator._on_data(data)
+                except Exception:
+                    self._logger.exception('Emulator failed on ' + repr(data))
+
+            now = time.time()
+            while True:
+                with self._lock:
+                    if not self._timers or self._timers[0][0] > now:
+                        break
+                    callback = heapq.heappop(self._timers)[2]
+                try:
+                    callback()
+                except Exception:
+                    self._logger.exception('Emulator failed')
+
+
+_hub = None
+_hub_lock = threading.Lock()
+
+def _get_hub():
+    global _hub
+    with _hub_lock:
+        if _hub is None:
+            _hub = _Hub()
+        return _hub
+
+
+class ModemEmulator(object):
+    """Virtual Huawei modem behind a pseudo-terminal. Open devicefile with any of
+    the GSMModem classes. It answers the AT commands used by this library, and
+    keeps the state they change: operator, access technology, registration,
+    PDP context, APNs, etc.
+    - model: one of MODELS
+    - latency: seconds to answer a command, or (min, max) for a random one
+    - latencies: latency per command, i.e. {'AT+COPS=': 3}, or {'AT+COPS=0': 3} for
+      one first parameter only. See latency.command_key
+    - errors: error line answered to a command, i.e. {'AT+CGATT=': '+CME ERROR: 30'}
+    - noise: probability of trash characters before the final result code
+    - urc_interval: seconds between ^RSSI URCs. None for no periodic URCs
+    - registration_delay: seconds to register after selecting an operator
+    - networks: visible networks as {plmn: (long name, short name, act)}
+    SMS are supported in PDU mode: deliver() stores a received message, and the
+    ones sent are kept in sent.
+    AT+CMUX=0 switches it to 3GPP TS 27.010 multiplexing, each channel being a
+    port of its own. URCs are sent on all of them."""
+
+    MODELS = {
+        'MS2131': {'revision': '21.318.01.00.00', 'syscfg': '^SYSCFG'},
+        'MS2372h': {'revision': '21.110.99.02.00', 'syscfg': '^SYSCFGEX'},
+        'E3372': {'revision': '22.315.01.01.264', 'syscfg': '^SYSCFGEX'},
+    }
+
+    NETWORKS = {
+        '21401': ('vodafone ES', 'voda ES', 2),
+        '21403': ('Orange', 'Orange', 2),
+        '21407': ('Movistar', 'Movistar', 2),
+    }
+
+    def __init__(self, model='E3372', latency=0.01, latencies=None, errors=None, noise=0.0, urc_interval=None,
+                 registration_delay=0.5, networks=None, imei='861234567890123', imsi='214011234567890',
+                 iccid='8934011234567890123', seed=None):
+        assert model in self.MODELS, "Unknown model " + model
+        self.model = model
+        self.latency, self.latencies, self.errors = latency, latencies or {}, errors or {}
+        self.noise, self.urc_interval, self.registration_delay = noise, urc_interval, registration_delay
+        self.networks = networks if networks is not None else dict(self.NETWORKS)
+        self.imei, self.imsi, self.iccid = imei, imsi, iccid
+        self.commands = [] # Every command received, for the curious
+        self.messages = {} # SIM card storage, index -> [stat, PDU]
+        self.sent = [] # PDUs of the messages sent
+        self.storage_size = 50
+        self._random = random.Random(seed)
+        self._port = _Port(None) # The serial port itself
+        self._channels, self._decoder = None, None # Open CMUX channels, dlci -> _Port
+
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.devicefile = os.ttyname(self._slave)
+        self._closed = False
+        self._hub = _get_hub()
+        self.reset()
+        self._hub.register(self)
+        if urc_interval:
+            self._hub.schedule(urc_interval, self._periodic_urc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self._hub.unregister(self)
+            os.close(self._master)
+            os.close(self._slave)
+
+    def reset(self):
+        """Back to power on state"""
+        self._port.echo = True
+        self.creg_n, self.cgreg_n, self.cgerep, self.curc = 0, 0, 0, 1
+        self.operator, self.stat, self.act = None, '0', '00'
+        self.cops_mode = '0' # Automatic operator selection
+        self.mode, self.roam, self.srvdomain = '2', '1', '2'
+        self.attached, self.pdp_active = False, False
+        self.lac, self.cid = '00C3', '0000B1A7'
+        self.rssi, self.ber = 17, 99
+        self.apns = {1: 'internet'}
+        self.cmgf, self.cnmi, self.cmms, self.mr = 0, [], 0, 0
+        self._registration = None
+        self.select_operator(self.imsi[:5] if self.imsi[:5] in self.networks else None)
+
+    def emit(self, line, delay=0):
+        """Send an unsolicited result code"""
+        def write():
+            for dlci in sorted(self._channels) if self._channels is not None else [None]:
+                self._write('\r\n' + line + '\r\n', dlci)
+        self._hub.schedule(delay, write)
+
+    def select_operator(self, plmn):
+        """Start registering on plmn, as AT+COPS would do. None deregisters"""
+        self.operator = plmn
+        self._registration = registration = object() # Only the latest selection completes
+        if plmn is None:
+            self.set_registration('0')
+            return
+
+        self.set_registration('2') # Searching
+        def registered():
+            if self._registration is registration:
+                self.set_registration('1' if plmn[:5] == self.imsi[:5] else '5')
+        self._hub.schedule(self.registration_delay, registered)
+
+    def set_registration(self, stat):
+        """Change the registration status, sending +CREG/+CGREG URCs if enabled"""
+        self.stat = stat
+        if stat not in ('1', '5'):
+            self.attached = self.pdp_active = False
+        location = ',"' + self.lac + '","' + self.cid + '"'
+        if self.creg_n:
+            self.emit('+CREG: ' + stat + (location if self.creg_n == 2 else ''))
+        if self.cgreg_n:
+            self.emit('+CGREG: ' + stat + (location if self.cgreg_n == 2 else ''))
+
+    def deliver(self, sender, text, timestamp=None):
+        """Store a message received from sender, in several parts if it does not fit in
+        one, notifying each one with +CMTI if enabled. Returns their indexes"""
+        indexes = []
+        for pdu in encode_deliver(sender, text, timestamp, smsc='+34609090909', reference=len(self.sent) + len(self.messages)):
+            free = [index for index in range(1, self.storage_size + 1) if index not in self.messages]
+            if not free:
+                break # Storage full, lost
+            self.messages[free[0]] = [0, pdu]
+            indexes.append(free[0])
+            if self.cnmi[1:2] == ['1']:
+                self.emit('+CMTI: "SM",' + str(free[0]))
+        return indexes
+
+    # Serial I/O, called from the hub thread
+
+    def _write(self, data, dlci=None):
+        """Write to the serial port, or to a CMUX channel"""
+        if self._closed:
+            return
+        data = data.encode('latin-1')
+        if dlci is not None:
+            if dlci not in (self._channels or ()):
+                return # Closed meanwhile
+            data = encode_frame(dlci, UIH, data, cr=False)
+        os.write(self._master, data)
+
+    def _on_data(self, data):
+        if self._channels is None:
+            self._on_text(self._port, data.decode('latin-1'))
+            return
+        for frame in self._decoder.feed(data):
+            self._on_frame(frame)
+
+    def _on_frame(self, frame):
+        if frame.control == SABM:
+            if frame.dlci:
+                self._channels[frame.dlci] = _Port(frame.dlci)
+            os.write(self._master, encode_frame(frame.dlci, UA))
+        elif frame.control == DISC:
+            self._channels.pop(frame.dlci, None)
+            os.write(self._master, encode_frame(frame.dlci, UA))
+            if frame.dlci == 0: # Multiplexer closed down, back to AT commands
+                self._channels, self._decoder = None, None
+        elif frame.control in (UIH, UI):
+            if frame.dlci in self._channels:
+                self._on_text(self._channels[frame.dlci], frame.info.decode('latin-1'))
+            else:
+                os.write(self._master, encode_frame(frame.dlci, DM))
+
+    def _on_text(self, port, text):
+        port.rxbuf += text
+        while port.prompt is not None: # Message after the AT+CMGS prompt, up to Ctrl-Z, or ESC to cancel it
+            ends = [i for i in (port.rxbuf.find('\x1a'), port.rxbuf.find('\x1b')) if i >= 0]
+            if not ends:
+                return
+            message, end, port.rxbuf = port.rxbuf[:min(ends)], port.rxbuf[min(ends)], port.rxbuf[min(ends) + 1:]
+            self._on_message(port, message.strip(), end == '\x1a')
+        while '\r' in port.rxbuf:
+            line, port.rxbuf = port.rxbuf.split('\r', 1)
+            if port.echo:
+                self._write(line + '\r', port.dlci)
+            command = line.strip().lstrip('\n')
+            if command[:2].upper() == 'AT':
+                self._on_command(command, port)
+            if port.prompt is not None: # The rest is the message
+                self._on_text(port, '')
+                return
+
+    @staticmethod
+    def _lookup(table, command, default=None):
+        """Value for command in table, by its key with the first parameter or without it"""
+        return table.get(command_key(command), table.get(command_key(command, argument=False), default))
+
+    def _on_command(self, command, port):
+        self.commands.append(command)
+        latency = self._lookup(self.latencies, command, self.latency)
+        if isinstance(latency, tuple):
+            latency = self._random.uniform(*latency)
+
+        error = self._lookup(self.errors, command)
+        self._busy = 0 # Extra seconds some commands take, like registering
+        if error is None:
+            lines, error = [], None
+            # Concatenated commands, i.e. AT+CSQ;+CIMI. The first error aborts the rest
+            for part in command[2:].split(';'):
+                try:
+                    lines.extend(self._execute(part, port))
+                except _CommandError as e:
+                    error = str(e)
+                    break
+
+        if port.prompt is not None and not error:
+            self._hub.schedule(latency, lambda: self._write('\r\n> ', port.dlci))
+            return
+        port.prompt = None
+
+        response = ''.join('\r\n' + line + '\r\n' for line in ([] if error else lines))
+        if self.noise and self._random.random() < self.noise:
+            response += '\r\n' + ''.join(chr(self._random.randint(0x21, 0x7e)) for _ in range(3)) + '\r\n'
+        response += '\r\n' + (error or 'OK') + '\r\n'
+        self._hub.schedule(latency + self._busy, lambda: self._write(response, port.dlci))
+
+    def _on_message(self, port, pdu, send):
+        length, port.prompt = port.prompt, None
+        if not send:
+            response = '\r\nOK\r\n' # Cancelled
+        elif self.cmgf:
+            response = '\r\n+CMS ERROR: 304\r\n' # Invalid PDU mode parameter
+        else:
+            try: # Anything else than the announced TPDU length after the SMSC, i.e. a command, is invalid
+                if len(pdu) - 2 - 2 * int(pdu[:2], 16) != 2 * length:
+                    raise ValueError('PDU length mismatch')
+                decode_pdu(pdu)
+                self.sent.append(pdu)
+                self.mr = (self.mr + 1) % 256
+                response = '\r\n+CMGS: ' + str(self.mr) + '\r\n\r\nOK\r\n'
+            except ValueError:
+                response = '\r\n+CMS ERROR: 304\r\n'
+        latency = self.latencies.get('AT+CMGS=', self.latency)
+        if isinstance(latency, tuple):
+            latency = self._random.uniform(*latency)
+        self._hub.schedule(latency, lambda: self._write(response, port.dlci))
+
+    def _periodic_urc(self):
+        if self._closed:
+            return
+        if self.curc:
+            self.rssi = max(0, min(31, self.rssi + self._random.randint(-1, 1)))
+            self.emit('^RSSI: ' + str(self.rssi))
+        self._hub.schedule(self.urc_interval, self._periodic_urc)
+
+    # AT commands, without the AT prefix. They return the information lines or
+    # raise _CommandError with the error line
+
+    def _execute(self, command, port):
+        upper = command.upper()
+        if upper in ('', 'E0', 'E1', 'Z'):
+            if upper == 'Z':
+                self.reset()
+            elif upper:
+                port.echo = upper == 'E1'
+            return []
+
+        name, sep, args = command.partition('=')
+        if name.upper() == '+CMGS' and sep: # Prompts for the message, see _on_text
+            self._pdu_mode()
+            port.prompt = int(args)
+            return []
+        handler = getattr(self, '_at_' + name.lstrip('+^').rstrip('?').lower(), None)
+        if handler is None:
+            raise _CommandError('COMMAND NOT SUPPORT' if name.startswith('^') else 'ERROR')
+        if name.endswith('?'):
+            return handler(query=True)
+        elif args == '?':
+            return handler(test=True)
+        return handler(args=[arg.strip('"') for arg in args.split(',')] if sep else [])
+
+    def _at_gmi(self, **kwargs):
+        return ['huawei']
+
+    def _at_gmm(self, **kwargs):
+        return [self.model]
+
+    def _at_gmr(self, **kwargs):
+        return [self.MODELS[self.model]['revision']]
+
+    def _at_gsn(self, **kwargs):
+        return [self.imei]
+
+    def _at_cimi(self, **kwargs):
+        return [self.imsi]
+
+    def _at_iccid(self, **kwargs):
+        return ['^ICCID: ' + self.iccid + 'F' * (20 - len(self.iccid))]
+
+    def _at_reset(self, **kwargs):
+        self.reset()
+        self._channels, self._decoder = None, None # Rebooted, the multiplexer too
+        return []
+
+    def _at_cmux(self, args=None, **kwargs):
+        if args is None or args[0] != '0' or self._channels is not None:
+            raise _CommandError('ERROR') # Basic option only
+        self._channels, self._decoder = {}, FrameDecoder() # The OK is written raw yet
+        return []
+
+    def _at_curc(self, args=None, **kwargs):
+        self.curc = int(args[0])
+        return []
+
+    def _at_csq(self, **kwargs):
+        return ['+CSQ: ' + str(self.rssi) + ',' + str(self.ber)]
+
+    def _at_cops(self, args=None, query=False, test=False):
+        if query:
+            if self.stat in ('1', '5'):
+                act = self.networks.get(self.operator, ('', '', 2))[2]
+                return ['+COPS: ' + self.cops_mode + ',2,"' + self.operator + '",' + str(act)]
+            return ['+COPS: ' + self.cops_mode]
+        elif test:
+            # Status 2 current, 1 available
+            networks = ','.join('(' + ('2' if plmn == self.operator else '1') + ',"' + names[0] + '","' + names[1] +
+                                '","' + plmn + '",' + str(names[2]) + ')' for plmn, names in sorted(self.networks.items()))
+            return ['+COPS: ' + networks + ',,(0,1,2,3,4),(0,1,2)']
+
+        if args[0] in ('1', '4') and len(args) >= 3:
+            if args[2] not in self.networks:
+                raise _CommandError('+CME ERROR: 30') # No network service
+            self.select_operator(args[2])
+            self.cops_mode = args[0]
+            self._busy = self.registration_delay # Manual selection answers once registered
+        elif args[0] == '0':
+            self.select_operator(self.imsi[:5] if self.imsi[:5] in self.networks else sorted(self.networks)[0])
+            self.cops_mode = args[0]
+        elif args[0] == '2':
+            self.select_operator(None)
+            self.cops_mode = args[0]
+        return []
+
+    def _registration_info(self, name, n):
+        info = '+' + name + ': ' + str(n) + ',' + self.stat
+        if n == 2 and self.stat in ('1', '5'):
+            info += ',"' + self.lac + '","' + self.cid + '"'
+        return [info]
+
+    def _at_creg(self, args=None, query=False, **kwargs):
+        if query:
+            return self._registration_info('CREG', self.creg_n)
+        self.creg_n = int(args[0])
+        return []
+
+    def _at_cgreg(self, args=None, query=False, **kwargs):
+        if query:
+            return self._registration_info('CGREG', self.cgreg_n)
+        self.cgreg_n = int(args[0])
+        return []
+
+    def _at_cgerep(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CGEREP: ' + str(self.cgerep) + ',0']
+        self.cgerep = int(args[0])
+        return []
+
+    def _at_cgatt(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CGATT: ' + ('1' if self.attached else '0')]
+        if args[0] == '1':
+            if self.stat not in ('1', '5'):
+                raise _CommandError('+CME ERROR: 30')
+            self.attached = True
+        else:
+            self.attached = self.pdp_active = False
+            if self.cgerep:
+                self.emit('+CGEV: ME DETACH')
+        return []
+
+    def _at_cgact(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CGACT: 1,' + ('1' if self.pdp_active else '0')]
+        if args[0] == '1':
+            if not self.attached:
+                raise _CommandError('+CME ERROR: 30')
+            self.pdp_active = True
+            if self.cgerep:
+                self.emit('+CGEV: ME PDN ACT 1')
+        else:
+            self.pdp_active = False
+        return []
+
+    def _at_cgdcont(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CGDCONT: ' + str(cid) + ',"IP","' + apn + '","0.0.0.0",0,0' for cid, apn in sorted(self.apns.items())]
+        self.apns[int(args[0])] = args[2]
+        return []
+
+    def _at_syscfg(self, args=None, query=False, **kwargs):
+        if self.MODELS[self.model]['syscfg'] != '^SYSCFG':
+            raise _CommandError('COMMAND NOT SUPPORT')
+        if query:
+            return ['^SYSCFG: ' + self.mode + ',' + str(int(self.act)) + ',3FFFFFFF,' + self.roam + ',' + self.srvdomain]
+        self.mode, self.act, self.roam, self.srvdomain = args[0], args[1], args[3], args[4]
+        return []
+
+    def _at_syscfgex(self, args=None, query=False, **kwargs):
+        if self.MODELS[self.model]['syscfg'] != '^SYSCFGEX':
+            raise _CommandError('COMMAND NOT SUPPORT')
+        if query:
+            return ['^SYSCFGEX: "' + self.act + '",3FFFFFFF,' + self.roam + ',' + self.srvdomain + ',7FFFFFFFFFFFFFFF']
+        self.act, self.roam, self.srvdomain = args[0], args[2], args[3]
+        return []
+
+    def _at_cmgf(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CMGF: ' + str(self.cmgf)]
+        self.cmgf = int(args[0])
+        return []
+
+    def _at_cnmi(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CNMI: ' + ','.join(self.cnmi or ['0', '0', '0', '0', '0'])]
+        self.cnmi = args
+        return []
+
+    def _at_cmms(self, args=None, query=False, **kwargs):
+        if query:
+            return ['+CMMS: ' + str(self.cmms)]
+        self.cmms = int(args[0])
+        return []
+
+    def _pdu_mode(self):
+        if self.cmgf:
+            raise _CommandError('+CMS ERROR: 302') # Operation not allowed, text mode is not emulated
+
+    def _at_cmgl(self, args=None, **kwargs):
+        self._pdu_mode()
+        stat = int(args[0]) if args else 0
+        lines = []
+        for index, message in sorted(self.messages.items()):
+            if stat == 4 or message[0] == stat:
+                lines += ['+CMGL: ' + str(index) + ',' + str(message[0]) + ',,' + str(len(message[1]) // 2 - 1 - int(message[1][:2], 16)),
+                          message[1]]
+                message[0] = 1 if message[0] == 0 else message[0]
+        return lines
+
+    def _at_cmgr(self, args=None, **kwargs):
+        self._pdu_mode()
+        message = self.messages.get(int(args[0]))
+        if message is None:
+            raise _CommandError('+CMS ERROR: 321') # Invalid memory index
+        lines = ['+CMGR: ' + str(message[0]) + ',,' + str(len(message[1]) // 2 - 1 - int(message[1][:2], 16)), message[1]]
+        message[0] = 1 if message[0] == 0 else message[0]
+        return lines
+
+    def _at_cmgd(self, args=None, **kwargs):
+        flag = int(args[1]) if len(args) > 1 else 0
+        if flag:
+            stats = {1: (1,), 2: (1, 3), 3: (1, 2, 3), 4: (0, 1, 2, 3)}[flag]
+            for index in [index for index, message in self.messages.items() if message[0] in stats]:
+                del self.messages[index]
+        elif not 1 <= int(args[0]) <= self.storage_size:
+            raise _CommandError('+CMS ERROR: 321')
+        else:
+            self.messages.pop(int(args[0]), None)
+        return []
+
+
+class _CommandError(Exception):
+    """Error line answered to a command"""
+
+
+class _Port(object):
+    """Line buffer and echo setting of the serial port or of a CMUX channel"""
+
+    def __init__(self, dlci):
+        self.dlci, self.rxbuf, self.echo = dlci, '', True
+        self.prompt = None # Length of the message being entered after AT+CMGS
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Virtual Huawei modems behind pseudo-terminals')
+    parser.add_argument('--model', default='E3372', choices=sorted(ModemEmulator.MODELS))
+    parser.add_argument('--count', type=int, default=1, help='number of modems')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds to answer a command')
+    parser.add_argument('--noise', type=float, default=0.0, help='probability of trash characters')
+    parser.add_argument('--urc-interval', type=float, default=None, help='seconds between ^RSSI URCs')
+    args = parser.parse_args()
+
+    emulators = [ModemEmulator(args.model, args.latency, noise=args.noise, urc_interval=args.urc_interval)
+                 for _ in range(args.count)]
+    for emulator in emulators:
+        print(emulator.devicefile)
+
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        for emulator in emulators:
+            emulator.close()
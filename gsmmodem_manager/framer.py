@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import re
+import sys
+import errno
+import select
+
+from .recorder import RX
+
+_EOL = re.compile(b'[\r\n]')
+_BLANKS = bytearray(b' \t')
+_WHITESPACE = bytearray(b' \t\r\n')
+_PROMPT = b'>'
+
+if sys.version_info[0] >= 3:
+    def _decode(buf, start, end):
+        return str(memoryview(buf)[start:end], 'ascii', 'replace') # No intermediate bytes copy
+else:
+    def _decode(buf, start, end):
+        return str(buf[start:end])
+
+
+class LineFramer(object):
+    """Splits the bytes received from a modem in lines, on CR or LF. Data is read
+    straight from the file descriptor into a reusable bytearray, where lines are
+    searched in place, and only copied out of it when decoded. Reading the file
+    descriptor instead of through pyserial also avoids its select() calls, which
+    fail with descriptors over 1024."""
+
+    CHUNK = 4096 # Max bytes per read
+
+    def __init__(self):
+        self._buf = bytearray(self.CHUNK)
+        self._start, self._end = 0, 0 # Data not taken as lines yet
+        self.recorder = None # recorder.Recorder of the data read
+
+    def read(self, fd):
+        """Read what's available on fd, which must be non blocking. Returns the number
+        of bytes read, 0 at end of file, or None if there was nothing to read"""
+        self._reserve(self.CHUNK)
+        try:
+            if hasattr(os, 'readv'):
+                received = os.readv(fd, [memoryview(self._buf)[self._end:self._end + self.CHUNK]])
+                data = memoryview(self._buf)[self._end:self._end + received] if self.recorder else None
+            else: # python 2
+                data = os.read(fd, self.CHUNK)
+                received = len(data)
+                self._buf[self._end:self._end + received] = data
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+        if self.recorder is not None and received:
+            self.recorder.record(RX, data)
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Add data read by other means"""
+        self._reserve(len(data))
+        self._buf[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def _reserve(self, size):
+        if len(self._buf) - self._end >= size:
+            return
+        pending = self._end - self._start
+        if self._start: # Move the pending data to the beginning
+            self._buf[:pending] = self._buf[self._start:self._end]
+            self._start, self._end = 0, pending
+        if len(self._buf) - self._end < size:
+            self._buf.extend(bytearray(size - (len(self._buf) - self._end)))
+
+    def lines(self):
+        """Generator of the complete non empty lines, without blanks around. Lines
+        not iterated yet are kept, i.e. when the caller stops after a final result code.
+        A prompt to enter a message, '> ' with no line end, is a line too."""
+        buf = self._buf
+        while True:
+            match = _EOL.search(buf, self._start, self._end)
+            if match is None:
+                if 0 < self._end - self._start < 8 and buf[self._start:self._end].strip() == _PROMPT: # No copy of long partials
+                    self._start = self._end
+                    yield _PROMPT.decode('ascii')
+                if self._start == self._end:
+                    self._start, self._end = 0, 0
+                return
+
+            start, end = self._start, match.start()
+            self._start = end + 1
+            while start < end and buf[start] in _BLANKS:
+                start += 1
+            while end > start and buf[end - 1] in _BLANKS:
+                end -= 1
+            if start < end:
+                yield _decode(buf, start, end)
+
+    def pop_partial(self):
+        """Takes out the incomplete line received so far"""
+        start, end = self._start, self._end
+        while start < end and self._buf[start] in _WHITESPACE:
+            start += 1
+        while end > start and self._buf[end - 1] in _WHITESPACE:
+            end -= 1
+        msg = _decode(self._buf, start, end)
+        self._start, self._end = 0, 0
+        return msg
+
+    def clear(self):
+        self._start, self._end = 0, 0
+
+
+def wait_readable(fd, timeout):
+    """Wait up to timeout seconds until fd is readable. poll() has no descriptor limit"""
+    poll = select.poll()
+    poll.register(fd, select.POLLIN)
+    return bool(poll.poll(max(timeout, 0) * 1000))
+
+
+def write_all(fd, data, timeout=5):
+    """Write data to a non blocking fd, waiting while it's full"""
+    poll = None
+    while data:
+        try:
+            data = data[os.write(fd, data):]
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+            if poll is None:
+                poll = select.poll()
+                poll.register(fd, select.POLLOUT)
+            if not poll.poll(timeout * 1000):
+                raise OSError(errno.ETIMEDOUT, 'Write timed out')
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import json
+import logging
+import threading
+from collections import deque
+
+MESSAGE_KEY = '<message>'
+
+def command_key(command, argument=True):
+    """Command without its parameters but the first one, which tells set commands
+    like AT+CGATT=1 and AT+CGATT=0 apart, i.e. AT+COPS=1,2,"21401" -> AT+COPS=1
+    Quoted ones, like PINs and phone numbers, are left out: AT+CPIN="1234" -> AT+CPIN=
+    Messages entered after a prompt, like the PDUs of AT+CMGS, are all MESSAGE_KEY
+    - argument: False to leave out the first parameter too, AT+COPS=1,2,"21401" -> AT+COPS="""
+    if command.endswith(('\x1a', '\x1b')):
+        return MESSAGE_KEY
+    parts = []
+    for part in command.split(';'):
+        if part.endswith('=?') or '=' not in part:
+            parts.append(part)
+        else:
+            name, params = part.split('=', 1)
+            first = params.split(',')[0] if argument else ''
+            parts.append(name + '=' + ('' if first.startswith('"') else first))
+    return ';'.join(parts)
+
+
+class LatencyProfiles(object):
+    """Observed completion latency of each command, per modem model and firmware
+    revision. Command deadlines are derived from a high percentile of them, so
+    they shrink to what each model really needs, or grow for the slow ones.
+    Profiles can be saved to disk and loaded by a new process."""
+
+    PERCENTILE = 95
+    MARGIN = 1.5 # Deadline is the percentile latency times this
+    MIN_SAMPLES = 5 # Below this, the default deadline of the command is used
+    MAX_SAMPLES = 200 # Only the latest ones are kept
+    MIN_DEADLINE, MAX_DEADLINE = 0.2, 120
+
+    def __init__(self):
+        self._profiles = {} # 'vendor:product:revision' -> {command key -> deque of seconds}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        """Profiles saved at path. Empty ones if the file does not exist yet, or it
+        is not valid, i.e. truncated by a crash while saving"""
+        profiles = cls()
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            with profiles._lock:
+                for model, commands in data.items():
+                    for key, samples in commands.items():
+                        profiles._samples(model, key).extend(float(sample) for sample in samples)
+        except IOError:
+            return cls()
+        except (AttributeError, TypeError, ValueError) as e:
+            logging.getLogger('carrierwatchdog.modem').warning('Latency profiles discarded: ' + repr(e))
+            return cls()
+        return profiles
+
+    def save(self, path):
+        with self._lock:
+            data = dict((model, dict((key, list(samples)) for key, samples in commands.items()))
+                        for model, commands in self._profiles.items())
+        with open(path, 'w') as f:
+            json.dump(data, f, sort_keys=True)
+
+    @staticmethod
+    def model(modem, revision=None):
+        return hex(modem.VENDOR_ID) + ':' + hex(modem.PRODUCT_ID) + ':' + (revision or '*')
+
+    def _samples(self, model, key):
+        """Called with the lock held"""
+        return self._profiles.setdefault(model, {}).setdefault(key, deque(maxlen=self.MAX_SAMPLES))
+
+    def record(self, modem, revision, command, seconds):
+        """Completion latency of a command. Kept for the firmware revision, if known,
+        and for the whole model."""
+        key = command_key(command)
+        with self._lock:
+            self._samples(self.model(modem), key).append(round(seconds, 4))
+            if revision:
+                self._samples(self.model(modem, revision), key).append(round(seconds, 4))
+
+    def deadline(self, modem, revision, command, default):
+        """Deadline for the command. The revision profile is preferred, then the model one,
+        falling back to default while there are not enough samples of either. Learned
+        deadlines are capped at MAX_DEADLINE, or at default for commands known to take longer."""
+        key = command_key(command)
+        for model in (self.model(modem, revision), self.model(modem)):
+            with self._lock: # Copied, as other threads record meanwhile
+                samples = list(self._profiles.get(model, {}).get(key, ()))
+            if len(samples) >= self.MIN_SAMPLES:
+                samples.sort()
+                latency = samples[min(len(samples) * self.PERCENTILE // 100, len(samples) - 1)]
+                return min(max(latency * self.MARGIN, self.MIN_DEADLINE), max(self.MAX_DEADLINE, default))
+        return default
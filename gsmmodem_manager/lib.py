@@ -8,9 +8,26 @@
 # - J. Félix Ontañón <felix.ontanon@podgroup.com>
 # - Pius T. Loosli Hirsbrunner <pius.loosli@podgroup.com>
 
+import re
 import serial
 import time
 import logging
+import functools
+import threading
+from collections import deque
+
+try:
+    import Queue as queue # python 2
+except ImportError:
+    import queue
+
+from .urc import UrcDispatcher
+from .cmux import Multiplexer
+from .framer import LineFramer, wait_readable, write_all
+from .recorder import TX
+from .sms import encode_sms, decode_pdu, iter_messages, Reassembler
+from .parsers import parse_csq, parse_creg, parse_cops, parse_cops_list, parse_cgdcont, parse_syscfg, parse_iccid, as_dict
+from .parsers import parse_cmgr, parse_cmti, parse_cmgs
 
 # Inspired in http://m2msupport.net/m2msupport/atcsq-signal-quality/
 def signal_quality(rssi_dBm):
@@ -23,13 +40,65 @@ def signal_quality(rssi_dBm):
     else: return "Not valid rssi_dBm"
 
 
+def at_operation(function):
+    """Decorator used to write modem methods independently of the serial I/O.
+    The decorated generator yields (command, sleeptime) tuples to send commands,
+    receiving back the response lines, or (None, timeout) to wait for the next URC.
+    It ends yielding the (status, command, response) result. Each modem class
+    drives it through _run_operation, so the same definition serves blocking and
+    asyncio modems. The generator itself is kept as the operation attribute, so
+    other operations can delegate on it."""
+    @functools.wraps(function)
+    def func_wrapper(self, *args, **kwargs):
+        return self._run_operation(function(self, *args, **kwargs))
+    func_wrapper.operation = function
+    return func_wrapper
+
+
+def cached_operation(function):
+    """Decorator for at_operation generators whose result hardly ever changes, like
+    the IMEI. Successful results are kept for CACHE_TTL seconds in the modem cache,
+    unless a command timed out on the way, as its late answer may have been taken
+    for the response of another one. A new result of the SIM_IDENTITY methods different than the previous one means
+    the SIM card was swapped, so the whole cache is invalidated. So do the SIM_URC_PREFIXES URCs, which are
+    read before serving a cached result even without the reader thread. A modem which does not report
+    the swap with them serves the identity of the old SIM card for up to CACHE_TTL seconds."""
+    name = function.__name__
+
+    @functools.wraps(function)
+    def func_wrapper(self, *args, **kwargs):
+        self._dispatch_urcs() # A SIM card swap reported meanwhile invalidates the cache
+        cached = self._cache.get(name)
+        if cached is not None and time.time() - cached[0] < self.CACHE_TTL:
+            yield cached[1]
+            return
+
+        operation = function(self, *args, **kwargs)
+        step, timed_out = next(operation), False
+        while len(step) != 3:
+            response = yield step
+            if step[0] is not None and (not len(response) or not self._is_final_response(response[-1])):
+                timed_out = True
+            step = operation.send(response)
+        operation.close()
+
+        if step[0] and not timed_out:
+            if name in self.SIM_IDENTITY and cached is not None and cached[1][2] != step[2]:
+                self._logger.warning('SIM card changed, ' + name + ' is now ' + str(step[2]))
+                self.invalidate_cache()
+            self._cache[name] = (time.time(), step)
+        yield step
+    return func_wrapper
+
+
 class GSMModem(object):
     """Super class for GSM modems. Only Standard Hayes AT commands supported."""
 
-    __conf = {'devicefile':'', 'baudrate':''}
-
     VENDOR_ID, PRODUCT_ID = 0x0000, 0x0000,
     VENDOR, PRODUCT = 'GSM Modem', 'Generic'
+
+    # Which of the tty nodes of the USB device answers AT commands, in interface order
+    AT_PORT = 0
     
     # As per ETSI TS 127 007 v10.3.0 AT Commands set for User Equipment
     # Format of dictionary
@@ -43,35 +112,398 @@ class GSMModem(object):
     #    }
     RSSI_DBM = dict(zip(
         range(0, 32), # 0 to 31
-        [(x, signal_quality(x),n*100/32) for n,x in enumerate(range(-113, -49, 2))]
-    )); del x
+        [(x, signal_quality(x),n*100//32) for n,x in enumerate(range(-113, -49, 2))]
+    ))
     RSSI_DBM[99] = (-114, 'Not known or not detectable', 0)
 
-    def __init__(self, devicefile, baudrate, timeout=25):
-        self.__conf['devicefile'], self.__conf['baudrate'] = devicefile, baudrate
-        self.__ser = serial.Serial(devicefile, baudrate, timeout=25, dsrdtr=True, rtscts=True)
+    # Registration status, as per 3GPP TS 27.007 +CREG
+    STAT_NOTREG, STAT_REGHOME, STAT_SEARCH, STAT_DENIED, STAT_UNK, STAT_REGROAM = '0', '1', '2', '3', '4', '5'
+
+    # Unsolicited result codes, as per 3GPP TS 27.007 and 27.005
+    URC_PREFIXES = ('+CREG:', '+CGREG:', '+CEREG:', '+CGEV:', '+CMTI:', '+CMT:', '+CDSI:', '+CDS:', '+CBM:',
+                    '+CUSD:', '+CRING:', 'RING', '+CLIP:', '+CPIN:')
+
+    def __init__(self, devicefile, baudrate, timeout=25, lazy=False):
+        """- lazy: True to postpone opening the port until the first command is sent"""
+        self.__conf = {'devicefile': devicefile, 'baudrate': baudrate}
+        self.__ser = None
+        self.__framer = LineFramer()
+        self.__reader, self.__responses, self.__pending = None, None, None
+        self._late = None # Deadline for the final result code of a command which timed out
+        self._lock = threading.RLock() # Held while a command is sent, so those of several threads never interleave
+        self._urc = UrcDispatcher(self.URC_PREFIXES)
+        self.__urc_event = threading.Event()
+        self._urc.subscribe('', lambda line: self.__urc_event.set())
+        self._cache = {} # method name -> (timestamp, result)
+        self._scans = {} # (lac, cid) -> (timestamp, scan_networks result)
+        self._latency = None
+        self._metrics = None
+        self._recorder = None
+        for prefix in self.SIM_URC_PREFIXES:
+            self._urc.subscribe(prefix, lambda line: self.invalidate_cache())
+        self._sms_indexes, self._sms_parts = deque(), Reassembler() # Messages notified, not received yet
+        self._sms_reference = int(time.time()) % 256 # Of concatenated messages
+        self._urc.subscribe('+CMTI:', self.__on_new_sms)
         self._logger = logging.getLogger('carrierwatchdog.modem')
         if not self._logger.handlers: logging.basicConfig() # In the case there's no parent logger, lets log anyway in basic mode
-        self.set_echo(on=False)
+        if not lazy:
+            self.connect()
 
     def __str__(self):
         return self.VENDOR + ' ' + self.PRODUCT + ' (' + hex(self.VENDOR_ID) + ',' + hex(self.PRODUCT_ID) + ')'
+
+    def __enter__(self):
+        if self.__ser is None or not self.__ser.isOpen():
+            self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close_connection()
+
+    def connect(self, retries=10, sleeptime=0.5):
+        """Open the serial port and handshake with the modem.
+        - retries: max number of handshake probes
+        - sleeptime: deadline in seconds for each probe"""
+        self.invalidate_cache() # It may be a different modem or SIM card by now
+        with self._lock:
+            if self.__ser is None:
+                self.__ser = serial.Serial(self.__conf['devicefile'], self.__conf['baudrate'], timeout=25, dsrdtr=True, rtscts=True)
+            elif not self.__ser.isOpen():
+                self.__ser.open()
+
+            return self.handshake(retries, sleeptime)
+
+    @at_operation
+    def handshake(self, retries=10, sleeptime=0.5):
+        """Probe the modem with ATE0 until it answers OK. Echo is turned off on the way.
+        - retries: max number of probes
+        - sleeptime: deadline in seconds for each probe"""
+        command, response = 'ATE0', []
+        for _ in range(retries):
+            response = yield command, sleeptime
+
+            # The first answer may still come echoed, so only the last line matters
+            if len(response) and response[-1] == 'OK':
+                yield True, command, None
+
+        self._logger.error('Handshake failed with: ' + str(response))
+        yield False, command, response
   
-    # By default 2 seconds of sleep before reading command response. Randomly choosed :D
+    # Any of these lines closes the response to a command. As per ITU-T V.250
+    # and 3GPP TS 27.007, plus the Huawei specific one for unknown commands.
+    FINAL_RESPONSES = ('OK', 'ERROR', 'NO CARRIER', 'NO DIALTONE', 'BUSY', 'NO ANSWER', 'COMMAND NOT SUPPORT')
+    FINAL_RESPONSE_PREFIXES = ('+CME ERROR:', '+CMS ERROR:')
+
+    # Commands answered with a prompt to enter a message, as per 3GPP TS 27.005.
+    # The message is sent as a command too, ending with CTRL_Z, or ESC to cancel it.
+    PROMPT_COMMANDS = ('AT+CMGS=', 'AT+CMGW=')
+    PROMPT, CTRL_Z, ESC = '>', '\x1a', '\x1b'
+
+    def _is_final_response(self, line):
+        return line in self.FINAL_RESPONSES or line.startswith(self.FINAL_RESPONSE_PREFIXES) or line == self.PROMPT
+
+    def _command_data(self, command):
+        """Characters sent for command. Messages go as they are, prompt commands end with
+        a bare CR, as the LF would be taken as part of the message, and the rest with CR LF"""
+        if command.endswith((self.CTRL_Z, self.ESC)):
+            return command
+        return command + ('\r' if command.startswith(self.PROMPT_COMMANDS) else '\r\n')
+
+    # Seconds to wait for the late answer of a command which timed out, before sending
+    # the next one. The modem answers nothing else meanwhile, and its lines would be
+    # taken as the response of the next command otherwise.
+    LATE_RESPONSE_TIMEOUT = 5
+
+    # The response is returned as soon as a final result code is read. The sleeptime
+    # is the deadline to wait for it, by default 2 seconds. Randomly choosed :D
     def _send_command(self, command, sleeptime=2):
-        self.__ser.write(command+"\r\n")
-        time.sleep(sleeptime)
-
-        ret = []
-        while self.__ser.inWaiting() > 0:
-            msg = self.__ser.readline().strip().replace("\r","").replace("\n","")
-            if msg != "":
+        with self._lock:
+            if self.__ser is None: # Lazy mode, the port is opened on first use
+                self.connect()
+
+            sleeptime = self._command_deadline(command, sleeptime)
+            if self.__reader is not None:
+                self.__drain_reader()
+                start = time.time()
+                response, first_line = self.__send_command_reader(command, sleeptime)
+            else:
+                self.__drain()
+                start = time.time()
+                self.__write(command)
+                response, first_line = self.__read_response(command, start + sleeptime)
+
+            end = time.time()
+            if not len(response) or not self._is_final_response(response[-1]):
+                self._late = end + self.LATE_RESPONSE_TIMEOUT
+            self._record_latency(command, sleeptime, end - start, response)
+            self._record_metrics(command, response, start, first_line, end)
+        return response
+
+    def set_metrics(self, metrics):
+        """Count the commands sent in metrics, a Metrics shared among modems. None,
+        the default, to stop counting."""
+        self._metrics = metrics
+
+    def _record_metrics(self, command, response, start, first_line, end):
+        """- first_line: when the first line of response arrived, None if nothing did"""
+        if self._metrics is None:
+            return
+        timed_out = not len(response) or not self._is_final_response(response[-1])
+        first_line = first_line if first_line is not None else end # No line read, all the time was waiting
+        self._metrics.record(self.__conf['devicefile'], command, response, timed_out, start, first_line, end)
+
+    def set_recorder(self, recorder):
+        """Record the traffic on the port in recorder, a recorder.Recorder. None, the
+        default, to stop recording."""
+        self._recorder = recorder
+        self.__framer.recorder = recorder
+
+    def set_latency_profiles(self, profiles):
+        """Learn the latency of each command in profiles, a LatencyProfiles shared
+        among modems, and use it for the command deadlines instead of the default
+        sleeptimes. None to stop learning."""
+        self._latency = profiles
+
+    def _command_deadline(self, command, sleeptime):
+        if self._latency is None:
+            return sleeptime
+        return self._latency.deadline(self, self.__cached_revision(), command, sleeptime)
+
+    def _record_latency(self, command, sleeptime, elapsed, response):
+        if self._latency is None:
+            return
+        if not len(response) or not self._is_final_response(response[-1]):
+            elapsed = sleeptime * 2 # Timed out, the deadline must grow
+        self._latency.record(self, self.__cached_revision(), command, elapsed)
+
+    def __cached_revision(self):
+        cached = self._cache.get('get_revision')
+        return cached[1][2] if cached is not None else None
+
+    def __write(self, command):
+        # Straight to the fd, pyserial opens it non blocking
+        data = self._command_data(command).encode('ascii')
+        if self._recorder is not None:
+            self._recorder.record(TX, data)
+        write_all(self.__ser.fileno(), data)
+
+    def __drain(self):
+        """Discard the lines left by previous commands, dispatching the URCs among them.
+        After a timeout, wait for its final result code first, up to the _late deadline"""
+        fd = self.__ser.fileno()
+        while True:
+            if self.__read_out_of_command(fd):
+                continue # There may be more
+            now = time.time()
+            if self._late is None or now >= self._late:
+                self._late = None
+                return
+            wait_readable(fd, self._late - now)
+
+    def __read_out_of_command(self, fd):
+        """Read what the port has, dispatching the URCs and discarding the rest. Called
+        with the lock held. Returns the number of bytes read"""
+        received = self.__framer.read(fd)
+        for msg in self.__framer.lines():
+            if self._urc.is_unsolicited(msg):
+                self._urc.dispatch(msg)
+                continue
+            self._logger.debug('Discarded line out of any command: ' + msg)
+            if self._is_final_response(msg):
+                self._late = None
+        return received
+
+    def _dispatch_urcs(self):
+        """Dispatch the URCs received so far, without waiting for more. They are read as
+        they arrive already with the reader thread running, and by the running command if any"""
+        if not self._lock.acquire(False):
+            return
+        try:
+            if self.__reader is None and self.__ser is not None and self.__ser.isOpen():
+                while self.__read_out_of_command(self.__ser.fileno()):
+                    pass
+        except (serial.SerialException, OSError) as e: # Left for the next command to fail
+            self._logger.debug('URCs not read: ' + repr(e))
+        finally:
+            self._lock.release()
+
+    def __read_response(self, command, deadline, until_urc=False):
+        """Response lines and when the first one arrived, None if none did"""
+        ret, first_line = [], None
+        fd = self.__ser.fileno()
+        while True:
+            received = self.__framer.read(fd)
+            for msg in self.__framer.lines():
+                if self._urc.is_unsolicited(msg, command):
+                    self._urc.dispatch(msg)
+                    if until_urc:
+                        return ret, first_line
+                elif command is None: # Waiting for URCs, no command is running
+                    self._logger.debug('Discarded line out of any command: ' + msg)
+                    if self._is_final_response(msg):
+                        self._late = None # The late answer of a command which timed out
+                else:
+                    if not ret:
+                        first_line = time.time()
+                    ret.append(msg)
+                    if self._is_final_response(msg):
+                        return ret, first_line # Anything after it is kept for the next command
+
+            now = time.time()
+            if now >= deadline:
+                # No final result code in time, return whatever was received
+                msg = self.__framer.pop_partial()
+                if msg != "":
+                    ret.append(msg)
+                return ret, first_line
+
+            if not received:
+                wait_readable(fd, deadline - now)
+
+    # Reader thread mode. The response lines are routed here by the reader thread
+    def __drain_reader(self):
+        """__drain counterpart. The late lines of a command which timed out are routed
+        here, as if they were of a command without name, while waiting for them"""
+        while not self.__responses.empty(): # Late lines of a previous command
+            self.__responses.get_nowait()
+        if self._late is None:
+            return
+
+        self.__pending = 'AT'
+        try:
+            while True:
+                try:
+                    msg = self.__responses.get(timeout=max(self._late - time.time(), 0))
+                except queue.Empty:
+                    break
+                self._logger.debug('Discarded late line: ' + msg)
+                if self._is_final_response(msg):
+                    break
+        finally:
+            self.__pending, self._late = None, None
+
+    def __send_command_reader(self, command, sleeptime):
+        self.__pending = command
+        self.__write(command)
+        deadline = time.time() + sleeptime
+
+        ret, first_line = [], None
+        try:
+            while True:
+                try:
+                    msg = self.__responses.get(timeout=max(deadline - time.time(), 0))
+                except queue.Empty: # No final result code in time, return whatever was received
+                    return ret, first_line
+
+                if not ret:
+                    first_line = time.time()
                 ret.append(msg)
-
-        return ret
+                if self._is_final_response(msg):
+                    return ret, first_line
+        finally:
+            self.__pending = None
+
+    # Max seconds the port is read for URCs at once without the reader thread, as
+    # other threads can't send commands meanwhile
+    URC_WAIT_SLICE = 0.1
+
+    def _wait_urc(self, timeout):
+        """Wait up to timeout seconds until an URC is received"""
+        if self.__ser is None:
+            self.connect()
+
+        self.__urc_event.clear()
+        if self.__reader is not None:
+            self.__urc_event.wait(timeout)
+            return
+
+        deadline = time.time() + timeout
+        while True: # No command is waiting for an answer meanwhile, lines other than URCs are discarded
+            with self._lock:
+                self.__read_response(None, min(deadline, time.time() + self.URC_WAIT_SLICE), until_urc=True)
+            if self.__urc_event.is_set() or time.time() >= deadline: # Or read by the command of another thread
+                return
+
+    # Seconds the reader thread waits on the port before checking whether it must stop
+    READER_TIMEOUT = 0.5
+
+    def start_reader(self):
+        """Start a thread which reads the port continuously. Command responses are
+        routed to the waiting command and URCs are delivered to subscribers as soon
+        as they arrive, instead of on the next command."""
+        if self.__reader is not None:
+            return
+        if self.__ser is None:
+            self.connect()
+
+        self.__responses = queue.Queue()
+        self.__reader = threading.Thread(target=self.__read_loop, args=(self.__ser,))
+        self.__reader.daemon = True
+        self.__reader.start()
+
+    def reader_running(self):
+        return self.__reader is not None
+
+    def stop_reader(self):
+        reader, self.__reader = self.__reader, None
+        if reader is not None and reader is not threading.current_thread():
+            reader.join()
+
+    def __read_loop(self, ser):
+        while self.__reader is threading.current_thread():
+            try:
+                fd = ser.fileno()
+                if wait_readable(fd, self.READER_TIMEOUT) and self.__framer.read(fd) == 0:
+                    raise serial.SerialException('Port readable with no data, disconnected?')
+            except (serial.SerialException, OSError, TypeError, ValueError) as e: # Or closed under our feet
+                self._logger.error('Reader thread stopped: ' + repr(e))
+                self.__reader = None
+                return
+
+            for msg in self.__framer.lines():
+                command = self.__pending
+                if self._urc.is_unsolicited(msg, command):
+                    self._urc.dispatch(msg)
+                elif command is not None:
+                    self.__responses.put(msg)
+                else:
+                    self._logger.debug('Discarded line out of any command: ' + msg)
+                    if self._is_final_response(msg):
+                        self._late = None # The late answer of a command which timed out
+
+    def subscribe_urc(self, prefix, callback=None, maxsize=100):
+        """Receive the unsolicited result codes starting with prefix, i.e. '^RSSI:'.
+        '' receives all of them. URCs are delivered as they arrive with the reader
+        thread running, otherwise while reading the response of the next command.
+        - callback: called with the URC line. Must not block.
+        - maxsize: if no callback is given, URCs are put in a queue of this size
+        Returns the callback or the queue, needed to unsubscribe."""
+        return self._urc.subscribe(prefix, callback, maxsize)
+
+    def unsubscribe_urc(self, prefix, subscriber):
+        self._urc.unsubscribe(prefix, subscriber)
+
+    def _run_operation(self, operation):
+        """Blocking driver for at_operation methods. Commands of several threads
+        never interleave, but they can run between the commands of this one."""
+        step = next(operation)
+        while len(step) != 3: # Anything but the (status, command, response) result is a command
+            if step[0] is None:
+                step = operation.send(self._wait_urc(step[1]))
+                continue
+            with self._lock:
+                while True:
+                    response = self._send_command(*step)
+                    step = operation.send(response)
+                    # After a prompt the modem waits for the message, nothing else can be sent meanwhile
+                    if len(step) == 3 or step[0] is None or response[-1:] != [self.PROMPT]:
+                        break
+        operation.close()
+        return step
 
     # As per 3GPP TS 27.007 v15.4.0 AT command set for User Equipment
     # As recommended with default value "on" (TA echoes commands back)
+    @at_operation
     def set_echo(self, on=True, sleeptime=10):
         """Turn echo mode ON or OFF
         - on: True (activate) / False (deactivate) echo"""
@@ -80,191 +512,815 @@ class GSMModem(object):
         elif not on:
             command = 'ATE0'
         
-        response = self._send_command(command, sleeptime) 
+        response = yield command, sleeptime 
 
         if len(response) and response[0] == 'OK':
-            return True, command, None
+            yield True, command, None
             
         else:
-            return False, command, response
+            yield False, command, response
     
-    def at_command_wrapper(command, sleeptime):
-        """"Decorator used to generate basic AT commands with a standard response size"""
+    def at_command_wrapper(command, sleeptime, cached=False, pattern=None):
+        """"Decorator used to generate basic AT commands with a standard response size
+        - cached: True to keep the result in the modem cache, see cached_operation
+        - pattern: regular expression the response must match, i.e. the digits of
+          the IMEI, so the answer of another command is never taken for it"""
+        regex = re.compile(pattern) if pattern is not None else None
         def tags_decorator(function):
             def func_wrapper(self, *args):
-                response = self._send_command(command, sleeptime)
+                response = yield command, sleeptime
 
-                if len(response) == 2 and response[1] == 'OK':
-                    return True, command, response[0]
+                if len(response) == 2 and response[1] == 'OK' and (regex is None or regex.match(response[0])):
+                    yield True, command, response[0]
                 else:
-                    return False, command, response
-            return func_wrapper
+                    yield False, command, response
+            func_wrapper.__name__ = function.__name__
+            if cached:
+                func_wrapper = cached_operation(func_wrapper)
+            return at_operation(func_wrapper)
         return tags_decorator
 
-    @at_command_wrapper(command='AT+GMI', sleeptime=1)
+    @at_command_wrapper(command='AT+GMI', sleeptime=1, cached=True)
     def get_manufacturer():
         pass
 
-    @at_command_wrapper(command='AT+GMM', sleeptime=1)
+    @at_command_wrapper(command='AT+GMM', sleeptime=1, cached=True)
     def get_model():
         pass
 
-    @at_command_wrapper(command='AT+GMR', sleeptime=1)
+    @at_command_wrapper(command='AT+GMR', sleeptime=1, cached=True)
     def get_revision():
         pass
 
-    @at_command_wrapper(command='AT+GSN', sleeptime=1)
+    # 15 digit IMEI, or 16 digit IMEISV, and up to 15 digit IMSI, as per 3GPP TS 23.003
+    @at_command_wrapper(command='AT+GSN', sleeptime=1, cached=True, pattern=r'\d{15,16}$')
     def get_serial_number():
         pass
 
-    @at_command_wrapper(command='AT+GSN', sleeptime=1)
+    @at_command_wrapper(command='AT+GSN', sleeptime=1, cached=True, pattern=r'\d{15,16}$')
     def get_imei():
         pass
 
-    @at_command_wrapper(command='AT+CIMI', sleeptime=1)
+    @at_command_wrapper(command='AT+CIMI', sleeptime=1, cached=True, pattern=r'\d{6,15}$')
     def get_imsi():
         pass
 
+    # Seconds the results of cached methods are valid. 0 disables the cache
+    CACHE_TTL = 3600
+
+    # Cached methods identifying the SIM card, a different result means it was swapped
+    SIM_IDENTITY = ('get_imsi', 'get_iccid')
+
+    # URCs reporting the SIM card was removed or inserted, i.e. +CPIN: NOT READY
+    SIM_URC_PREFIXES = ('+CPIN:',)
+
+    def invalidate_cache(self):
+        """Forget the results of cached methods, like IMEI or IMSI"""
+        self._cache.clear()
+
+    # Whether the modem accepts several extended commands in a single command line
+    BATCH_COMMANDS = True
+
+    @at_operation
+    def batch(self, *calls):
+        """Run several AT methods concatenating their commands in a single command
+        line, i.e. AT+GMI;+GMM;+CIMI. Each method gets its part of the response, so
+        the results are the same than calling them one by one. If the modem rejects
+        the command line, or the response can't be split, they are run one by one.
+        - calls: at_operation methods, or (method, arg, ...) tuples
+        The response is the list of results, and command the concatenated command
+        line, or the list of commands when they were run one by one."""
+        operations = []
+        for call in calls:
+            function, args = (call[0], call[1:]) if isinstance(call, tuple) else (call, ())
+            operations.append(function.operation(self, *args))
+
+        steps = [next(operation) for operation in operations]
+        # Only extended commands can be concatenated
+        batched = [i for i, step in enumerate(steps) if len(step) == 2 and step[0] and step[0][:3] in ('AT+', 'AT^')]
+
+        command = None
+        if self.BATCH_COMMANDS and len(batched) > 1:
+            command = 'AT' + ';'.join(steps[i][0][2:] for i in batched)
+            response = yield command, sum(steps[i][1] for i in batched)
+
+            responses = self._split_batch_response([steps[i][0] for i in batched], response)
+            if responses is not None:
+                for i, batch_response in zip(batched, responses):
+                    steps[i] = operations[i].send(batch_response)
+            else:
+                self._logger.debug('Batch failed, running commands one by one: ' + str(response))
+                command = None
+
+        commands, results = [], []
+        for operation, step in zip(operations, steps):
+            while len(step) != 3: # Whatever is left runs one by one
+                commands.append(step[0])
+                step = operation.send((yield step))
+            operation.close()
+            results.append(step)
+
+        yield all(result[0] for result in results), command or commands, results
+
+    def _split_batch_response(self, commands, response):
+        """Split the response of a concatenated command line in the response of each
+        command, with its own OK. None if it can't be done unambiguously."""
+        if not len(response) or response[-1] != 'OK':
+            return None
+
+        # Information lines are prefixed with the command name, i.e. +CSQ: 17,99,
+        # except for some commands like AT+CIMI which answer a bare line
+        names = [command[2:].split('=')[0].split('?')[0] + ':' for command in commands]
+        responses, bare = [[] for _ in commands], []
+        for line in response[:-1]:
+            for i, name in enumerate(names):
+                if line.startswith(name):
+                    responses[i].append(line)
+                    break
+            else:
+                bare.append(line)
+
+        # Set commands don't answer information lines, the rest answers a bare line if no prefixed one
+        expecting = [i for i, command in enumerate(commands)
+                     if not responses[i] and ('=' not in command or command.endswith('=?'))]
+        if len(bare) != len(expecting):
+            return None
+
+        for i, line in zip(expecting, bare):
+            responses[i].append(line)
+        return [lines + ['OK'] for lines in responses]
+
+    # Result keys and methods of get_identity
+    IDENTITY = (('manufacturer', 'get_manufacturer'), ('model', 'get_model'), ('revision', 'get_revision'),
+                ('imei', 'get_imei'), ('imsi', 'get_imsi'))
+
+    @at_operation
+    def get_identity(self):
+        """Manufacturer, model, revision, IMEI and IMSI in a single command line.
+        The response is a dictionary, with None for the failed ones."""
+        operation = self.batch.operation(self, *[getattr(self, method) for key, method in self.IDENTITY])
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        status, command, results = step
+
+        identity = dict((key, result[2] if result[0] else None) for (key, method), result in zip(self.IDENTITY, results))
+        yield status, command, identity
+
+    @at_operation
     def set_operator(self, plmn, sleeptime=2):
         command = 'AT+COPS=1,2,"' + plmn + '"'
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
         if len(response) and response[0] == 'OK': 
-            return True, command, None
+            yield True, command, None
         elif response is None or response == []:
-            return True, command, None
+            yield True, command, None
         else:
             self._logger.error('Set operator failed with: ' + str(response))
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def get_operator(self, sleeptime=2):
         command = 'AT+COPS?'
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
         # This case mode, format, oper and optionally AcT is returned.
         if len(response) == 2:
-            # Split response in chunks: mode, [format, oper, [AcT]]
-            resp_split = response[0].split(':')[1].split(',') 
-            if len(resp_split) >= 3: # Theres an oper in the response.
-                oper = resp_split[2].replace('"', '')
-                return True, command, oper
+            cops = parse_cops(response[0])
+            if cops is not None and cops.oper is not None: # Theres an oper in the response.
+                yield True, command, cops.oper
             else: # Most likely to be ['+COPS: 1', 'OK'], no operator selected
                 self._logger.error('No operator selected: ' + str(response))
-                return False, command, response
+                yield False, command, response
         # CME Error !!
         else:
             self._logger.error('Get operator failed with: ' + str(response))
-            return False, command, response
-
+            yield False, command, response
+
+    # Seconds the networks found by scan_networks are valid, in the same cell
+    SCAN_TTL = 600
+
+    # Access technologies of the AT+COPS=? networks, as per 3GPP TS 27.007 <AcT>
+    COPS_ACT_GSM, COPS_ACT_UTRAN, COPS_ACT_EUTRAN = ('0', '1', '3'), ('2', '4', '5', '6'), ('7',)
+
+    # <AcT> of the networks usable with each ACT_* of the modem class. Others, like ACT_AUTO, use any
+    COPS_ACTS = {}
+
+    @at_operation
+    def scan_networks(self, sleeptime=180, max_age=None):
+        """Networks visible, as a list of dictionaries with stat (1 available, 2 current,
+        3 forbidden), long_name, short_name, plmn and act if the modem reports it.
+        Scans take minutes, so results are cached per cell, the LAC and CID of
+        get_registration_info, for max_age seconds, SCAN_TTL by default. They are
+        not cached when the modem is not registered."""
+        max_age = self.SCAN_TTL if max_age is None else max_age
+        operation = self.get_registration_info.operation(self)
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        status, command, reg = step
+        location = (reg.get('lac'), reg.get('cid')) if status and reg.get('lac') else None
+
+        cached = self._scans.get(location)
+        if cached is not None and time.time() - cached[0] < max_age:
+            yield cached[1]
+            return
+
+        command = 'AT+COPS=?'
+        response = yield command, sleeptime
+
+        networks = parse_cops_list(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if networks is not None:
+            result = True, command, [as_dict(network) for network in networks]
+            if location is not None:
+                self._scans[location] = (time.time(), result)
+            yield result
+        else:
+            self._logger.error('Network scan failed with: ' + str(response))
+            yield False, command, response
+
+    def network_available(self, networks, plmn, act=None):
+        """Whether plmn is in networks, as returned by scan_networks, as available or
+        current. On the access technology act, one of ACT_*, if given"""
+        acts = self.COPS_ACTS.get(act)
+        for network in networks:
+            if network['plmn'] == plmn and network['stat'] in ('1', '2'):
+                if acts is None or network.get('act') is None or network['act'] in acts:
+                    return True
+        return False
+
+    @at_operation
     def register(self, lac=2, sleeptime=2):
         command = 'AT+CREG=' + str(lac) # 1 = enable | 2 = enable with lac/cellid info
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
         if len(response) and response[0] == 'OK':
-            return True, command, response[0]
+            yield True, command, response[0]
         if response is None or response is []:
             # It seems that if already registered
             # nothing will show but it is already
             # authenticated
-            return True, command, response
+            yield True, command, response
         else:
             self._logger.error('Registration failed with: ' + str(response))
-            return False, command, response
+            yield False, command, response
+
+    @at_operation
+    def get_registration_mode(self, sleeptime=2):
+        """The <n> set with register(), as a string. Always read from AT+CREG?, which
+        some modem classes don't use for get_registration_info"""
+        command = 'AT+CREG?'
+        response = yield command, sleeptime
+
+        reg = parse_creg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if reg is not None:
+            yield True, command, reg.n
+        else:
+            yield False, command, response
 
     # First attach to PS domain. Let's give it 10 secs at least.
+    @at_operation
     def activate_pdp_context(self, sleeptime=10):
         command_pdp_attachment = 'AT+CGATT=1'
         command_pdp_activate = 'AT+CGACT=1,1'
 
-        response = self._send_command(command_pdp_attachment, sleeptime/2)
+        response = yield command_pdp_attachment, sleeptime/2
 
         if len(response) and response[0] == 'OK':
-            response = self._send_command(command_pdp_activate, sleeptime/2)
+            response = yield command_pdp_activate, sleeptime/2
             if len(response) and response[0] == 'OK':
-                return True, command_pdp_activate, None
+                yield True, command_pdp_activate, None
             else:
-                return False, command_pdp_activate, response
+                yield False, command_pdp_activate, response
         else:
-            return False, command_pdp_attachment, response
+            yield False, command_pdp_attachment, response
 
+    @at_operation
     def deactivate_pdp_context(self, sleeptime=2):
         command = 'AT+CGATT=0'
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
         if len(response) and response[0] == 'OK':
-            return True, command, None
+            yield True, command, None
         else:
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def get_pdp_context(self, sleeptime=2):
         command = 'AT+CGATT?'
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
         if len(response) == 2 and response[-1] == 'OK':
-            response = {"pdp_attached" : (response[0].split(" ")[-1] == 1)}
-            return True, command, response
+            response = {"pdp_attached" : (response[0].split(" ")[-1] == '1')}
+            yield True, command, response
         else:
-            return False, command, response
+            yield False, command, response
+
+    # +CREG URCs are sent with register(), +CGEV ones with AT+CGEREP=1
+    REGISTRATION_URC_PREFIXES = ('+CREG:', '+CGREG:', '+CEREG:')
+    PDP_URC_PREFIXES = ('+CGEV:',)
 
+    @at_operation
+    def get_registration_info(self):
+        command = 'AT+CREG?'
+        response = yield command, 2
+
+        reg = parse_creg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if reg is not None:
+            yield True, command, as_dict(reg)
+        else:
+            self._logger.error('Get registration info failed with: ' + str(response))
+            yield False, command, response
+
+    @at_operation
+    def wait_for_registration(self, states=None, timeout=60, poll_interval=0.5, max_poll_interval=8):
+        """Wait until the registration status is one of states. Returns as soon as a
+        +CREG/+CGREG/+CEREG URC reports it. Meanwhile get_registration_info is polled,
+        doubling the interval every time up to max_poll_interval.
+        - states: registration status to wait for. Home or roaming by default
+        - timeout: seconds to give up
+        The response is the registration info, and command the URC line if it came from one."""
+        states = states or (self.STAT_REGHOME, self.STAT_REGROAM)
+        urcs = []
+        subscriber = self._urc.subscribe('', urcs.append)
+        deadline = time.time() + timeout
+
+        try:
+            while True:
+                operation = self.get_registration_info.operation(self)
+                step = next(operation)
+                while len(step) != 3:
+                    step = operation.send((yield step))
+                status, command, reg = step
+
+                if status and reg.get('stat') in states:
+                    yield True, command, reg
+
+                next_poll = min(time.time() + poll_interval, deadline)
+                while time.time() < next_poll:
+                    yield None, next_poll - time.time()
+
+                    while urcs:
+                        line = urcs.pop(0)
+                        if line.startswith(self.REGISTRATION_URC_PREFIXES):
+                            urc_reg = parse_creg(line, solicited=False)
+                            if urc_reg is not None and urc_reg.stat in states:
+                                yield True, line, as_dict(urc_reg)
+
+                if time.time() >= deadline:
+                    self._logger.error('Registration timed out with: ' + str(reg))
+                    yield False, command, reg
+
+                poll_interval = min(poll_interval * 2, max_poll_interval)
+        finally:
+            self._urc.unsubscribe('', subscriber)
+
+    @at_operation
+    def wait_for_pdp_attach(self, timeout=60, poll_interval=0.5, max_poll_interval=8):
+        """Wait until the modem is attached to the PS domain. Returns as soon as a +CGEV
+        URC reports a PDP context activation. Meanwhile get_pdp_context is polled,
+        doubling the interval every time up to max_poll_interval.
+        - timeout: seconds to give up"""
+        urcs = []
+        subscriber = self._urc.subscribe('', urcs.append)
+        deadline = time.time() + timeout
+
+        try:
+            while True:
+                operation = self.get_pdp_context.operation(self)
+                step = next(operation)
+                while len(step) != 3:
+                    step = operation.send((yield step))
+                status, command, response = step
+
+                if status and response['pdp_attached']:
+                    yield True, command, response
+
+                next_poll = min(time.time() + poll_interval, deadline)
+                while time.time() < next_poll:
+                    yield None, next_poll - time.time()
+
+                    while urcs:
+                        line = urcs.pop(0)
+                        # i.e. +CGEV: NW ACT 1,1 or +CGEV: ME PDN ACT 1, but not DEACT
+                        if line.startswith(self.PDP_URC_PREFIXES) and ' ACT ' in line + ' ':
+                            yield True, line, {'pdp_attached': True}
+
+                if time.time() >= deadline:
+                    self._logger.error('PDP attach timed out with: ' + str(response))
+                    yield False, command, response
+
+                poll_interval = min(poll_interval * 2, max_poll_interval)
+        finally:
+            self._urc.unsubscribe('', subscriber)
+
+    @at_operation
     def get_signal_quality(self, sleeptime=2):
         """Returns Signal Quality as RSSI,BER string. Use GSMModem.sq_to_rssi to convert to RSSI dBm"""
 
         command = 'AT+CSQ'
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
-        if len(response) >= 2 and response[1] == 'OK':
-            sq = response[0].split(':')[1].replace(' ','')
-            return True, command, sq
+        csq = parse_csq(response[0]) if len(response) >= 2 and response[1] == 'OK' else None
+        if csq is not None:
+            yield True, command, csq.rssi + ',' + csq.ber
         else:
-            return False, command, response
+            yield False, command, response
 
     def sq_to_rssidBm(self, sq):
         sq = int(sq) # Just in case it is not a integer
         return self.RSSI_DBM[sq]
 
+    @at_operation
     def get_apn(self):
         command = 'AT+CGDCONT?'
-        response = self._send_command(command, sleeptime=1)
+        response = yield command, 1
 
         # Sometimes modem send trash characters before the OK
         # but if OK is the last line then everything went well
         # this might be caused by the noise in serial connection
         if len(response) > 0 and response[-1] == 'OK': 
-            return True, command, response[:-1]
+            yield True, command, response[:-1]
         else:
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def set_apn(self, context_number, apn_name, sleeptime=2):
         assert isinstance(context_number, int), "PDP context # must be int"
         command = 'AT+CGDCONT=' + str(context_number) + ',"IP","' + apn_name + '",""'
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
         if len(response) == 1 and response[0] == 'OK':
-            return True, command, response[0]
+            yield True, command, response[0]
         else:
-            return False, command, response
+            yield False, command, response
+
+    # Parameters of apply_config, in the order they are set. A new access technology
+    # may drop the registration, so it goes before the operator selection, and the
+    # APN is defined before registering, as the PS attach uses it.
+    CONFIG_KEYS = ('act', 'apn', 'operator', 'creg')
+
+    @at_operation
+    def apply_config(self, desired):
+        """Set only the parameters of desired which differ from the current ones, so it
+        is cheap to call on every boot or reconnection. They are read in a single
+        command line, and set in CONFIG_KEYS order.
+        - desired: dictionary with any of
+            act: access technology, one of the ACT_* of the modem class
+            apn: APN of PDP context 1, or a (context number, APN) tuple
+            operator: PLMN to select, i.e. '21401'
+            creg: registration URC mode, as the lac argument of register()
+        The response is {'changed': {key: (current, desired)}, 'unchanged': [key, ...],
+        'failed': {key: result of the failed method}}, and command the list of set commands sent."""
+        unknown = [key for key in desired if key not in self.CONFIG_KEYS]
+        assert not unknown, "Unknown config keys: " + str(unknown)
+        keys = [key for key in self.CONFIG_KEYS if key in desired]
+        report = {'changed': {}, 'unchanged': [], 'failed': {}}
+
+        if 'act' in keys and not hasattr(self, 'set_access_technology'):
+            report['failed']['act'] = (False, None, 'Access technology not supported by ' + self.__class__.__name__)
+            keys.remove('act')
+
+        getters = {'act': self.get_access_technology if 'act' in keys else None, 'apn': self.get_apn,
+                   'operator': self._get_operator_selection, 'creg': self.get_registration_mode}
+        operation = self.batch.operation(self, *[getters[key] for key in keys])
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        current = dict((key, self.__current_config(key, desired[key], result)) for key, result in zip(keys, step[2]))
+
+        commands = []
+        for key in keys:
+            if current[key] == self.__desired_config(key, desired[key]):
+                report['unchanged'].append(key)
+                continue
+
+            if key == 'act':
+                operation = self.set_access_technology.operation(self, desired[key])
+            elif key == 'apn':
+                context_number, apn_name = desired[key] if isinstance(desired[key], tuple) else (1, desired[key])
+                operation = self.set_apn.operation(self, context_number, apn_name)
+            elif key == 'operator':
+                operation = self.set_operator.operation(self, desired[key])
+            else:
+                operation = self.register.operation(self, desired[key])
+            step = next(operation)
+            while len(step) != 3:
+                commands.append(step[0])
+                step = operation.send((yield step))
+            operation.close()
+
+            if step[0]:
+                report['changed'][key] = (current[key], self.__desired_config(key, desired[key]))
+            else:
+                self._logger.error('Apply config failed on ' + key + ' with: ' + str(step[2]))
+                report['failed'][key] = step
+
+        yield not report['failed'], commands, report
+
+    @at_operation
+    def _get_operator_selection(self):
+        """AT+COPS? as get_operator sends it, but its response is the parsers.Cops, as
+        apply_config tells the operator format and selection mode apart"""
+        command, sleeptime = next(self.get_operator.operation(self))
+        response = yield command, sleeptime
+
+        cops = parse_cops(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if cops is not None:
+            yield True, command, cops
+        else:
+            yield False, command, response
+
+    def __desired_config(self, key, value):
+        if key == 'apn':
+            return value[1] if isinstance(value, tuple) else value
+        return str(value) if key in ('act', 'creg') else value
+
+    def __current_config(self, key, value, result):
+        """Comparable value of key out of the result of its get method. None if unknown"""
+        status, command, response = result
+        if not status:
+            return None
+        if key == 'apn':
+            context_number = value[0] if isinstance(value, tuple) else 1
+            for line in response:
+                context = parse_cgdcont(line)
+                if context is not None and int(context.cid) == context_number:
+                    return context.apn
+            return None
+        if key == 'operator':
+            # Only a manual selection by numeric PLMN is the desired one. In automatic mode
+            # the modem may register elsewhere, and names can't be compared with PLMNs.
+            return response.oper if response.mode == '1' and response.format == '2' else None
+        # Compared as strings, like the desired ones
+        if key == 'act':
+            return str(response['acqorder'])
+        return str(response) if key == 'creg' else response
+
+    # Message status, as per 3GPP TS 27.005 <stat> in PDU mode
+    SMS_UNREAD, SMS_READ, SMS_UNSENT, SMS_SENT, SMS_ALL = 0, 1, 2, 3, 4
+
+    # New message indications of AT+CNMI: buffered while the port is busy, +CMTI for the stored ones
+    CNMI = '2,1,0,0,0'
+
+    SMS_DELETE_BATCH = 10 # AT+CMGD per command line, as its length is limited
+    SMS_SEND_TIMEOUT = 60 # Seconds for the network to acknowledge each part
+
+    @at_operation
+    @cached_operation
+    def set_sms_pdu_mode(self):
+        """AT+CMGF=0. Cached, as the mode lasts until a reset, so every SMS method sends it first at no cost"""
+        command = 'AT+CMGF=0'
+        response = yield command, 2
+
+        if len(response) and response[-1] == 'OK':
+            yield True, command, None
+        else:
+            self._logger.error('PDU mode failed with: ' + str(response))
+            yield False, command, response
+
+    @at_operation
+    def enable_sms_notifications(self, sleeptime=2):
+        """Have new messages notified with +CMTI URCs, which receive_sms waits for"""
+        command = 'AT+CNMI=' + self.CNMI
+        response = yield command, sleeptime
 
+        if len(response) and response[-1] == 'OK':
+            yield True, command, None
+        else:
+            yield False, command, response
+
+    @at_operation
+    def list_sms(self, stat=4, reassemble=True, sleeptime=30):
+        """Messages with status stat, all of them by default, listed with a single AT+CMGL.
+        The response is a generator of sms.Sms, decoding them as it is iterated. With
+        reassemble, concatenated messages come whole once all their parts are listed,
+        with the tuple of their indexes as index. Unread ones are marked as read."""
+        operation = self.set_sms_pdu_mode.operation(self)
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        if not step[0]:
+            yield step
+
+        command = 'AT+CMGL=' + str(stat)
+        response = yield command, sleeptime
+
+        if len(response) and response[-1] == 'OK':
+            yield True, command, iter_messages(response[:-1], reassemble)
+        else:
+            self._logger.error('List SMS failed with: ' + str(response))
+            yield False, command, response
+
+    @at_operation
+    def read_sms(self, index, sleeptime=5):
+        """Message at index, as an sms.Sms. Marked as read if it was unread"""
+        operation = self.set_sms_pdu_mode.operation(self)
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        if not step[0]:
+            yield step
+
+        command = 'AT+CMGR=' + str(index)
+        response = yield command, sleeptime
+
+        header = parse_cmgr(response[0]) if len(response) == 3 and response[-1] == 'OK' else None
+        if header is not None:
+            try:
+                yield True, command, decode_pdu(response[1], int(index), int(header.stat))
+            except ValueError as e:
+                self._logger.error('Read SMS failed: ' + str(e))
+                yield False, command, response
+        else:
+            self._logger.error('Read SMS failed with: ' + str(response))
+            yield False, command, response
+
+    @at_operation
+    def delete_sms(self, indexes, sleeptime=5):
+        """Delete the messages at indexes, SMS_DELETE_BATCH of them per command line,
+        i.e. AT+CMGD=1;+CMGD=2. Reassembled messages, with a tuple index, are deleted
+        all their parts. command is the list of command lines sent, and the response
+        the indexes which may not have been deleted on failure."""
+        flat = []
+        for index in indexes:
+            flat.extend(index if isinstance(index, tuple) else (index,))
+        size = self.SMS_DELETE_BATCH if self.BATCH_COMMANDS else 1
+
+        commands = []
+        for start in range(0, len(flat), size):
+            command = 'AT' + ';'.join('+CMGD=' + str(index) for index in flat[start:start + size])
+            commands.append(command)
+            response = yield command, sleeptime
+
+            if not len(response) or response[-1] != 'OK':
+                self._logger.error('Delete SMS failed with: ' + str(response))
+                yield False, commands, flat[start:]
+        yield True, commands, None
+
+    @at_operation
+    def delete_all_sms(self, flag=4, sleeptime=10):
+        """Delete the messages in bulk, as per AT+CMGD <delflag>: 1 the read ones, 2 the read
+        and sent ones, 3 the read, sent and unsent ones, 4 all of them"""
+        command = 'AT+CMGD=1,' + str(flag)
+        response = yield command, sleeptime
+
+        if len(response) and response[-1] == 'OK':
+            yield True, command, None
+        else:
+            self._logger.error('Delete SMS failed with: ' + str(response))
+            yield False, command, response
+
+    @at_operation
+    def send_sms(self, number, text, status_report=False, sleeptime=None):
+        """Send text to number, in as many concatenated parts as needed, GSM 7 bit encoded
+        or UCS2 if it does not fit. The response is the list of message references of
+        the parts, as per +CMGS.
+        - sleeptime: deadline for the network acknowledge of each part, SMS_SEND_TIMEOUT by default"""
+        operation = self.send_sms_batch.operation(self, [(number, text)], status_report, sleeptime)
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        status, commands, results = step
+        yield results[0] if results else step
+
+    @at_operation
+    def send_sms_batch(self, messages, status_report=False, sleeptime=None):
+        """Send several (number, text) messages back to back. The link to the SMSC is
+        kept open among them with AT+CMMS=1, and every part is entered as soon as the
+        modem prompts for it, so each one only waits for the network acknowledge of
+        the previous one. A failed message does not stop the rest.
+        The response is the list of (status, command, message references) of each
+        message, as send_sms returns them, and command the list of commands sent."""
+        sleeptime = sleeptime or self.SMS_SEND_TIMEOUT
+        operation = self.set_sms_pdu_mode.operation(self)
+        step = next(operation)
+        while len(step) != 3:
+            step = operation.send((yield step))
+        if not step[0]:
+            yield False, [step[1]], [step] * len(messages)
+
+        # All encoded beforehand, not to delay the prompts
+        encoded = []
+        for number, text in messages:
+            self._sms_reference = (self._sms_reference + 1) % 256
+            encoded.append(encode_sms(number, text, reference=self._sms_reference, status_report=status_report))
+
+        commands, results = [], []
+        more = sum(len(pdus) for pdus in encoded) > 1
+        if more: # Not supported by every modem, it is just slower without it
+            commands.append('AT+CMMS=1')
+            yield 'AT+CMMS=1', 2
+
+        for pdus in encoded:
+            references, result = [], None
+            for length, pdu in pdus:
+                command = 'AT+CMGS=' + str(length)
+                commands.append(command)
+                response = yield command, 5
+                if not len(response) or response[-1] != self.PROMPT:
+                    if not len(response): # The prompt may still come, or was missed
+                        yield self.ESC, 1
+                    result = (False, command, response)
+                    break
+
+                response = yield pdu + self.CTRL_Z, sleeptime
+                reference = parse_cmgs(response[0]) if len(response) == 2 and response[-1] == 'OK' else None
+                if reference is None:
+                    result = (False, command, response)
+                    break
+                references.append(reference)
+
+            if result is not None:
+                self._logger.error('Send SMS failed with: ' + str(result[2]))
+            results.append(result or (True, command, references))
+
+        if more:
+            commands.append('AT+CMMS=0')
+            yield 'AT+CMMS=0', 2
+        yield all(result[0] for result in results), commands, results
+
+    def __on_new_sms(self, line):
+        cmti = parse_cmti(line)
+        if cmti is not None:
+            self._sms_indexes.append(int(cmti.index))
+
+    @at_operation
+    def receive_sms(self, timeout=60, delete=False):
+        """Next message received, as an sms.Sms. The ones notified with +CMTI URCs are
+        read as they are, see enable_sms_notifications, so the storage is not polled.
+        Concatenated messages are returned whole once all their parts are received.
+        The response is None if none is received in timeout seconds.
+        - delete: delete the messages from the storage once read"""
+        deadline = time.time() + timeout
+        command = None
+        while True:
+            while self._sms_indexes:
+                index = self._sms_indexes.popleft()
+                operation = self.read_sms.operation(self, index)
+                step = next(operation)
+                while len(step) != 3:
+                    step = operation.send((yield step))
+                status, command, sms = step
+                if not status: # i.e. deleted meanwhile
+                    continue
+
+                if delete:
+                    operation = self.delete_sms.operation(self, [index])
+                    step = next(operation)
+                    while len(step) != 3:
+                        step = operation.send((yield step))
+                for part in self._sms_parts.expire():
+                    self._logger.warning('Incomplete message dropped, part ' + str(part.concat) + ' at ' + str(part.index))
+                sms = self._sms_parts.add(sms)
+                if sms is not None:
+                    yield True, command, sms
+
+            if time.time() >= deadline:
+                yield False, command, None
+            yield None, deadline - time.time()
+
+    @at_operation
     def reset_modem_default(self):
+        self.invalidate_cache()
         command = 'ATZ'
-        response = self._send_command(command, sleeptime=1)
+        response = yield command, 1
 
         # Sometimes modem send trash characters before the OK
         # but if OK is the last line then everything went well
         # this might be caused by the noise in serial connection
         if len(response) > 0 and response[-1] == 'OK':
-            return True, command, response
+            yield True, command, response
         else:
-            return False, command, response
+            yield False, command, response
 
     def close_connection(self):
-        self.__ser.close()
+        self.invalidate_cache()
+        with self._lock:
+            self.stop_reader()
+            if self.__ser is not None:
+                self.__ser.close()
 
     def open_connection(self):
-        self.__ser.open()
+        self.invalidate_cache()
+        if self.__ser is None:
+            self.connect()
+        else:
+            self.__ser.open()
 
     def get_serial_conf(self):
         return self.__conf
 
+    def multiplex(self, channels=2):
+        """Switch the modem to 3GPP TS 27.010 multiplexing, if it supports AT+CMUX.
+        Returns the open cmux.Multiplexer, whose modem(dlci) are objects of this same
+        class on each channel. This one is closed, as the port belongs to it now."""
+        self.close_connection()
+        mux = Multiplexer(self.__conf['devicefile'], self.__conf['baudrate'], channels, self.__class__)
+        mux.open()
+        return mux
+
 # Further details HUAWEI_MS2131_AT_Command_Interface_Specification
 class HuaweiModem(GSMModem):
     """Super class for Huawei GSM USB dongles, supporting Huawei extended AT commands and specific definitions."""
@@ -272,76 +1328,94 @@ class HuaweiModem(GSMModem):
     VENDOR_ID = 0x12d1
     VENDOR = 'Huawei'
 
-    STAT_NOTREG, STAT_REGHOME, STAT_SEARCH, STAT_DENIED, STAT_UNK, STAT_REGROAM = '0', '1', '2', '3', '4', '5'
+    IDENTITY = GSMModem.IDENTITY + (('iccid', 'get_iccid'),)
+
+    SIM_URC_PREFIXES = GSMModem.SIM_URC_PREFIXES + ('^SIMST:',)
+
+    # Status reports stored too, and notified with +CDSI
+    CNMI = '2,1,0,2,0'
 
-    def __init__(self, devicefile, baudrate, timeout=25):
-        super(HuaweiModem, self).__init__(devicefile, baudrate, timeout)
+    URC_PREFIXES = GSMModem.URC_PREFIXES + (
+        '^RSSI:', '^HCSQ:', '^MODE:', '^BOOT:', '^SIMST:', '^SRVST:', '^DSFLOWRPT:', '^RSSILVL:', '^HRSSILVL:',
+        '^CSNR:', '^NWTIME:', '^STIN:', '^CEND:', '^CONN:', '^ORIG:', '^CONF:', '^NDISSTAT:', '^SYSSTART')
+
+    def __init__(self, devicefile, baudrate, timeout=25, lazy=False):
+        super(HuaweiModem, self).__init__(devicefile, baudrate, timeout, lazy)
 
     # Surprisingly CGREG returns LAC/CellID. CREG doesn't. Is this Huawei specific behaviour?
+    @at_operation
     def get_registration_info(self):
         command = 'AT+CGREG?'
-        response = self._send_command(command)
+        response = yield command, 2
 
-        if len(response) == 2 and response[1] == 'OK':
-            params = ['n', 'stat', 'lac', 'cid']
-            reg = map(lambda item: item.replace('"', '').strip(), response[0].split(':')[1].split(','))
-            return True, command, dict(zip(params,reg))
+        reg = parse_creg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if reg is not None:
+            yield True, command, as_dict(reg)
         else:
             self._logger.error('Get registration info failed with: ' + str(response))
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def set_operator(self, plmn):
-        return super(HuaweiModem, self).set_operator(plmn, 10) # 10 secs for this specific device worked
+        return super(HuaweiModem, self).set_operator.operation(self, plmn, 10) # 10 secs for this specific device worked
 
+    @at_operation
     def get_operator(self):
-        return super(HuaweiModem, self).get_operator(5) # 5 secs for this specific device worked
+        return super(HuaweiModem, self).get_operator.operation(self, 5) # 5 secs for this specific device worked
 
+    @at_operation
+    @cached_operation
     def get_iccid(self, sleeptime=2):
         command = "AT^ICCID?"
-        response = self._send_command(command, sleeptime)
+        response = yield command, sleeptime
 
-        if len(response) == 2 and response[1] == 'OK':
-            return True, command, response[0].split(': ')[1].split('F')[0]
+        iccid = parse_iccid(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if iccid is not None and 18 <= len(iccid) <= 20: # As per ITU-T E.118, F padding left out
+            yield True, command, iccid
         else:
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def get_access_technology(self):
         command = 'AT^SYSCFGEX?'
-        response = self._send_command(command)
+        response = yield command, 2
 
-        if len(response) == 2 and response[1] == 'OK':
-            acqorder, band, roam, srvdomain, lteband = response[0].split(':')[1].split(',')
-            return True, command, {'acqorder': acqorder.replace('"',''), 'roam': roam}
+        syscfg = parse_syscfg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if syscfg is not None:
+            yield True, command, {'acqorder': syscfg.acqorder, 'roam': syscfg.roam}
         else:
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def set_access_technology(self, act):
         assert act in [self.ACT_AUTO, self.ACT_GSM, self.ACT_UMTS, self.ACT_LTE]
         # ACT / Any Band / Roam enabled / CS+PS used / LTE Any Band
         command = 'AT^SYSCFGEX="' + act + '",3FFFFFFF,1,2,7FFFFFFFFFFFFFFF,,' 
         
         # Lesser waiting time translates to error 
-        response = self._send_command(command, 2)
+        response = yield command, 2
         
         # It can happen that switching bewteen ACT some
         # trash characteres are generated
         if len(response) > 0 and response[-1] == 'OK':
-            return True, command, response
+            yield True, command, response
         else:
-            return False, command, response
+            yield False, command, response
 
     # Huawei specific modem reset, use this one over reset_modem_default
+    @at_operation
     def reset_modem(self):
+        self.invalidate_cache()
         command = 'AT^RESET'
-        response = self._send_command(command, sleeptime=1)
+        response = yield command, 1
 
         # Sometimes modem send trash characters before the OK
         # but if OK is the last line then everything went well
         # this might be caused by the noise in serial connection
         if len(response) > 0 and response[-1] == 'OK':
-            return True, command, response
+            yield True, command, response
         else:
-            return False, command, response
+            yield False, command, response
 
 # Further details HUAWEI_MS2131_AT_Command_Interface_Specification
 class HuaweiMS2131(HuaweiModem):
@@ -351,37 +1425,39 @@ class HuaweiMS2131(HuaweiModem):
 
     MODE_AUTO, MODE_GSM, MODE_WCDMA, MODE_NOTCHANGED = '2', '13', '14', '16'
     ACT_AUTO, ACT_GSM, ACT_UMTS, ACT_NOTCHANGED = '0', '1', '2', '3'
+    COPS_ACTS = {ACT_GSM: GSMModem.COPS_ACT_GSM, ACT_UMTS: GSMModem.COPS_ACT_UTRAN}
     ROAM_NO, ROAM_YES, ROAM_NA = '0', '1', '2'
 
-    def __init__(self, devicefile, baudrate, timeout=25):
-        super(HuaweiMS2131, self).__init__(devicefile, baudrate, timeout)
+    def __init__(self, devicefile, baudrate, timeout=25, lazy=False):
+        super(HuaweiMS2131, self).__init__(devicefile, baudrate, timeout, lazy)
 
+    @at_operation
     def get_registration_info(self):
         command = 'AT+CREG?'
-        response = self._send_command(command)
+        response = yield command, 2
 
-        if len(response) == 2 and response[1] == 'OK':
-            params = ['n', 'stat', 'lac', 'cid']
-            reg = map(lambda item: item.replace('"', '').strip(),
-                      response[0].split(':')[1].split(','))
-            return True, command, dict(zip(params, reg))
+        reg = parse_creg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if reg is not None:
+            yield True, command, as_dict(reg)
         else:
             self._logger.error(
                 'Get registration info failed with: ' + str(response))
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def get_access_technology(self):
         # As per HUAWEI_MS2131_AT_Command_Interface_Specification Section 9.6: Command of Setting System Configurations
         command = 'AT^SYSCFG?'
-        response = self._send_command(command)
+        response = yield command, 2
 
-        if len(response) == 2 and response[1] == 'OK': 
-            mode, acqorder, band, roam, srvdomain = response[0].split(':')[1].split(',')
-            return True, command, {'acqorder': acqorder.replace('"',''), 'roam': roam}
-        else: 
-            return False, command, response
+        syscfg = parse_syscfg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if syscfg is not None:
+            yield True, command, {'acqorder': syscfg.acqorder, 'roam': syscfg.roam}
+        else:
+            yield False, command, response
 
     # Further details Section 9.6: Command of Setting System Configurations
+    @at_operation
     def set_access_technology(self, act):
         assert act in [self.ACT_AUTO, self.ACT_GSM, self.ACT_UMTS]
         if act == self.ACT_GSM: mode = self.MODE_GSM
@@ -389,12 +1465,12 @@ class HuaweiMS2131(HuaweiModem):
         else: mode = self.ACT_NOTCHANGED
 
         command = "AT^SYSCFG=" + mode + ',0' + act + ',3FFFFFFF,1,2' # Mode / ACT / Any Band / Roam enabled / CS+PS used
-        response = self._send_command(command, 1) # TODO: Sleep time of 1 worked for me! Why? Who knows!
+        response = yield command, 1 # TODO: Sleep time of 1 worked for me! Why? Who knows!
 
         if len(response) and response[0] == 'OK':
-            return True, command, None
+            yield True, command, None
         else:
-            return False, command, response
+            yield False, command, response
 
 
 # TODO: Look for HUAWEI_MS2372_AT_Command_Interface_Specification
@@ -404,10 +1480,11 @@ class HuaweiMS2372h(HuaweiModem):
     PRODUCT = 'MS2372h'
 
     ACT_AUTO, ACT_GSM, ACT_UMTS, ACT_LTE, ACT_NOTCHANGED = '00', '01', '02', '03', '99'
+    COPS_ACTS = {ACT_GSM: GSMModem.COPS_ACT_GSM, ACT_UMTS: GSMModem.COPS_ACT_UTRAN, ACT_LTE: GSMModem.COPS_ACT_EUTRAN}
     ROAM_NO, ROAM_YES, ROAM_NA = '0', '1', '2'
 
-    def __init__(self, devicefile, baudrate, timeout=25):
-        super(HuaweiMS2372h, self).__init__(devicefile, baudrate, timeout)
+    def __init__(self, devicefile, baudrate, timeout=25, lazy=False):
+        super(HuaweiMS2372h, self).__init__(devicefile, baudrate, timeout, lazy)
 
     # Depreciated get ACT method. Works better with the one found on the E3372 model. It's now set as a global Huawei method in the global Huawei class.    
     # def get_access_technology(self):
@@ -452,30 +1529,33 @@ class HuaweiE3372(HuaweiModem):
     PRODUCT = 'E3372'
 
     ACT_AUTO, ACT_GSM, ACT_UMTS, ACT_LTE, ACT_NOTCHANGED = '00', '01', '02', '03', '99'
+    COPS_ACTS = {ACT_GSM: GSMModem.COPS_ACT_GSM, ACT_UMTS: GSMModem.COPS_ACT_UTRAN, ACT_LTE: GSMModem.COPS_ACT_EUTRAN}
     ROAM_NO, ROAM_YES, ROAM_NA = '0', '1', '2'
 
-    def __init__(self, devicefile, baudrate, timeout=25):
-        super(HuaweiE3372, self).__init__(devicefile, baudrate, timeout)
+    def __init__(self, devicefile, baudrate, timeout=25, lazy=False):
+        super(HuaweiE3372, self).__init__(devicefile, baudrate, timeout, lazy)
     
+    # URCs never get mixed with responses, but there's no point on
+    # receiving them if nobody subscribes with subscribe_urc
+    @at_operation
     def stop_periodic_messages(self):
         command = 'AT^CURC=0'
-        response = self._send_command(command)
+        response = yield command, 2
 
         if len(response) >= 1 and response[-1] == 'OK':
-            return True, command, response[-1]
+            yield True, command, response[-1]
         else:
-            return False, command, response
+            yield False, command, response
 
+    @at_operation
     def get_registration_info(self):
         # On other Huawei modems AT+CGREG works with LAC and CID
         # but this one outputs LAC & CID with CREG insead of CGREG
         command = 'AT+CREG?'
-        response = self._send_command(command) 
+        response = yield command, 2 
 
-        if len(response) == 2 and response[1] == 'OK': 
-            params = ['n', 'stat', 'lac', 'cid']
-            reg = map(lambda item: item.replace('"', '').strip(), response[0].split(':')[1].split(','))
-            response = dict(zip(params,reg))
-            return True, command, response
+        reg = parse_creg(response[0]) if len(response) == 2 and response[1] == 'OK' else None
+        if reg is not None:
+            yield True, command, as_dict(reg)
         else:
-            return False, command, response
+            yield False, command, response
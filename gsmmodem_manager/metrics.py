@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import json
+import bisect
+import threading
+import logging
+from collections import namedtuple
+
+from .latency import command_key
+
+# A command sent to a modem. wait is the time until the first response line, read the rest
+CommandSample = namedtuple('CommandSample', ['device', 'command', 'code', 'latency', 'wait', 'read',
+                                             'bytes_written', 'bytes_read'])
+
+
+class Metrics(object):
+    """Counters of the AT commands sent by the modems using it (see GSMModem.set_metrics),
+    per device and command: calls, failures by result code, bytes written and read,
+    time waiting for the modem and reading its response, and a latency histogram.
+    Hooks receive every CommandSample, i.e. to feed another metrics system."""
+
+    BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30) # Seconds, plus +Inf
+
+    # Result codes of successful commands, OK or the prompt to enter a message
+    SUCCESS_CODES = ('OK', '>')
+
+    # Offsets of the counters list
+    CALLS, BYTES_WRITTEN, BYTES_READ, WAIT, READ, LATENCY, HISTOGRAM = range(7)
+
+    def __init__(self):
+        self._counters = {} # (device, command) -> counters list
+        self._failures = {} # (device, command, code) -> count
+        self._hooks = []
+        self._lock = threading.Lock()
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def add_hook(self, callback):
+        """callback is called with the CommandSample of every command"""
+        self._hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self._hooks.remove(callback)
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._failures.clear()
+
+    def record(self, device, command, response, timed_out, start, first_line, end):
+        """- response: response lines, the last one being the result code unless timed_out
+        - start, first_line, end: when the command was sent, the first line arrived and the response ended"""
+        code = 'TIMEOUT' if timed_out else response[-1]
+        sample = CommandSample(device, command_key(command), code, end - start, first_line - start, end - first_line,
+                               len(command) + 2, sum(len(line) + 2 for line in response))
+
+        key = (sample.device, sample.command)
+        with self._lock:
+            counters = self._counters.get(key)
+            if counters is None:
+                counters = self._counters[key] = [0] * self.HISTOGRAM + [0] * (len(self.BUCKETS) + 1)
+            counters[self.CALLS] += 1
+            counters[self.BYTES_WRITTEN] += sample.bytes_written
+            counters[self.BYTES_READ] += sample.bytes_read
+            counters[self.WAIT] += sample.wait
+            counters[self.READ] += sample.read
+            counters[self.LATENCY] += sample.latency
+            counters[self.HISTOGRAM + bisect.bisect_left(self.BUCKETS, sample.latency)] += 1
+            if code not in self.SUCCESS_CODES:
+                failure = key + (code,)
+                self._failures[failure] = self._failures.get(failure, 0) + 1
+
+        for hook in self._hooks:
+            try:
+                hook(sample)
+            except Exception as e:
+                self._logger.error('Metrics hook failed: ' + repr(e))
+
+    def snapshot(self):
+        """Counters as a list of dictionaries, one per device and command"""
+        with self._lock:
+            counters = dict((key, list(values)) for key, values in self._counters.items())
+            failures = dict(self._failures)
+
+        snapshot = []
+        for (device, command), values in sorted(counters.items()):
+            snapshot.append({
+                'device': device, 'command': command, 'calls': values[self.CALLS],
+                'bytes_written': values[self.BYTES_WRITTEN], 'bytes_read': values[self.BYTES_READ],
+                'wait_seconds': values[self.WAIT], 'read_seconds': values[self.READ],
+                'latency_seconds': values[self.LATENCY],
+                'histogram': dict(zip([str(bucket) for bucket in self.BUCKETS] + ['+Inf'], values[self.HISTOGRAM:])),
+                'failures': dict((code, count) for (d, c, code), count in failures.items() if (d, c) == (device, command)),
+            })
+        return snapshot
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), sort_keys=True)
+
+    def to_prometheus(self):
+        """Counters in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append('# HELP ' + name + ' ' + help)
+            lines.append('# TYPE ' + name + ' ' + kind)
+            for labels, value in samples:
+                lines.append(name + '{' + ','.join(k + '="' + _escape(v) + '"' for k, v in labels) + '} ' + repr(value))
+
+        def labels(entry):
+            return [('device', entry['device']), ('command', entry['command'])]
+
+        metric('gsmmodem_commands_total', 'counter', 'AT commands sent',
+               [(labels(e), e['calls']) for e in snapshot])
+        metric('gsmmodem_command_failures_total', 'counter', 'AT commands not answered with OK, by result code',
+               [(labels(e) + [('code', code)], count) for e in snapshot for code, count in sorted(e['failures'].items())])
+        metric('gsmmodem_bytes_written_total', 'counter', 'Bytes written to the modem',
+               [(labels(e), e['bytes_written']) for e in snapshot])
+        metric('gsmmodem_bytes_read_total', 'counter', 'Bytes of response lines read from the modem',
+               [(labels(e), e['bytes_read']) for e in snapshot])
+        metric('gsmmodem_wait_seconds_total', 'counter', 'Time waiting for the first response line',
+               [(labels(e), e['wait_seconds']) for e in snapshot])
+        metric('gsmmodem_read_seconds_total', 'counter', 'Time from the first response line to the result code',
+               [(labels(e), e['read_seconds']) for e in snapshot])
+
+        name = 'gsmmodem_command_latency_seconds'
+        lines.append('# HELP ' + name + ' AT command latency')
+        lines.append('# TYPE ' + name + ' histogram')
+        for e in snapshot:
+            label = ','.join(k + '="' + _escape(v) + '"' for k, v in labels(e))
+            cumulative = 0
+            for bucket in [str(bucket) for bucket in self.BUCKETS] + ['+Inf']:
+                cumulative += e['histogram'][bucket]
+                lines.append(name + '_bucket{' + label + ',le="' + bucket + '"} ' + str(cumulative))
+            lines.append(name + '_sum{' + label + '} ' + repr(e['latency_seconds']))
+            lines.append(name + '_count{' + label + '} ' + str(e['calls']))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
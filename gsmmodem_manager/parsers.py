@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Parsers of the information response lines, as per 3GPP TS 27.007 and the
+Huawei AT command interface specifications. They take a single line and return
+a record, or None if the line does not follow the grammar, so they are usable
+on responses and URCs read by any transport. Optional fields missing on the
+line are None. Quotes and blanks are never part of the values."""
+
+import re
+from collections import namedtuple
+
+# Records are namedtuples, so they take no more memory than a tuple (__slots__ is empty)
+Csq = namedtuple('Csq', ['rssi', 'ber'])
+Creg = namedtuple('Creg', ['n', 'stat', 'lac', 'cid', 'act'])
+Cops = namedtuple('Cops', ['mode', 'format', 'oper', 'act'])
+Network = namedtuple('Network', ['stat', 'long_name', 'short_name', 'plmn', 'act']) # stat 1 available, 2 current, 3 forbidden
+SysCfg = namedtuple('SysCfg', ['mode', 'acqorder', 'band', 'roam', 'srvdomain', 'lteband'])
+Cgdcont = namedtuple('Cgdcont', ['cid', 'pdp_type', 'apn'])
+Hcsq = namedtuple('Hcsq', ['sysmode', 'values']) # values depend on sysmode, i.e. rssi,rsrp,sinr,rsrq for LTE
+Cmgl = namedtuple('Cmgl', ['index', 'stat', 'alpha', 'length'])
+Cmgr = namedtuple('Cmgr', ['stat', 'alpha', 'length'])
+Cmti = namedtuple('Cmti', ['mem', 'index'])
+
+_SEP = r'\s*,\s*'
+_QUOTED = r'"?([^",]*?)"?'
+
+# +CSQ: <rssi>,<ber>
+_CSQ = re.compile(r'\+CSQ:\s*(\d+)' + _SEP + r'(\d+)')
+
+# +CREG: <n>,<stat>[,<lac>,<ci>[,<AcT>]] when solicited, +CREG: <stat>[,<lac>,<ci>[,<AcT>]] when unsolicited.
+# Same for +CGREG and +CEREG, which may add more fields after <AcT>.
+_REG_LOCATION = r'(?:' + _SEP + _QUOTED + _SEP + _QUOTED + r'(?:' + _SEP + r'(\d+))?)?'
+_CREG = re.compile(r'\+C(?:G|E)?REG:\s*(\d+)' + _SEP + r'(\d+)' + _REG_LOCATION + r'\s*(?:,|$)')
+_CREG_URC = re.compile(r'\+C(?:G|E)?REG:\s*(\d+)' + _REG_LOCATION + r'\s*(?:,|$)')
+
+# +COPS: <mode>[,<format>,<oper>[,<AcT>]]
+_COPS = re.compile(r'\+COPS:\s*(\d+)(?:' + _SEP + r'(\d+)' + _SEP + r'"([^"]*)"(?:' + _SEP + r'(\d+))?)?')
+
+# +CGDCONT: <cid>,<PDP_type>,<APN>[,<PDP_addr>,...]
+_CGDCONT = re.compile(r'\+CGDCONT:\s*(\d+)' + _SEP + _QUOTED + _SEP + r'"?([^",]*)"?')
+
+# +COPS: [list of supported (<stat>,long alphanumeric <oper>,short alphanumeric <oper>,numeric <oper>[,<AcT>])s]
+# [,,(list of supported <mode>s),(list of supported <format>s)]
+_COPS_NETWORK = re.compile(r'\(\s*(\d+)' + _SEP + r'"([^"]*)"' + _SEP + r'"([^"]*)"' + _SEP + r'"([^"]*)"'
+                           + r'(?:' + _SEP + r'(\d+))?\s*\)')
+
+# +CMGL: <index>,<stat>,[<alpha>],<length> and +CMGR: <stat>,[<alpha>],<length>, in PDU mode.
+# The PDU comes on the next line
+_CMGL = re.compile(r'\+CMGL:\s*(\d+)' + _SEP + r'(\d+)' + _SEP + r'"?([^",]*)"?' + _SEP + r'(\d+)')
+_CMGR = re.compile(r'\+CMGR:\s*(\d+)' + _SEP + r'"?([^",]*)"?' + _SEP + r'(\d+)')
+
+# +CMTI: <mem>,<index>
+_CMTI = re.compile(r'\+CMTI:\s*' + _QUOTED + _SEP + r'(\d+)')
+
+# +CMGS: <mr>
+_CMGS = re.compile(r'\+CMGS:\s*(\d+)')
+
+# ^SYSCFG: <mode>,<acqorder>,<band>,<roam>,<srvdomain>
+# ^SYSCFGEX: <acqorder>,<band>,<roam>,<srvdomain>[,<lteband>]
+_SYSCFG = re.compile(r'\^SYSCFG:\s*(\d+)' + _SEP + r'(\d+)' + _SEP + r'(\w+)' + _SEP + r'(\d+)' + _SEP + r'(\d+)')
+_SYSCFGEX = re.compile(r'\^SYSCFGEX:\s*' + _QUOTED + _SEP + r'(\w*)' + _SEP + r'(\d+)' + _SEP + r'(\d+)'
+                       + r'(?:' + _SEP + r'(\w*))?')
+
+# ^RSSI: <rssi>, same scale than +CSQ
+_RSSI = re.compile(r'\^RSSI:\s*(\d+)')
+
+# ^HCSQ: <sysmode>[,<value1>[,<value2>[,<value3>[,<value4>]]]]
+_HCSQ = re.compile(r'\^HCSQ:\s*"?(\w+)"?((?:' + _SEP + r'\d+)*)')
+_NUMBER = re.compile(r'\d+')
+
+# ^ICCID: <iccid>, padded with F when it has an odd number of digits
+_ICCID = re.compile(r'\^ICCID:\s*"?(\d+)')
+
+
+def parse_csq(line):
+    match = _CSQ.match(line)
+    return Csq(*match.groups()) if match else None
+
+
+def parse_creg(line, solicited=True):
+    """+CREG, +CGREG or +CEREG line. Unsolicited ones come without the <n> field."""
+    if solicited:
+        match = _CREG.match(line)
+        return Creg(*match.groups()) if match else None
+    match = _CREG_URC.match(line)
+    return Creg(None, *match.groups()) if match else None
+
+
+def parse_cops(line):
+    match = _COPS.match(line)
+    return Cops(*match.groups()) if match else None
+
+
+def parse_cops_list(line):
+    """Networks of the AT+COPS=? response line, an empty list if none"""
+    if not line.startswith('+COPS:'):
+        return None
+    return [Network(*match[:4] + (match[4] or None,)) for match in _COPS_NETWORK.findall(line)]
+
+
+def parse_cgdcont(line):
+    match = _CGDCONT.match(line)
+    return Cgdcont(*match.groups()) if match else None
+
+
+def _optional(value):
+    return value if value != '' else None
+
+
+def parse_cmgl(line):
+    match = _CMGL.match(line)
+    return Cmgl(match.group(1), match.group(2), _optional(match.group(3)), match.group(4)) if match else None
+
+
+def parse_cmgr(line):
+    match = _CMGR.match(line)
+    return Cmgr(match.group(1), _optional(match.group(2)), match.group(3)) if match else None
+
+
+def parse_cmti(line):
+    match = _CMTI.match(line)
+    return Cmti(*match.groups()) if match else None
+
+
+def parse_cmgs(line):
+    """Message reference of a sent message"""
+    match = _CMGS.match(line)
+    return match.group(1) if match else None
+
+
+def parse_syscfg(line):
+    """^SYSCFG or ^SYSCFGEX line. The former has no <lteband>, the latter no <mode>."""
+    match = _SYSCFG.match(line)
+    if match:
+        return SysCfg(*match.groups() + (None,))
+    match = _SYSCFGEX.match(line)
+    return SysCfg(None, *match.groups()) if match else None
+
+
+def parse_rssi(line):
+    match = _RSSI.match(line)
+    return match.group(1) if match else None
+
+
+def parse_hcsq(line):
+    match = _HCSQ.match(line)
+    return Hcsq(match.group(1), tuple(_NUMBER.findall(match.group(2)))) if match else None
+
+
+def parse_iccid(line):
+    match = _ICCID.match(line)
+    return match.group(1) if match else None
+
+
+def as_dict(record):
+    """Fields of a record present on the line"""
+    return dict((field, value) for field, value in zip(record._fields, record) if value is not None)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import threading
+import time
+import logging
+from collections import namedtuple
+
+try:
+    import Queue as queue # python 2
+except ImportError:
+    import queue
+
+# Outcome of an operation on a single modem. Either result or error is set.
+PoolResult = namedtuple('PoolResult', ['modem', 'result', 'error', 'elapsed'])
+
+
+class PoolTimeout(Exception):
+    """The operation on a modem did not finish in time"""
+
+
+class ModemPool(object):
+    """Owns a set of modems and runs operations across all of them in parallel,
+    on a bounded number of threads. A failing or hung modem does not hold back
+    the results of the rest: once it times out, another thread takes over the
+    remaining modems, and the hung one ends with its operation."""
+
+    def __init__(self, modems, max_workers=8):
+        self.modems = list(modems)
+        self.max_workers = max_workers
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    @classmethod
+    def from_devicefiles(cls, modem_class, devicefiles, baudrate, max_workers=8):
+        """Pool of modem_class instances, one per device file. The ports are
+        opened lazily by the first operation, so they are handshaked in parallel."""
+        return cls([modem_class(devicefile, baudrate, lazy=True) for devicefile in devicefiles], max_workers)
+
+    def __len__(self):
+        return len(self.modems)
+
+    def __iter__(self):
+        return iter(self.modems)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        for modem in self.modems:
+            modem.close_connection()
+
+    def run(self, operation, timeout=None):
+        """Run operation(modem) on every modem. Generator yielding a PoolResult
+        as soon as each modem finishes, so the whole sweep lasts as much as the
+        slowest modem.
+        - operation: callable receiving the modem, or name of a modem method
+        - timeout: max seconds per modem, counted since its operation started"""
+        if not callable(operation):
+            operation = self._method_caller(operation)
+
+        tasks, results = queue.Queue(), queue.Queue()
+        for modem in self.modems:
+            tasks.put(modem)
+
+        started, lock = {}, threading.Lock() # modem -> start time of running operations
+        pending, abandoned = set(self.modems), set() # Reported as timed out while running
+
+        def worker():
+            while True:
+                try:
+                    modem = tasks.get_nowait()
+                except queue.Empty:
+                    return
+
+                with lock:
+                    started[modem] = time.time()
+                try:
+                    result, error = operation(modem), None
+                except Exception as e:
+                    self._logger.error('Pool operation failed on ' + str(modem) + ': ' + repr(e))
+                    result, error = None, e
+                with lock:
+                    elapsed = time.time() - started.pop(modem)
+                    if modem in abandoned: # Its slot went to another thread meanwhile
+                        return
+                results.put(PoolResult(modem, result, error, elapsed))
+
+        def spawn():
+            thread = threading.Thread(target=worker)
+            thread.daemon = True # A hung modem must not block the interpreter exit
+            thread.start()
+
+        for _ in range(min(self.max_workers, len(self.modems))):
+            spawn()
+
+        while pending:
+            try:
+                res = results.get(timeout=0.1 if timeout is not None else None)
+            except queue.Empty:
+                res = None
+
+            if res is not None: # Timed out ones are not reported again
+                pending.discard(res.modem)
+                yield res
+                continue
+
+            now = time.time()
+            with lock:
+                expired = [(modem, now - start) for modem, start in started.items()
+                           if modem in pending and now - start >= timeout]
+                abandoned.update(modem for modem, elapsed in expired)
+            for modem, elapsed in expired:
+                pending.discard(modem)
+                spawn() # The hung thread ends with its operation, so max_workers modems run besides hung ones
+                yield PoolResult(modem, None, PoolTimeout(str(modem) + ' timed out'), elapsed)
+
+    def collect(self, operation, timeout=None):
+        """Same as run, but waits for all the modems. Returns a list of PoolResult
+        in the same order as the pool modems."""
+        results = dict((res.modem, res) for res in self.run(operation, timeout))
+        return [results[modem] for modem in self.modems]
+
+    def _method_caller(self, name):
+        def operation(modem):
+            return getattr(modem, name)()
+        return operation
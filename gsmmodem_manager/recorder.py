@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Recording of the serial traffic of a modem, and replay of recordings.
+
+A recording is MAGIC followed by frames, each one a FRAME_HEADER (timestamp
+as a double, direction, length) and the bytes sent or received, so big ones are
+scanned through mmap without reading the data. Replayer serves a recording
+behind a pseudo-terminal, so any modem class can be run against it."""
+
+import os
+import sys
+import tty
+import time
+import mmap
+import errno
+import select
+import struct
+import threading
+import logging
+from collections import namedtuple
+
+MAGIC = b'GSMREC\x00\x01'
+FRAME_HEADER = struct.Struct('<dBI')
+TX, RX = 0, 1 # Sent to and received from the modem
+
+# data is a memoryview on the mapped recording, valid until it is closed. bytes(data) to keep it
+RecordedFrame = namedtuple('RecordedFrame', ['ts', 'direction', 'data'])
+
+
+class Recorder(object):
+    """Appends the traffic of a modem to a recording file. Set it with
+    GSMModem.set_recorder, one per modem, as frames do not tell the port.
+    - autoflush: write every frame through, not to lose the last ones on a crash"""
+
+    def __init__(self, path, autoflush=True):
+        self.path = path
+        self.autoflush = autoflush
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def record(self, direction, data, ts=None):
+        """- data: bytes, bytearray or memoryview"""
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(FRAME_HEADER.pack(ts or time.time(), direction, len(data)))
+            self._file.write(data)
+            if self.autoflush:
+                self._file.flush()
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class Recording(object):
+    """Memory mapped recording. Frames are read lazily, a truncated last one,
+    i.e. of a crashed recorder, is left out."""
+
+    def __init__(self, path):
+        self.path = path
+        self._map, self._view = None, None
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(path + ' is not a recording')
+            if os.fstat(f.fileno()).st_size > len(MAGIC):
+                self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                # memoryview on mmap is python 3 only, slices of it are copies otherwise
+                self._view = memoryview(self._map) if sys.version_info[0] >= 3 else self._map
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            try:
+                if sys.version_info[0] >= 3:
+                    self._view.release()
+                self._map.close()
+            except BufferError: # Frames still in use, unmapped once they are gone
+                pass
+            self._map, self._view = None, None
+
+    def __iter__(self):
+        return self.frames()
+
+    def frames(self, direction=None, since=None, until=None):
+        """Frames in order, optionally only those of direction, or taken between since and until"""
+        if self._map is None:
+            return
+        offset, size = len(MAGIC), len(self._map)
+        while offset + FRAME_HEADER.size <= size:
+            ts, frame_direction, length = FRAME_HEADER.unpack_from(self._map, offset)
+            start = offset + FRAME_HEADER.size
+            offset = start + length
+            if offset > size or (until is not None and ts > until):
+                return
+            if (direction is None or frame_direction == direction) and (since is None or ts >= since):
+                yield RecordedFrame(ts, frame_direction, self._view[start:offset])
+
+    def stats(self):
+        """Number of frames and bytes of each direction, and the time span, only reading the headers"""
+        counts = {TX: [0, 0], RX: [0, 0]}
+        first = last = None
+        for ts, direction, data in self.frames():
+            counts[direction][0] += 1
+            counts[direction][1] += len(data)
+            first = ts if first is None else first
+            last = ts
+        return {'tx_frames': counts[TX][0], 'tx_bytes': counts[TX][1], 'rx_frames': counts[RX][0],
+                'rx_bytes': counts[RX][1], 'duration': last - first if first is not None else 0}
+
+
+class Replayer(object):
+    """Plays a recording behind a pseudo-terminal. Open devicefile with any of the
+    GSMModem classes. Received frames are written with their recorded timing,
+    relative to the sent frame before them, so they answer once the modem object
+    has sent that command; sent frames that differ are kept in mismatches.
+    - speed: time scale, i.e. 10 for ten times faster. None for no delays at all
+    - timeout: seconds to wait for each sent frame before going on without it"""
+
+    def __init__(self, path, speed=1.0, timeout=5):
+        self.speed, self.timeout = speed, timeout
+        self.mismatches = [] # (recorded, received) sent frames
+        self.done = threading.Event() # Set once the whole recording is played
+        self._recording = Recording(path)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self.devicefile = os.ttyname(self._slave)
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+        self._running = True
+        self._thread = threading.Thread(target=self._play)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._running:
+            self._running = False
+            self._thread.join()
+            os.close(self._master)
+            os.close(self._slave)
+            self._recording.close()
+
+    def _sleep_until(self, deadline):
+        while self._running and time.time() < deadline:
+            time.sleep(min(deadline - time.time(), 0.05))
+
+    def _receive(self, length, deadline, poll):
+        """Up to length bytes sent by the modem object, until deadline"""
+        data = b''
+        while self._running and len(data) < length and time.time() < deadline:
+            if poll.poll(min(deadline - time.time(), 0.05) * 1000):
+                try:
+                    data += os.read(self._master, length - len(data))
+                except OSError as e:
+                    if e.errno != errno.EIO: # EIO while the slave is not open
+                        raise
+                    time.sleep(0.01)
+        return data
+
+    def _play(self):
+        poll = select.poll()
+        poll.register(self._master, select.POLLIN)
+        anchor = None # (recorded, actual) time the timing is relative to
+        for frame in self._recording.frames():
+            if not self._running:
+                return
+            if anchor is None:
+                anchor = (frame.ts, time.time())
+
+            if frame.direction == TX:
+                expected = bytes(frame.data)
+                received = self._receive(len(expected), time.time() + self.timeout, poll)
+                if received != expected:
+                    self.mismatches.append((expected, received))
+                    self._logger.warning('Replay expected ' + repr(expected) + ' but got ' + repr(received))
+                anchor = (frame.ts, time.time())
+            else:
+                if self.speed:
+                    self._sleep_until(anchor[1] + (frame.ts - anchor[0]) / self.speed)
+                os.write(self._master, bytes(frame.data))
+        self.done.set()
+
+        while self._running: # Discard anything else sent
+            if poll.poll(50):
+                try:
+                    os.read(self._master, 4096)
+                except OSError:
+                    time.sleep(0.01)
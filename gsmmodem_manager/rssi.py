@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Bulk conversion of +CSQ RSSI indexes (0 to 31, 99 unknown) to dBm, quality
+class and percentage, for the analysis of logged signal quality. Inputs are any
+iterable of indexes; outputs are NumPy arrays if it is installed, array.array
+otherwise. Both ways the conversion is a lookup in tables derived once from
+GSMModem.RSSI_DBM, with no per value Python code. Indexes out of range are
+taken as unknown, like 99."""
+
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .lib import GSMModem
+
+UNKNOWN = 99
+
+# Quality classes, their codes being the position here. As per signal_quality()
+QUALITIES = ('Not known or not detectable', 'No Signal', 'Marginal, No Signal', 'Marginal', 'OK', 'Good', 'Excellent')
+
+
+def _table(field):
+    """RSSI_DBM field of each index from 0 to 255"""
+    return [GSMModem.RSSI_DBM.get(index, GSMModem.RSSI_DBM[UNKNOWN])[field] for index in range(256)]
+
+DBM = _table(0)
+QUALITY = [QUALITIES.index(quality) for quality in _table(1)]
+PERCENT = _table(2)
+
+# Translation tables for bytearray.translate, with the array typecode of the result.
+# dBm are stored as signed bytes.
+_TABLES = {
+    'dbm': (bytes(bytearray(dbm & 0xFF for dbm in DBM)), 'b'),
+    'quality': (bytes(bytearray(QUALITY)), 'B'),
+    'percent': (bytes(bytearray(PERCENT)), 'B'),
+}
+
+if numpy is not None:
+    _ARRAYS = {
+        'dbm': numpy.array(DBM, dtype=numpy.int8),
+        'quality': numpy.array(QUALITY, dtype=numpy.uint8),
+        'percent': numpy.array(PERCENT, dtype=numpy.uint8),
+    }
+
+
+def _indexes(rssis):
+    if numpy is not None:
+        if not hasattr(rssis, '__len__'):
+            rssis = list(rssis) # numpy takes iterators as a single object
+        rssis = numpy.asarray(rssis, dtype=numpy.int64)
+        return numpy.where((rssis >= 0) & (rssis < 256), rssis, UNKNOWN)
+    if isinstance(rssis, (bytes, bytearray)):
+        return rssis
+    if isinstance(rssis, array):
+        # Otherwise bytearray would copy the machine representation of wider types
+        rssis = rssis if rssis.typecode == 'B' else rssis.tolist()
+    elif not isinstance(rssis, (list, tuple)):
+        rssis = list(rssis) # Iterators could not be retried below
+    try:
+        rssis = bytearray(rssis) # Done in C for integers in range
+    except (ValueError, TypeError):
+        rssis = bytearray(rssi if 0 <= rssi < 256 else UNKNOWN for rssi in map(int, rssis))
+    return rssis
+
+
+def _lookup(rssis, table):
+    rssis = _indexes(rssis)
+    if numpy is not None:
+        return _ARRAYS[table][rssis]
+    translation, typecode = _TABLES[table]
+    converted = array(typecode)
+    frombytes = getattr(converted, 'frombytes', None) or converted.fromstring # fromstring in python 2
+    frombytes(bytes(rssis.translate(translation)))
+    return converted
+
+
+def to_dbm(rssis):
+    return _lookup(rssis, 'dbm')
+
+
+def to_quality(rssis):
+    """Quality class codes, see QUALITIES"""
+    return _lookup(rssis, 'quality')
+
+
+def to_percent(rssis):
+    return _lookup(rssis, 'percent')
+
+
+def convert(rssis):
+    """dBm, quality class codes and percentages of rssis"""
+    rssis = _indexes(rssis) # Once for the three of them
+    return to_dbm(rssis), to_quality(rssis), to_percent(rssis)
+
+
+def quality_histogram(rssis):
+    """Number of rssis of each quality class, as a dictionary"""
+    rssis = _indexes(rssis)
+    if numpy is not None:
+        counts = numpy.bincount(_ARRAYS['quality'][rssis], minlength=len(QUALITIES)).tolist()
+    else:
+        qualities = rssis.translate(_TABLES['quality'][0])
+        counts = [qualities.count(bytearray([code])) for code in range(len(QUALITIES))]
+    return dict(zip(QUALITIES, counts))
+
+
+def cell_averages(cells, rssis):
+    """Mean dBm of the rssis of each cell, i.e. CIDs or (LAC, CID) tuples sampled
+    along. Unknown rssis are left out, and so cells with no known one."""
+    rssis = _indexes(rssis)
+    if numpy is not None:
+        cells = numpy.asarray(cells)
+        known = _ARRAYS['quality'][rssis] != 0
+        keys, inverse = numpy.unique(cells[known], return_inverse=True, axis=0 if cells.ndim > 1 else None)
+        sums = numpy.bincount(inverse.ravel(), weights=_ARRAYS['dbm'][rssis[known]])
+        counts = numpy.bincount(inverse.ravel())
+        keys = [tuple(key) if cells.ndim > 1 else key for key in keys.tolist()]
+        return dict(zip(keys, (sums / counts).tolist()))
+
+    sums = {}
+    for cell, dbm, quality in zip(cells, to_dbm(rssis), to_quality(rssis)):
+        if quality != 0:
+            total = sums.setdefault(cell, [0, 0])
+            total[0] += dbm
+            total[1] += 1
+    return dict((cell, float(total) / count) for cell, (total, count) in sums.items())
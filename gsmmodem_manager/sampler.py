@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import time
+import threading
+import logging
+from array import array
+from collections import namedtuple
+
+from .parsers import parse_rssi, parse_hcsq
+from .scheduler import ModemScheduler
+
+# Registration info fields are None when unknown. lac and cid are integers
+Sample = namedtuple('Sample', ['ts', 'rssi', 'ber', 'stat', 'lac', 'cid', 'act'])
+
+# Samples of an interval. rssi and ber statistics leave out the unknown ones (99), being
+# None if all of them are; registration info is the latest of the interval.
+Bucket = namedtuple('Bucket', ['ts', 'count', 'rssi_min', 'rssi_max', 'rssi_mean', 'ber_min', 'ber_max', 'ber_mean',
+                               'stat', 'lac', 'cid', 'act'])
+
+UNKNOWN = 99 # RSSI index and BER not known or not detectable, as per 3GPP TS 27.007 +CSQ
+_MISSING = 0xFFFFFFFF # Unknown registration info in the arrays
+
+
+class RingBuffer(object):
+    """Fixed number of samples, the oldest being overwritten. Each field is kept
+    in an array, so a sample takes about 25 bytes instead of a tuple of objects."""
+
+    # Array typecode of each field
+    TYPECODES = (('ts', 'd'), ('rssi', 'B'), ('ber', 'B'), ('stat', 'I'), ('lac', 'I'), ('cid', 'I'), ('act', 'I'))
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._columns = [array(typecode, [0]) * capacity for _, typecode in self.TYPECODES]
+        self._next, self._count = 0, 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._count
+
+    def append(self, ts, rssi, ber, stat=None, lac=None, cid=None, act=None):
+        """- rssi, ber: +CSQ indexes
+        - stat, lac, cid, act: registration info as returned by get_registration_info, or None"""
+        values = (ts, int(rssi), int(ber), _int(stat, 10), _int(lac, 16), _int(cid, 16), _int(act, 10))
+        with self._lock:
+            for column, value in zip(self._columns, values):
+                column[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+
+    def clear(self):
+        with self._lock:
+            self._next, self._count = 0, 0
+
+    def __iter__(self):
+        return self.samples()
+
+    def samples(self, since=None):
+        """Samples from the oldest to the newest, optionally only those taken at or after since"""
+        with self._lock: # Copying the arrays is way cheaper than holding the lock while iterating
+            start = (self._next - self._count) % self.capacity
+            if start + self._count <= self.capacity:
+                columns = [column[start:start + self._count] for column in self._columns]
+            else:
+                columns = [column[start:] + column[:self._next] for column in self._columns]
+
+        for ts, rssi, ber, stat, lac, cid, act in zip(*columns):
+            if since is None or ts >= since:
+                yield Sample(ts, rssi, ber, _none(stat), _none(lac), _none(cid), _none(act))
+
+    def downsample(self, interval, since=None):
+        """Buckets of interval seconds, aligned to multiples of it, from the oldest to the newest"""
+        bucket = None
+        for sample in self.samples(since):
+            ts = sample.ts - sample.ts % interval
+            if bucket is None or ts != bucket[0]:
+                if bucket is not None:
+                    yield _bucket(*bucket)
+                bucket = [ts, 0, [], [], sample]
+            bucket[1] += 1
+            if sample.rssi != UNKNOWN:
+                bucket[2].append(sample.rssi)
+            if sample.ber != UNKNOWN:
+                bucket[3].append(sample.ber)
+            bucket[4] = sample
+        if bucket is not None:
+            yield _bucket(*bucket)
+
+
+def _int(value, base):
+    return _MISSING if value is None or value == '' else int(value, base)
+
+
+def _none(value):
+    return None if value == _MISSING else value
+
+
+def _bucket(ts, count, rssis, bers, last):
+    stats = []
+    for values in (rssis, bers):
+        if values:
+            stats += [min(values), max(values), float(sum(values)) / len(values)]
+        else:
+            stats += [None, None, None]
+    return Bucket(ts, count, *stats + [last.stat, last.lac, last.cid, last.act])
+
+
+def hcsq_to_rssi(hcsq):
+    """+CSQ RSSI index of a ^HCSQ record, whose first value is RSSI in 1 dBm steps from -120 dBm"""
+    if not hcsq.values:
+        return UNKNOWN # NOSERVICE
+    dbm = int(hcsq.values[0]) - 121
+    return min(max((dbm + 113) // 2, 0), 31)
+
+
+class Sampler(object):
+    """Samples the signal quality and registration info of a modem into a RingBuffer,
+    every interval seconds. With urc, ^RSSI and ^HCSQ URCs are sampled as they arrive
+    instead of polling get_signal_quality; they are delivered on time with the modem
+    reader thread running (see GSMModem.start_reader).
+
+    Its commands go through scheduler if given, behind any other request, or straight
+    to the modem otherwise, between those of other threads. See AsyncSampler for
+    AsyncGSMModem ones."""
+
+    URC_PREFIXES = ('^RSSI:', '^HCSQ:')
+
+    def __init__(self, modem, interval=10, capacity=8640, urc=False, scheduler=None):
+        """- capacity: number of samples kept, one day every 10 seconds by default
+        - scheduler: ModemScheduler of the modem, if the caller uses one"""
+        self.modem = modem
+        self.scheduler = scheduler
+        self.interval = interval
+        self.buffer = RingBuffer(capacity)
+        self.urc = urc and any(prefix in modem.URC_PREFIXES for prefix in self.URC_PREFIXES)
+        self._rssi, self._ber, self._reg = UNKNOWN, UNKNOWN, {}
+        self._thread, self._stop = None, threading.Event()
+        self._on_urc = self._on_urc # The same bound method is needed to unsubscribe
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def _on_urc(self, line):
+        if line.startswith('^RSSI:'):
+            rssi = parse_rssi(line)
+        else:
+            hcsq = parse_hcsq(line)
+            rssi = hcsq_to_rssi(hcsq) if hcsq is not None else None
+        if rssi is not None:
+            self._rssi = int(rssi)
+            self._append()
+
+    def _append(self):
+        reg = self._reg
+        self.buffer.append(time.time(), self._rssi, self._ber, reg.get('stat'), reg.get('lac'), reg.get('cid'), reg.get('act'))
+
+    def _record(self, csq, reg):
+        """Sample the results of get_signal_quality, None in URC mode, and get_registration_info"""
+        if csq is not None:
+            if csq[0]:
+                self._rssi, self._ber = [int(value) for value in csq[2].split(',')]
+            else:
+                self._rssi, self._ber = UNKNOWN, UNKNOWN
+        self._reg = reg[2] if reg[0] else {}
+        self._append()
+
+    def _subscribe(self):
+        if self.urc:
+            for prefix in self.URC_PREFIXES:
+                self.modem.subscribe_urc(prefix, self._on_urc)
+
+    def _unsubscribe(self):
+        if self.urc:
+            for prefix in self.URC_PREFIXES:
+                self.modem.unsubscribe_urc(prefix, self._on_urc)
+
+    def _call(self, name):
+        if self.scheduler is not None:
+            return self.scheduler.submit(name, priority=ModemScheduler.PRIORITY_TELEMETRY).result()
+        return getattr(self.modem, name)()
+
+    def poll(self):
+        """Take a sample now"""
+        csq = None if self.urc else self._call('get_signal_quality')
+        self._record(csq, self._call('get_registration_info'))
+
+    def start(self):
+        """Sample on a thread, at a fixed cadence, until stop"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._subscribe()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            thread.join()
+            self._unsubscribe()
+
+    def _run(self):
+        next_poll = time.time()
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self._logger.error('Sampling failed: ' + repr(e))
+            # Slow polls do not shift the cadence, missed ones are skipped
+            next_poll += self.interval * (1 + int(max(time.time() - next_poll, 0) // self.interval))
+            self._stop.wait(max(next_poll - time.time(), 0))
+
+    def __iter__(self):
+        return iter(self.buffer)
+
+    def samples(self, since=None):
+        return self.buffer.samples(since)
+
+    def downsample(self, interval, since=None):
+        return self.buffer.downsample(interval, since)
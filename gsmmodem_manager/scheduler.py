@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import time
+import heapq
+import threading
+import logging
+import itertools
+
+
+class SchedulerTimeout(Exception):
+    """The request did not finish before its deadline"""
+
+
+class SchedulerCancelled(Exception):
+    """The request was cancelled"""
+
+
+class ScheduledRequest(object):
+    """Handle of a request submitted to a ModemScheduler"""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self._done = threading.Event()
+        self._result, self._error = None, None
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return isinstance(self._error, SchedulerCancelled)
+
+    def cancel(self):
+        """Give up on the request. It is dropped if not started yet, or stopped before
+        its next command otherwise, unless other requests are coalesced on it."""
+        return self._finish(None, SchedulerCancelled('Request cancelled'))
+
+    def result(self, timeout=None):
+        """Wait for the result of the method, raising its exception if it failed,
+        SchedulerTimeout if the deadline passed or SchedulerCancelled."""
+        if self.deadline is not None and (timeout is None or time.time() + timeout >= self.deadline):
+            # Not to wait for the scheduler to notice, as it may be busy with a long command
+            if not self._done.wait(max(self.deadline - time.time(), 0)):
+                self._finish(None, SchedulerTimeout('Request missed its deadline'))
+        elif not self._done.wait(timeout):
+            raise SchedulerTimeout('Request still running')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _finish(self, result, error):
+        if self._done.is_set():
+            return False
+        self._result, self._error = result, error
+        self._done.set()
+        return True
+
+
+class _Task(object):
+    """A method call on the modem, shared by the requests coalesced on it"""
+
+    def __init__(self, name, args, kwargs, key, priority, seq):
+        self.name, self.args, self.kwargs, self.key = name, args, kwargs, key
+        self.priority, self.seq = priority, seq
+        self.requests = []
+        self.operation = None # Generator of at_operation methods, once started
+        self.step = None
+        self.wake = None # (time, URC count) to resume an operation waiting for an URC
+
+    def active_requests(self, now):
+        for request in self.requests:
+            if not request.done() and request.deadline is not None and now >= request.deadline:
+                request._finish(None, SchedulerTimeout(self.name + ' missed its deadline'))
+        self.requests = [request for request in self.requests if not request.done()]
+        return self.requests
+
+
+class ModemScheduler(object):
+    """Serializes the access to a modem shared by several threads. Method calls are
+    submitted as requests, run one command at a time by a scheduler thread in
+    priority order, so a high priority request only waits for the command being
+    sent, not for the whole operation. Operations waiting for an URC, like
+    wait_for_registration, let others run meanwhile. Identical requests of read
+    only methods submitted while one is pending or running share its result.
+
+    Threads may still call the modem directly, as commands never interleave, but
+    those calls are not prioritized. AsyncGSMModem ones need no scheduler."""
+
+    PRIORITY_CONTROL, PRIORITY_NORMAL, PRIORITY_TELEMETRY = 0, 5, 10
+
+    # Methods without side effects, whose identical requests are coalesced
+    READ_ONLY_PREFIXES = ('get_',)
+
+    # Max seconds reading URCs while operations wait for them, before checking for new requests
+    URC_SLICE = 0.05
+
+    def __init__(self, modem):
+        self.modem = modem
+        self._queue = [] # heap of (priority, seq, task)
+        self._parked = [] # tasks waiting for an URC
+        self._coalesced = {} # key -> task, for read only tasks pending or running
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._urcs = 0
+        self._on_urc = self._on_urc # The same bound method is needed to unsubscribe
+        self._thread, self._stopped = None, False
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _on_urc(self, line):
+        self._urcs += 1
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopped = False
+            self.modem.subscribe_urc('', self._on_urc)
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop the scheduler thread after the current command. Requests left are cancelled."""
+        with self._cond:
+            thread, self._thread = self._thread, None
+            self._stopped = True
+            self._cond.notify()
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.modem.unsubscribe_urc('', self._on_urc)
+
+        with self._cond:
+            tasks = [task for _, _, task in self._queue] + self._parked
+            self._queue, self._parked = [], []
+            self._coalesced.clear()
+        for task in tasks:
+            self._close(task, None, SchedulerCancelled('Scheduler stopped'))
+
+    def submit(self, name, args=(), kwargs=None, priority=PRIORITY_NORMAL, timeout=None):
+        """Request a call to a modem method. Returns a ScheduledRequest.
+        - name: method name, i.e. 'get_signal_quality'
+        - priority: lower runs first, see PRIORITY_*
+        - timeout: seconds from now to give up on it"""
+        kwargs = kwargs or {}
+        request = ScheduledRequest(time.time() + timeout if timeout is not None else None)
+        key = None
+        if name.startswith(self.READ_ONLY_PREFIXES):
+            key = (name, tuple(args), tuple(sorted(kwargs.items())))
+
+        with self._cond:
+            if self._thread is None:
+                self.start()
+
+            task = self._coalesced.get(key) if key is not None else None
+            if task is not None and task.requests:
+                if priority < task.priority and task.operation is None: # Reheaped, the old entry is skipped
+                    task.priority = priority
+                    heapq.heappush(self._queue, (task.priority, task.seq, task))
+            else:
+                task = _Task(name, tuple(args), kwargs, key, priority, next(self._seq))
+                if key is not None:
+                    self._coalesced[key] = task
+                heapq.heappush(self._queue, (task.priority, task.seq, task))
+
+            task.requests.append(request)
+            self._cond.notify()
+        return request
+
+    def call(self, name, *args, **kwargs):
+        """Blocking call to a modem method, at normal priority"""
+        return self.submit(name, args, kwargs).result()
+
+    def _next_task(self):
+        """Highest priority task ready to run, waiting meanwhile. None once stopped"""
+        while True:
+            with self._cond:
+                while not self._parked:
+                    if self._stopped:
+                        return None
+                    task = self._pop(time.time())
+                    if task is not None:
+                        return task
+                    self._cond.wait()
+
+                if self._stopped:
+                    return None
+                now = time.time()
+                for task in list(self._parked):
+                    if now >= task.wake[0] or self._urcs != task.wake[1] or not task.active_requests(now):
+                        self._parked.remove(task)
+                        heapq.heappush(self._queue, (task.priority, task.seq, task))
+                task = self._pop(now)
+                if task is not None:
+                    return task
+                wake = min(task.wake[0] for task in self._parked) if self._parked else now
+
+            # Only operations waiting for URCs, read them until one arrives or a new request comes in
+            try:
+                self.modem._wait_urc(max(min(wake - time.time(), self.URC_SLICE), 0))
+            except Exception as e:
+                self._logger.error('Scheduler failed waiting for URCs: ' + repr(e))
+                time.sleep(self.URC_SLICE)
+
+    def _pop(self, now):
+        while self._queue:
+            priority, seq, task = heapq.heappop(self._queue)
+            if priority != task.priority:
+                continue # Stale entry of a reheaped task
+            if not task.active_requests(now):
+                self._close(task, None, None) # All its requests cancelled or expired
+                continue
+            return task
+        return None
+
+    def _run(self):
+        while True:
+            task = self._next_task()
+            if task is None:
+                return
+            try:
+                self._step(task)
+            except Exception as e:
+                self._logger.error('Scheduled ' + task.name + ' failed: ' + repr(e))
+                self._close(task, None, e)
+
+    def _step(self, task):
+        """Run the task until its next command is answered, it waits for an URC or it ends"""
+        if task.operation is None:
+            method = getattr(self.modem, task.name)
+            if not hasattr(method, 'operation'): # Not an at_operation, run it at once
+                self._close(task, method(*task.args, **task.kwargs), None)
+                return
+            task.operation = method.operation(self.modem, *task.args, **task.kwargs)
+            task.step = next(task.operation)
+        elif task.step[0] is None: # Woken up while waiting for an URC
+            task.step = task.operation.send(None)
+
+        if len(task.step) != 3:
+            command, sleeptime = task.step
+            if command is None: # The rest can run until an URC arrives or the timeout
+                with self._cond:
+                    task.wake = (time.time() + sleeptime, self._urcs)
+                    self._parked.append(task)
+                return
+            with self.modem._lock: # Against threads using the modem without the scheduler
+                while True:
+                    response = self.modem._send_command(command, sleeptime)
+                    task.step = task.operation.send(response)
+                    # After a prompt the modem waits for the message, nothing else can be sent meanwhile
+                    if len(task.step) == 3 or task.step[0] is None or response[-1:] != [self.modem.PROMPT]:
+                        break
+                    command, sleeptime = task.step
+
+        if len(task.step) == 3:
+            self._close(task, task.step, None)
+        else:
+            with self._cond: # Its seq keeps it ahead of tasks of the same priority submitted later
+                heapq.heappush(self._queue, (task.priority, task.seq, task))
+
+    def _close(self, task, result, error):
+        with self._cond:
+            if task.key is not None and self._coalesced.get(task.key) is task:
+                del self._coalesced[task.key]
+        if task.operation is not None:
+            task.operation.close()
+        for request in task.requests:
+            request._finish(result, error)
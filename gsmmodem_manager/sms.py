@@ -0,0 +1,475 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""SMS in PDU mode, as per 3GPP TS 23.040 and 23.038: encoding of SMS-SUBMIT
+PDUs, split in concatenated parts when the text does not fit in one, decoding of
+SMS-DELIVER and SMS-SUBMIT PDUs, and reassembly of concatenated messages.
+Texts are GSM 7 bit encoded, or UCS2 when they have other characters."""
+
+import time
+import codecs
+import binascii
+import threading
+import logging
+from collections import namedtuple
+
+try:
+    import Queue as queue # python 2
+except ImportError:
+    import queue
+
+from .parsers import parse_cmgl
+from .scheduler import ScheduledRequest
+
+# Decoded message. index is its position in the modem storage, or the tuple of the indexes of
+# its parts once reassembled. stat as per GSMModem.SMS_*. number is the originator of received
+# messages and the destination of sent ones. timestamp, of the SMSC, 'yy/MM/dd,hh:mm:ss+zz' as
+# in text mode. text is bytes for 8 bit data. concat is (reference, parts, part) of the parts of
+# concatenated messages not reassembled, None otherwise.
+Sms = namedtuple('Sms', ['index', 'stat', 'number', 'smsc', 'timestamp', 'text', 'concat'])
+
+# GSM 03.38 default alphabet, and its extension table after the escape septet
+_GSM7 = (u'@£$¥èéùìòÇ\nØø\rÅåΔ_ΦΓΛΩΠΨΣΘΞ\x1bÆæßÉ !"#¤%&\'()*+,-./0123456789:;<=>?'
+         u'¡ABCDEFGHIJKLMNOPQRSTUVWXYZÄÖÑÜ§¿abcdefghijklmnopqrstuvwxyzäöñüà')
+_GSM7_EXT = {0x0A: u'\f', 0x14: u'^', 0x28: u'{', 0x29: u'}', 0x2F: u'\\', 0x3C: u'[', 0x3D: u'~', 0x3E: u']',
+             0x40: u'|', 0x65: u'€'}
+_GSM7_ESCAPE = 0x1B
+_GSM7_CODES = dict((char, code) for code, char in enumerate(_GSM7) if code != _GSM7_ESCAPE)
+_GSM7_EXT_CODES = dict((char, code) for code, char in _GSM7_EXT.items())
+
+# TP-Data-Coding-Scheme alphabets
+DCS_GSM7, DCS_8BIT, DCS_UCS2 = 0x00, 0x04, 0x08
+
+# TP-Message-Type-Indicator of the first octet
+MTI_DELIVER, MTI_SUBMIT = 0x00, 0x01
+_UDHI, _SRR, _VPF = 0x40, 0x20, 0x18
+
+# Type of address: international number, unknown, and alphanumeric ones
+TOA_INTERNATIONAL, TOA_UNKNOWN, TOA_ALPHANUMERIC = 0x91, 0x81, 0xD0
+
+# Concatenated short messages information elements, with 8 and 16 bit references
+IEI_CONCAT_8BIT, IEI_CONCAT_16BIT = 0x00, 0x08
+
+# Max user data of a part, in septets or octets, alone or with the concatenation header
+MAX_SEPTETS, MAX_CONCAT_SEPTETS = 160, 153
+MAX_OCTETS, MAX_CONCAT_OCTETS = 140, 134
+
+_SEMI_OCTETS = '0123456789*#abc'
+
+
+def _hex(octets):
+    return binascii.hexlify(bytes(octets)).decode('ascii').upper()
+
+
+def _gsm7_septets(text):
+    """Septets of text in the default alphabet, None if it has other characters"""
+    septets = []
+    for char in text:
+        if char in _GSM7_CODES:
+            septets.append(_GSM7_CODES[char])
+        elif char in _GSM7_EXT_CODES:
+            septets.extend((_GSM7_ESCAPE, _GSM7_EXT_CODES[char]))
+        else:
+            return None
+    return septets
+
+
+def _gsm7_text(septets):
+    chars, escaped = [], False
+    for septet in septets:
+        if escaped:
+            chars.append(_GSM7_EXT.get(septet, u' '))
+            escaped = False
+        elif septet == _GSM7_ESCAPE:
+            escaped = True
+        else:
+            chars.append(_GSM7[septet])
+    return u''.join(chars)
+
+
+def pack_septets(septets, padding=0):
+    """Septets packed in octets, after padding fill bits to align them after a user data header"""
+    octets = bytearray()
+    acc, bits = 0, padding
+    for septet in septets:
+        acc |= septet << bits
+        bits += 7
+        while bits >= 8:
+            octets.append(acc & 0xFF)
+            acc, bits = acc >> 8, bits - 8
+    if bits:
+        octets.append(acc & 0xFF)
+    return octets
+
+
+def unpack_septets(octets, count, padding=0):
+    """count septets packed in octets, skipping padding fill bits"""
+    septets = []
+    acc, bits = 0, 0
+    for octet in octets:
+        acc |= octet << bits
+        bits += 8
+        if padding:
+            acc, bits, padding = acc >> padding, bits - padding, 0
+        while bits >= 7 and len(septets) < count:
+            septets.append(acc & 0x7F)
+            acc, bits = acc >> 7, bits - 7
+    return septets
+
+
+def _semi_octets(digits):
+    if len(digits) % 2:
+        digits += 'F'
+    return bytearray(int(digits[i + 1] + digits[i], 16) for i in range(0, len(digits), 2))
+
+
+def _digits(octets, count=None):
+    digits = ''.join(_SEMI_OCTETS[octet & 0x0F] + _SEMI_OCTETS[octet >> 4] if octet >> 4 != 0x0F
+                     else _SEMI_OCTETS[octet & 0x0F] for octet in octets)
+    return digits[:count] if count is not None else digits
+
+
+def _encode_address(number):
+    """TP-DA of number, international if it starts with +"""
+    digits = number.lstrip('+')
+    assert digits.isdigit(), "Invalid number " + number
+    return bytearray([len(digits), TOA_INTERNATIONAL if number.startswith('+') else TOA_UNKNOWN]) + _semi_octets(digits)
+
+
+def _encode_smsc(smsc):
+    """SMSC information before the TPDU. 00 to use the one set in the SIM card"""
+    if smsc is None:
+        return bytearray([0])
+    address = _encode_address(smsc)
+    return bytearray([len(address) - 1]) + address[1:]
+
+
+def _decode_address(octets, offset):
+    """(number, offset after it) of the TP-OA or TP-DA at offset. Its length is in semi-octets"""
+    length, toa = octets[offset], octets[offset + 1]
+    value = octets[offset + 2:offset + 2 + (length + 1) // 2]
+    if toa & 0x70 == TOA_ALPHANUMERIC & 0x70:
+        number = _gsm7_text(unpack_septets(value, length * 4 // 7))
+    else:
+        number = ('+' if toa & 0x70 == TOA_INTERNATIONAL & 0x70 else '') + _digits(value, length)
+    return number, offset + 2 + (length + 1) // 2
+
+
+def _decode_smsc(octets):
+    """(SMSC number or None, offset of the TPDU)"""
+    length = octets[0]
+    if not length:
+        return None, 1
+    toa, digits = octets[1], _digits(octets[2:1 + length])
+    return ('+' if toa & 0x70 == TOA_INTERNATIONAL & 0x70 else '') + digits, 1 + length
+
+
+def _decode_timestamp(octets):
+    fields = ['%d%d' % (octet & 0x0F, octet >> 4) for octet in octets[:6]]
+    zone = octets[6]
+    quarters = (zone & 0x07) * 10 + (zone >> 4)
+    return (fields[0] + '/' + fields[1] + '/' + fields[2] + ',' + fields[3] + ':' + fields[4] + ':' + fields[5] +
+            ('-' if zone & 0x08 else '+') + '%02d' % quarters)
+
+
+def _encode_timestamp(timestamp):
+    """Octets of a 'yy/MM/dd,hh:mm:ss+zz' timestamp"""
+    zone = int(timestamp[18:20])
+    octets = _semi_octets(timestamp[0:2] + timestamp[3:5] + timestamp[6:8] + timestamp[9:11] + timestamp[12:14] + timestamp[15:17])
+    return octets + bytearray([(zone % 10) << 4 | zone // 10 | (0x08 if timestamp[17] == '-' else 0)])
+
+
+def _alphabet(dcs):
+    """DCS_* of a TP-Data-Coding-Scheme"""
+    if dcs & 0xC0 in (0x00, 0x40): # General data coding, maybe marked for automatic deletion
+        if dcs & 0x20 or dcs & 0x0C == 0x0C: # Compressed texts, and the reserved alphabet, are left as data
+            return DCS_8BIT
+        return dcs & 0x0C
+    if dcs & 0xF0 == 0xF0:
+        return dcs & DCS_8BIT
+    return DCS_UCS2 if dcs & 0xF0 == 0xE0 else DCS_GSM7 # Message waiting indications
+
+
+def _user_data_parts(text):
+    """(DCS, list of user data per part) of text, without headers. A single part if it
+    fits in a message, otherwise as big as they fit with the concatenation header"""
+    septets = _gsm7_septets(text)
+    if septets is not None:
+        if len(septets) <= MAX_SEPTETS:
+            return DCS_GSM7, [septets]
+        parts, start = [], 0
+        while start < len(septets):
+            end = min(start + MAX_CONCAT_SEPTETS, len(septets))
+            if end < len(septets) and septets[end - 1] == _GSM7_ESCAPE: # Not to split an escaped character
+                end -= 1
+            parts.append(septets[start:end])
+            start = end
+        return DCS_GSM7, parts
+
+    data = bytearray(codecs.encode(text, 'utf-16-be'))
+    if len(data) <= MAX_OCTETS:
+        return DCS_UCS2, [data]
+    parts, start = [], 0
+    while start < len(data):
+        end = min(start + MAX_CONCAT_OCTETS, len(data))
+        if end < len(data) and 0xD8 <= data[end - 2] <= 0xDB: # Not to split a surrogate pair
+            end -= 2
+        parts.append(data[start:end])
+        start = end
+    return DCS_UCS2, parts
+
+
+def _encode_tpdus(first, header, text, reference):
+    """Common part of SMS-SUBMIT and SMS-DELIVER: header is the TPDU up to the TP-PID
+    excluded, and the rest is built around the user data of each part"""
+    if not isinstance(text, type(u'')):
+        text = text.decode('utf-8')
+    dcs, parts = _user_data_parts(text)
+    tpdus = []
+    for seq, data in enumerate(parts, 1):
+        udh = bytearray()
+        if len(parts) > 1:
+            udh = bytearray([5, IEI_CONCAT_8BIT, 3, reference & 0xFF, len(parts), seq])
+        if dcs == DCS_GSM7:
+            header_septets = (len(udh) * 8 + 6) // 7
+            user_data = udh + pack_septets(data, header_septets * 7 - len(udh) * 8)
+            length = header_septets + len(data)
+        else:
+            user_data, length = udh + data, len(udh) + len(data)
+        tpdus.append((bytearray([first | (_UDHI if udh else 0)]), header, dcs, length, user_data))
+    return tpdus
+
+
+def encode_sms(number, text, smsc=None, reference=0, status_report=False):
+    """SMS-SUBMIT PDUs of text to number, several concatenated ones if it does not fit in one.
+    Returns the list of (TPDU length, PDU hex string), as AT+CMGS takes them.
+    - smsc: SMSC number, the one of the SIM card by default
+    - reference: concatenated message reference, the same for all the parts
+    - status_report: request a status report for each part"""
+    tpdus = []
+    for first, header, dcs, length, user_data in _encode_tpdus(MTI_SUBMIT | (_SRR if status_report else 0),
+                                                               _encode_address(number), text, reference):
+        # TP-MR 0 lets the modem set the message reference
+        tpdu = first + bytearray([0]) + header + bytearray([0, dcs, length]) + user_data
+        tpdus.append((len(tpdu), _hex(_encode_smsc(smsc) + tpdu)))
+    return tpdus
+
+
+def encode_deliver(sender, text, timestamp=None, smsc=None, reference=0):
+    """SMS-DELIVER PDUs, as the network sends them, i.e. to emulate received messages.
+    - timestamp: 'yy/MM/dd,hh:mm:ss+zz', now in UTC by default"""
+    timestamp = timestamp or time.strftime('%y/%m/%d,%H:%M:%S+00', time.gmtime())
+    return [_hex(_encode_smsc(smsc) + first + header + bytearray([0, dcs]) + _encode_timestamp(timestamp) +
+                 bytearray([length]) + user_data)
+            for first, header, dcs, length, user_data in _encode_tpdus(MTI_DELIVER, _encode_address(sender), text, reference)]
+
+
+def decode_pdu(pdu, index=None, stat=None):
+    """Sms of an SMS-DELIVER or SMS-SUBMIT PDU hex string, with the SMSC information.
+    Raises ValueError if it is malformed or of another type."""
+    try:
+        octets = bytearray(binascii.unhexlify(pdu.strip()))
+        smsc, offset = _decode_smsc(octets)
+        first = octets[offset]
+        mti = first & 0x03
+        if mti == MTI_DELIVER:
+            number, offset = _decode_address(octets, offset + 1)
+            dcs = octets[offset + 1]
+            timestamp = _decode_timestamp(octets[offset + 2:offset + 9])
+            offset += 9
+        elif mti == MTI_SUBMIT:
+            number, offset = _decode_address(octets, offset + 2) # After TP-MR
+            dcs = octets[offset + 1]
+            vpf = first & _VPF
+            offset += 2 + (0 if not vpf else 1 if vpf == 0x10 else 7)
+            timestamp = None
+        else:
+            raise ValueError('Unsupported message type ' + str(mti))
+
+        length, user_data = octets[offset], octets[offset + 1:]
+        alphabet, concat, udh_length = _alphabet(dcs), None, 0
+        if first & _UDHI:
+            udh_length = user_data[0] + 1
+            i = 1
+            while i + 1 < udh_length:
+                iei, iel = user_data[i], user_data[i + 1]
+                if iei == IEI_CONCAT_8BIT and iel == 3:
+                    concat = (user_data[i + 2], user_data[i + 3], user_data[i + 4])
+                elif iei == IEI_CONCAT_16BIT and iel == 4:
+                    concat = (user_data[i + 2] << 8 | user_data[i + 3], user_data[i + 4], user_data[i + 5])
+                i += 2 + iel
+
+        if alphabet == DCS_GSM7:
+            header_septets = (udh_length * 8 + 6) // 7
+            septets = unpack_septets(user_data[udh_length:], length - header_septets, header_septets * 7 - udh_length * 8)
+            text = _gsm7_text(septets)
+        elif alphabet == DCS_UCS2:
+            text = codecs.decode(bytes(user_data[udh_length:length]), 'utf-16-be')
+        else:
+            text = bytes(user_data[udh_length:length])
+    except (IndexError, TypeError, binascii.Error, UnicodeDecodeError) as e:
+        raise ValueError('Malformed PDU ' + pdu + ': ' + repr(e))
+    return Sms(index, stat, number, smsc, timestamp, text, concat)
+
+
+class Reassembler(object):
+    """Joins the parts of concatenated messages, which may come in any order.
+    Parts are kept by originator and reference until all of them are added, or
+    for max_age seconds."""
+
+    def __init__(self, max_age=86400):
+        """- max_age: seconds to keep incomplete messages, None for ever"""
+        self.max_age = max_age
+        self._parts = {} # (number, reference, parts) -> (time of the first one, {part: Sms})
+
+    def __len__(self):
+        return len(self._parts)
+
+    def add(self, sms):
+        """The whole message once its last part is added, sms itself if it is not a part, None otherwise"""
+        if sms.concat is None:
+            return sms
+        reference, count, part = sms.concat
+        key = (sms.number, reference, count)
+        parts = self._parts.setdefault(key, (time.time(), {}))[1]
+        parts[part] = sms
+        if len(parts) < count:
+            return None
+
+        del self._parts[key]
+        parts = [parts[part] for part in sorted(parts)]
+        text = parts[0].text[:0].join(part.text for part in parts) # Text or data
+        indexes = tuple(part.index for part in parts)
+        return parts[0]._replace(index=indexes if any(index is not None for index in indexes) else None,
+                                 text=text, concat=None)
+
+    def expire(self, max_age=None):
+        """Take out the parts of the messages incomplete for max_age seconds, all of them with 0.
+        Returns the list of their Sms, so they can be deleted"""
+        max_age = self.max_age if max_age is None else max_age
+        if max_age is None:
+            return []
+        now, expired = time.time(), []
+        for key, (first, parts) in list(self._parts.items()):
+            if now - first >= max_age:
+                del self._parts[key]
+                expired += [parts[part] for part in sorted(parts)]
+        return expired
+
+
+def iter_messages(lines, reassemble=True):
+    """Generator of the Sms listed in AT+CMGL response lines, decoded as they are
+    iterated. With reassemble, concatenated messages come once all their parts do,
+    and the parts of incomplete ones at the end, so they can still be deleted.
+    Malformed ones are skipped."""
+    logger = logging.getLogger('carrierwatchdog.modem')
+    reassembler = Reassembler(max_age=None) if reassemble else None
+    header = None
+    for line in lines:
+        if header is None:
+            header = parse_cmgl(line)
+            continue
+        try:
+            sms = decode_pdu(line, int(header.index), int(header.stat))
+        except ValueError as e:
+            logger.warning('Skipped message ' + header.index + ': ' + str(e))
+            sms = None
+        header = None
+        if sms is not None and reassembler is not None:
+            sms = reassembler.add(sms)
+        if sms is not None:
+            yield sms
+
+    if reassembler is not None:
+        for sms in reassembler.expire(0):
+            yield sms
+
+
+class SmsSender(object):
+    """Queue of messages sent by a thread, so callers don't wait for the network
+    acknowledges. The messages queued while a batch is being sent go together in
+    the next one, with GSMModem.send_sms_batch, so they are entered back to back
+    on a link to the SMSC kept open.
+
+    Batches go through scheduler if given, or straight to the modem otherwise, whose
+    lock keeps other threads from writing between a prompt and its message."""
+
+    def __init__(self, modem, status_report=False, batch=20, scheduler=None):
+        """- status_report: request status reports of the messages
+        - batch: max messages per batch
+        - scheduler: ModemScheduler of the modem, if the caller uses one"""
+        self.modem = modem
+        self.scheduler = scheduler
+        self.status_report = status_report
+        self.batch = batch
+        self._queue = queue.Queue()
+        self._thread = None
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def send(self, number, text):
+        """Queue a message. Returns a ScheduledRequest, whose result is the
+        (status, command, message references) of the message, as per send_sms"""
+        request = ScheduledRequest(None)
+        self._queue.put((number, text, request))
+        if self._thread is None:
+            self.start()
+        return request
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop once the messages queued are sent"""
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            messages = [self._queue.get()]
+            while len(messages) < self.batch: # Whatever else is queued by now
+                try:
+                    messages.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in messages
+            messages = [message for message in messages if message is not None]
+            if messages:
+                self._send(messages)
+            if stopping and self._queue.empty():
+                return
+
+    def _send(self, messages):
+        args = ([message[:2] for message in messages], self.status_report)
+        try:
+            if self.scheduler is not None:
+                status, command, results = self.scheduler.submit('send_sms_batch', args).result()
+            else:
+                status, command, results = self.modem.send_sms_batch(*args)
+        except Exception as e:
+            self._logger.error('SMS batch failed: ' + repr(e))
+            for message in messages:
+                message[2]._finish(None, e)
+            return
+        for message, result in zip(messages, results):
+            message[2]._finish(result, None)
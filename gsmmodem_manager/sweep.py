@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+"""Qualification of operators and access technologies: every (plmn, act) cell
+of a matrix is tested on one of several modems, in parallel."""
+
+import time
+import threading
+import logging
+from collections import namedtuple
+
+try:
+    import Queue as queue # python 2
+except ImportError:
+    import queue
+
+from .pool import ModemPool
+
+# Outcome of a cell. skipped when no modem scan shows it available, with modem and result None.
+# Otherwise either result or error is set.
+SweepResult = namedtuple('SweepResult', ['plmn', 'act', 'modem', 'skipped', 'result', 'error', 'elapsed'])
+
+
+def qualify(modem, plmn, act, timeout=60):
+    """Default test of a cell: select act and plmn (only what differs from the
+    current configuration), wait for the registration, activate the PDP context,
+    and take the signal quality and registration info before deactivating it.
+    The response is a dictionary of what was measured, with the seconds taken to
+    register and to attach."""
+    config = {'operator': plmn}
+    if act is not None:
+        config['act'] = act
+
+    start = time.time()
+    status, command, response = modem.apply_config(config)
+    if status:
+        status, command, response = modem.wait_for_registration(timeout=timeout)
+    if not status:
+        return False, command, response
+    report = {'registration_time': time.time() - start}
+
+    start = time.time()
+    status, command, response = modem.activate_pdp_context()
+    if status:
+        status, command, response = modem.wait_for_pdp_attach(timeout=timeout)
+    if not status:
+        return False, command, response
+    report['pdp_attach_time'] = time.time() - start
+
+    status, command, sq = modem.get_signal_quality()
+    if status:
+        report['rssi'], report['ber'] = sq.split(',')
+        report['rssi_dBm'] = modem.sq_to_rssidBm(report['rssi'])[0]
+    status, command, reg = modem.get_registration_info()
+    if status:
+        report.update(reg)
+
+    status, command, response = modem.deactivate_pdp_context()
+    return status, command, report
+
+
+def sweep(modems, plmns, acts, cell=qualify, scan=True, max_age=None):
+    """Test every (plmn, act) pair, splitting them across modems, all of the same
+    class as the ACT codes differ among models. Generator yielding a SweepResult as
+    soon as each cell is done, skipped ones first.
+    - cell: callable testing a cell, cell(modem, plmn, act). qualify by default
+    - scan: scan the networks first on every modem, in parallel, to skip the cells
+      none of them sees available. See GSMModem.scan_networks
+    - max_age: seconds a cached scan is valid, as per scan_networks"""
+    modems = list(modems)
+    logger = logging.getLogger('carrierwatchdog.modem')
+    cells = [(plmn, act) for plmn in plmns for act in acts]
+
+    if scan and modems:
+        scans = []
+        for res in ModemPool(modems, max_workers=len(modems)).run(lambda modem: modem.scan_networks(max_age=max_age)):
+            if res.error is None and res.result[0]:
+                scans.append((res.modem, res.result[2]))
+            else:
+                logger.warning('Network scan failed on ' + str(res.modem) + ', its cells are not skipped')
+        if scans: # Otherwise nothing is known to be unavailable
+            available = [(plmn, act) for plmn, act in cells
+                         if any(modem.network_available(networks, plmn, act) for modem, networks in scans)]
+            for plmn, act in cells:
+                if (plmn, act) not in available:
+                    yield SweepResult(plmn, act, None, True, None, None, 0)
+            cells = available
+
+    tasks, results = queue.Queue(), queue.Queue()
+    for task in cells:
+        tasks.put(task)
+
+    def worker(modem):
+        while True:
+            try:
+                plmn, act = tasks.get_nowait()
+            except queue.Empty:
+                return
+            start = time.time()
+            try:
+                result, error = cell(modem, plmn, act), None
+            except Exception as e:
+                logger.error('Sweep of ' + str(plmn) + '/' + str(act) + ' failed on ' + str(modem) + ': ' + repr(e))
+                result, error = None, e
+            results.put(SweepResult(plmn, act, modem, False, result, error, time.time() - start))
+
+    for modem in modems[:len(cells)]: # One thread per modem, as its cells run one after another
+        thread = threading.Thread(target=worker, args=(modem,))
+        thread.daemon = True
+        thread.start()
+
+    for _ in range(len(cells) if modems else 0):
+        yield results.get()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import logging
+
+try:
+    import Queue as queue # python 2
+except ImportError:
+    import queue
+
+
+class UrcDispatcher(object):
+    """Tells unsolicited result codes (URC) apart from command responses and
+    delivers them to the subscribers of their prefix."""
+
+    def __init__(self, prefixes):
+        """- prefixes: tuple of line prefixes considered as URC, i.e. GSMModem.URC_PREFIXES"""
+        self.prefixes = tuple(prefixes)
+        self._subscribers = {} # prefix -> list of callbacks
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def subscribe(self, prefix, callback=None, maxsize=100):
+        """Deliver every URC starting with prefix ('' for all of them).
+        - callback: called with the URC line. Called from the reader thread
+          when there's one running, so it must not block.
+        - maxsize: if no callback is given, URCs are put in a queue of this size
+        Returns the callback or the queue, needed to unsubscribe."""
+        if callback is None:
+            subscriber = queue.Queue(maxsize)
+            callback = self._enqueue(subscriber)
+            callback.subscriber = subscriber
+        else:
+            subscriber = callback
+
+        self._subscribers.setdefault(prefix, []).append(callback)
+        return subscriber
+
+    def unsubscribe(self, prefix, subscriber):
+        callbacks = self._subscribers.get(prefix, [])
+        callbacks[:] = [callback for callback in callbacks
+                        if callback is not subscriber and getattr(callback, 'subscriber', None) is not subscriber]
+
+    def is_unsolicited(self, line, command=None):
+        """Whether line is a URC or belongs to the response of the running command"""
+        if not line.startswith(self.prefixes):
+            return False
+        if command is not None:
+            # The response to a command carries its name, i.e. AT+CREG? is answered with +CREG:
+            # Several commands can be concatenated, i.e. AT+CSQ;+CREG?
+            for name in command[2:].split(';'):
+                name = name.split('=')[0].split('?')[0]
+                if name and line.startswith(name + ':'):
+                    return False
+        return True
+
+    def dispatch(self, line):
+        for prefix, callbacks in list(self._subscribers.items()):
+            if line.startswith(prefix):
+                for callback in list(callbacks):
+                    try:
+                        callback(line)
+                    except Exception as e:
+                        self._logger.error('URC subscriber failed on ' + line + ': ' + repr(e))
+
+    def _enqueue(self, subscriber):
+        def callback(line):
+            try:
+                subscriber.put_nowait(line)
+            except queue.Full:
+                self._logger.warning('URC queue full, discarded: ' + line)
+        return callback
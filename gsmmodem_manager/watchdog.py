@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import time
+import threading
+import logging
+from collections import namedtuple, deque
+
+from .metrics import Metrics
+from .scheduler import ModemScheduler
+
+# Outcome of a recovery. stages is the list of (stage, seconds, healthy) run, stage the
+# one which recovered the modem and time_to_recover the seconds since detected, both
+# None if none did.
+Recovery = namedtuple('Recovery', ['reason', 'detected', 'recovered', 'stage', 'time_to_recover', 'stages'])
+
+
+class ModemWatchdog(object):
+    """Checks the health of a modem every interval seconds and recovers it when it
+    stalls: commands not answered, error streaks, or registration or PDP context
+    lost. Recovery escalates through STAGES, the cheapest first, and stops as soon
+    as the modem registers again, waiting for it instead of sleeping fixed times:
+        reopen: close and reopen the port, and handshake
+        soft_reset: ATZ, back to the stored profile
+        reset: reboot with AT^RESET, on modems supporting it
+        reconfigure: apply_config(config), if a config is given
+    Command failures are watched through the modem Metrics, so streaks are noticed
+    on the commands of any caller, waking the watchdog up before the next check.
+
+    The watchdog thread sends its probes through scheduler if given, ahead of other
+    requests, or straight to the modem otherwise, between those of other threads.
+    The reader thread is started again after reopening the port if it was running."""
+
+    STAGES = ('reopen', 'soft_reset', 'reset', 'reconfigure')
+
+    TIMEOUT_STREAK = 2 # Commands in a row without final result code to declare a stall
+    ERROR_STREAK = 5 # Commands in a row answered with an error
+    ERROR_CODES = ('ERROR', '+CME ERROR:', '+CMS ERROR:')
+
+    REGISTRATION_TIMEOUT = 30 # Seconds to register again after each stage
+    REBOOT_TIMEOUT = 60 # Seconds for the modem to come back after AT^RESET
+    DETACH_TIMEOUT = 3 # Seconds for the port to disappear after AT^RESET
+
+    def __init__(self, modem, config=None, interval=30, pdp=False, history=100, scheduler=None):
+        """- config: desired configuration, as per apply_config
+        - pdp: whether the PDP context must be attached too
+        - history: number of Recovery kept
+        - scheduler: ModemScheduler of the modem, if the caller uses one"""
+        self.modem = modem
+        self.scheduler = scheduler
+        self.config = config
+        self.interval = interval
+        self.pdp = pdp
+        self.history = deque(maxlen=history)
+        self._hooks = []
+        self._device = modem.get_serial_conf()['devicefile']
+        self._timeouts, self._errors = 0, 0
+        self._metrics, self._own_metrics = None, False
+        self._on_command = self._on_command # The same bound method is needed to remove the hook
+        self._thread, self._stop, self._wakeup = None, threading.Event(), threading.Event()
+        self._logger = logging.getLogger('carrierwatchdog.modem')
+
+    def add_hook(self, callback):
+        """callback is called with the Recovery of every outage"""
+        self._hooks.append(callback)
+
+    def remove_hook(self, callback):
+        self._hooks.remove(callback)
+
+    def _on_command(self, sample):
+        if sample.device != self._device:
+            return
+        if sample.code == 'TIMEOUT':
+            self._timeouts, self._errors = self._timeouts + 1, 0
+        elif sample.code.startswith(self.ERROR_CODES):
+            self._timeouts, self._errors = 0, self._errors + 1
+        else:
+            self._timeouts, self._errors = 0, 0
+        if self._timeouts >= self.TIMEOUT_STREAK or self._errors >= self.ERROR_STREAK:
+            self._wakeup.set()
+
+    def _watch_commands(self):
+        self._metrics = self.modem._metrics
+        if self._metrics is None: # Counted only for the watchdog then
+            self._metrics, self._own_metrics = Metrics(), True
+            self.modem.set_metrics(self._metrics)
+        self._metrics.add_hook(self._on_command)
+
+    def _unwatch_commands(self):
+        self._metrics.remove_hook(self._on_command)
+        if self._own_metrics and self.modem._metrics is self._metrics:
+            self.modem.set_metrics(None)
+        self._metrics, self._own_metrics = None, False
+
+    def _call(self, name, *args, **kwargs):
+        if self.scheduler is not None:
+            return self.scheduler.submit(name, args, kwargs, priority=ModemScheduler.PRIORITY_CONTROL).result()
+        return getattr(self.modem, name)(*args, **kwargs)
+
+    def check(self):
+        """Why the modem is unhealthy, None if it is fine"""
+        if self._timeouts >= self.TIMEOUT_STREAK:
+            return str(self._timeouts) + ' commands without final result code'
+        if self._errors >= self.ERROR_STREAK:
+            return str(self._errors) + ' commands failed in a row'
+        try:
+            status, command, reg = self._call('get_registration_info')
+            if not status:
+                return 'Registration info failed with: ' + str(reg)
+            if reg.get('stat') not in (self.modem.STAT_REGHOME, self.modem.STAT_REGROAM):
+                return 'Not registered, status ' + str(reg.get('stat'))
+            if self.pdp:
+                status, command, pdp = self._call('get_pdp_context')
+                if not status or not pdp['pdp_attached']:
+                    return 'PDP context detached'
+        except Exception as e: # i.e. the port is gone
+            return 'Check failed: ' + repr(e)
+        return None
+
+    def stages(self):
+        """STAGES applicable to the modem"""
+        return [stage for stage in self.STAGES if (stage != 'reset' or hasattr(self.modem, 'reset_modem'))
+                and (stage != 'reconfigure' or self.config)]
+
+    def recover(self, reason):
+        """Run the recovery stages until the modem is healthy. Returns a Recovery"""
+        detected = time.time()
+        self._logger.warning('Recovering ' + self._device + ': ' + reason)
+        stages, healthy, stage = [], False, None
+        for stage in self.stages():
+            start = time.time()
+            try:
+                getattr(self, '_' + stage)()
+                self._timeouts, self._errors = 0, 0 # Whatever failed before the stage
+                healthy = self._settle()
+            except Exception as e:
+                self._logger.error('Recovery stage ' + stage + ' failed: ' + repr(e))
+                healthy = False
+            stages.append((stage, time.time() - start, healthy))
+            if healthy:
+                break
+
+        self._timeouts, self._errors = 0, 0
+        if healthy:
+            recovery = Recovery(reason, detected, True, stage, time.time() - detected, stages)
+            self._logger.warning('Recovered ' + self._device + ' by ' + stage + ' in %.1fs' % recovery.time_to_recover)
+        else:
+            recovery = Recovery(reason, detected, False, None, None, stages)
+            self._logger.error('Could not recover ' + self._device)
+        self.history.append(recovery)
+        for hook in self._hooks:
+            try:
+                hook(recovery)
+            except Exception as e:
+                self._logger.error('Watchdog hook failed: ' + repr(e))
+        return recovery
+
+    def _settle(self):
+        """Wait for the modem to register, and attach if needed, then check it"""
+        if not self._call('wait_for_registration', timeout=self.REGISTRATION_TIMEOUT)[0]:
+            return False
+        if self.pdp:
+            status, command, pdp = self._call('get_pdp_context')
+            if status and pdp['pdp_attached']:
+                return self.check() is None
+            self._call('activate_pdp_context')
+            if not self._call('wait_for_pdp_attach', timeout=self.REGISTRATION_TIMEOUT)[0]:
+                return False
+        return self.check() is None
+
+    # The port stages hold the modem lock, so no command of other threads, or of the
+    # scheduler, finds the port closed or the echo back on halfway through
+
+    def _reopen(self):
+        with self.modem._lock:
+            reader = self.modem.reader_running()
+            self.modem.close_connection()
+            if not self.modem.connect()[0]:
+                raise IOError('No answer to the handshake')
+            if reader:
+                self.modem.start_reader()
+
+    def _soft_reset(self):
+        with self.modem._lock:
+            if not self.modem.reset_modem_default()[0]:
+                raise IOError('ATZ failed')
+            self.modem.handshake() # Echo is back on
+
+    def _reset(self):
+        with self.modem._lock: # Not while it reboots, commands fail meanwhile anyway
+            reader = self.modem.reader_running()
+            self.modem.reset_modem()
+            self.modem.close_connection()
+        deadline = time.time() + self.DETACH_TIMEOUT
+        while os.path.exists(self._device) and time.time() < deadline: # Rebooting drops it from the USB bus
+            time.sleep(0.1)
+
+        deadline = time.time() + self.REBOOT_TIMEOUT
+        while True:
+            try:
+                with self.modem._lock:
+                    if os.path.exists(self._device) and self.modem.connect(retries=2)[0]:
+                        if reader:
+                            self.modem.start_reader()
+                        return
+            except Exception as e: # Not enumerated yet
+                self._logger.debug('Waiting for ' + self._device + ': ' + repr(e))
+            if time.time() >= deadline:
+                raise IOError('Modem did not come back after reset')
+            time.sleep(0.5)
+
+    def _reconfigure(self):
+        if not self._call('apply_config', self.config)[0]:
+            raise IOError('Configuration failed')
+
+    def start(self):
+        """Check and recover on a thread, until stop"""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._watch_commands()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._stop.set()
+            self._wakeup.set()
+            thread.join()
+            self._unwatch_commands()
+
+    def _run(self):
+        while not self._stop.is_set():
+            reason = self.check()
+            if reason is not None and not self._stop.is_set():
+                self.recover(reason)
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def stats(self):
+        """Outages in history, how many were recovered, and their time to recover"""
+        times = [recovery.time_to_recover for recovery in self.history if recovery.recovered]
+        stages = dict((stage, 0) for stage in self.STAGES)
+        for recovery in self.history:
+            if recovery.recovered:
+                stages[recovery.stage] += 1
+        return {'outages': len(self.history), 'recovered': len(times), 'failed': len(self.history) - len(times),
+                'mean_time_to_recover': sum(times) / len(times) if times else None,
+                'max_time_to_recover': max(times) if times else None, 'recovered_by_stage': stages}
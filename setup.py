@@ -21,4 +21,7 @@ setup(name='gsmmodem_manager',
       install_requires=[
           'pyserial',
       ],
+      extras_require={
+          'numpy': ['numpy'], # Faster bulk RSSI conversions in gsmmodem_manager.rssi
+      },
 )
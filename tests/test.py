@@ -13,16 +13,23 @@ parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
 # Now it can be imported :)
+# Use "emulator" as device file to test against a virtual modem, no hardware needed
+devicefile = len(sys.argv) >= 2 and sys.argv[1] or '/dev/ttyUSB0'
+if devicefile == 'emulator':
+    from gsmmodem_manager.emulator import ModemEmulator
+    emulator = ModemEmulator('MS2131')
+    devicefile = emulator.devicefile
+
 from gsmmodem_manager import HuaweiMS2131
-modem = HuaweiMS2131(len(sys.argv) >= 2 and sys.argv[1] or '/dev/ttyUSB0', '9600')
+modem = HuaweiMS2131(devicefile, '9600')
 
 # The testing suite also works with HuaweiMS2372h
 # from gsmmodem_manager import HuaweiMS2372h
-# modem = HuaweiMS2372h(len(sys.argv) >= 2 and sys.argv[1] or '/dev/ttyUSB0', 115200)
+# modem = HuaweiMS2372h(devicefile, 115200)
 
 # The testing suite also works with HuaweiE3372
 # from gsmmodem_manager import HuaweiE3372
-# modem = HuaweiE3372(len(sys.argv) >= 2 and sys.argv[1] or '/dev/ttyUSB0', 115200)
+# modem = HuaweiE3372(devicefile, 115200)
 
 def test_generic_commands(modem):
     print modem.get_imsi()
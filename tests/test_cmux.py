@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import time
+import unittest
+import binascii
+
+from gsmmodem_manager import HuaweiE3372
+from gsmmodem_manager.cmux import fcs, encode_frame, FrameDecoder, Frame, SABM, UA, DM, UIH, FLAG
+from gsmmodem_manager.emulator import ModemEmulator
+
+
+def unhex(text):
+    return binascii.unhexlify(text.encode('ascii'))
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_fcs(self):
+        # The receiver checks the frame with its FCS to the reversed polynomial remainder
+        data = bytearray(unhex('033f01'))
+        self.assertEqual(fcs(data), 0x1C)
+
+    def test_encode_control_frames(self):
+        # SABM and UA on the control channel, as per 3GPP TS 27.010 examples
+        self.assertEqual(encode_frame(0, SABM), unhex('f9033f011cf9'))
+        self.assertEqual(encode_frame(0, UA), unhex('f9037301d7f9'))
+
+    def test_encode_uih(self):
+        # No P/F bit, and only the header is checked
+        self.assertEqual(encode_frame(1, UIH, b'AT\r'), unhex('f907ef0741540dd3f9'))
+        self.assertEqual(encode_frame(1, UIH, b'AT\r')[-2], encode_frame(1, UIH, b'ATZ')[-2])
+
+    def test_encode_two_length_bytes(self):
+        frame = bytearray(encode_frame(2, UIH, b'x' * 200))
+        self.assertEqual(frame[3], (200 << 1) & 0xFE)
+        self.assertEqual(frame[4], 200 >> 7)
+        self.assertEqual(len(frame), 1 + 4 + 200 + 2)
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        decoder = FrameDecoder()
+        frames = decoder.feed(encode_frame(0, SABM) + encode_frame(3, UIH, b'OK\r\n', cr=False))
+        self.assertEqual(frames, [Frame(0, SABM, True, True, b''), Frame(3, UIH, False, False, b'OK\r\n')])
+
+    def test_byte_by_byte(self):
+        decoder, frames = FrameDecoder(), []
+        data = bytearray(encode_frame(1, UIH, b'+CSQ: 17,99') + encode_frame(1, DM, cr=False))
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+        self.assertEqual([frame.info for frame in frames], [b'+CSQ: 17,99', b''])
+        self.assertEqual(frames[1].control, DM)
+
+    def test_long_frame(self):
+        info = bytes(bytearray(range(256))) * 2
+        self.assertEqual(FrameDecoder().feed(encode_frame(2, UIH, info))[0].info, info)
+
+    def test_flag_in_information_field(self):
+        # The basic option does not escape flags, frames are delimited by their length
+        info = bytes(bytearray([FLAG, FLAG, 0x41, FLAG]))
+        self.assertEqual(FrameDecoder().feed(encode_frame(1, UIH, info))[0].info, info)
+
+    def test_shared_flags(self):
+        # The closing flag of a frame may open the next one
+        first, second = encode_frame(1, UIH, b'A'), encode_frame(2, UIH, b'B')
+        frames = FrameDecoder().feed(first + second[1:])
+        self.assertEqual([(frame.dlci, frame.info) for frame in frames], [(1, b'A'), (2, b'B')])
+
+    def test_corrupted_frame_skipped(self):
+        corrupted = bytearray(encode_frame(1, UIH, b'lost'))
+        corrupted[-2] ^= 0xFF
+        frames = FrameDecoder().feed(b'garbage' + bytes(corrupted) + encode_frame(1, UIH, b'kept'))
+        self.assertEqual([frame.info for frame in frames], [b'kept'])
+
+
+class MultiplexerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01)
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+        self.mux = self.modem.multiplex(2)
+
+    def tearDown(self):
+        self.mux.close()
+        self.emulator.close()
+
+    def test_channels(self):
+        first, second = self.mux.modem(1), self.mux.modem(2)
+        self.assertEqual(first.get_signal_quality(), (True, 'AT+CSQ', '17,99'))
+        self.assertEqual(second.get_imsi(), (True, 'AT+CIMI', self.emulator.imsi))
+        first.close_connection()
+        second.close_connection()
+
+    def test_full_channel_does_not_block(self):
+        channel = self.mux.modem(1)
+        start = time.time()
+        for _ in range(20): # Nobody reads channel 2
+            self.mux._deliver(2, b'x' * 1000)
+        self.assertLess(time.time() - start, 1)
+        self.assertLessEqual(len(self.mux._pending[2]), self.mux.BUFFER_SIZE)
+        self.assertTrue(channel.get_signal_quality()[0])
+        channel.close_connection()
+
+        os.read(self.mux._ptys[2][1], 1 << 16) # Room for the rest once read
+        deadline = time.time() + 2
+        while self.mux._pending[2] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.mux._pending[2]), 0)
+
+    def test_port_hang_up(self):
+        self.emulator.close() # Like the modem being unplugged
+        deadline = time.time() + 2
+        while self.mux.is_open() and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.mux.is_open())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gsmmodem_manager import HuaweiMS2131, HuaweiMS2372h, HuaweiE3372
+from gsmmodem_manager.discovery import ModemRegistry
+from gsmmodem_manager.emulator import ModemEmulator
+
+
+class ModemRegistryTest(unittest.TestCase):
+    """Emulated modems plugged in a fake sysfs tree"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sysfs, self.dev = os.path.join(self.root, 'sys'), os.path.join(self.root, 'dev')
+        os.makedirs(self.dev)
+        self.emulators = []
+        self.registry = ModemRegistry(sysfs=self.sysfs, dev=self.dev)
+        self.events = []
+        self.registry.subscribe(lambda action, modem: self.events.append((action, modem.devpath, modem.modem_class)))
+
+    def tearDown(self):
+        for emulator in self.emulators:
+            emulator.close()
+        shutil.rmtree(self.root)
+
+    def plug(self, devpath, product_id, model, tty, **kwargs):
+        emulator = ModemEmulator(model, latency=0.01, **kwargs)
+        self.emulators.append(emulator)
+        device = os.path.join(self.sysfs, 'bus', 'usb', 'devices', devpath)
+        os.makedirs(os.path.join(device, devpath + ':1.0', tty))
+        for name, value in (('idVendor', '12d1'), ('idProduct', product_id), ('serial', 'SN' + devpath)):
+            with open(os.path.join(device, name), 'w') as f:
+                f.write(value + '\n')
+        os.symlink(emulator.devicefile, os.path.join(self.dev, tty))
+        return emulator
+
+    def unplug(self, devpath):
+        shutil.rmtree(os.path.join(self.sysfs, 'bus', 'usb', 'devices', devpath))
+
+    def test_add_remove(self):
+        self.plug('1-1', '155e', 'E3372', 'ttyUSB0')
+        self.plug('1-2', '1506', 'MS2372h', 'ttyUSB1')
+        modems = self.registry.scan()
+        self.assertEqual([(modem.devpath, modem.devicefile, modem.modem_class) for modem in modems],
+                         [('1-1', os.path.join(self.dev, 'ttyUSB0'), HuaweiE3372),
+                          ('1-2', os.path.join(self.dev, 'ttyUSB1'), HuaweiMS2372h)]) # Told apart with AT+GMM
+        self.assertEqual(sorted(self.events), [('add', '1-1', HuaweiE3372), ('add', '1-2', HuaweiMS2372h)])
+
+        del self.events[:]
+        self.unplug('1-1')
+        self.assertEqual([modem.devpath for modem in self.registry.scan()], ['1-2'])
+        self.assertEqual(self.events, [('remove', '1-1', HuaweiE3372)])
+        self.assertEqual(self.emulators[1].commands.count('AT+GMM'), 1) # Probed once
+
+    def test_probe_retried(self):
+        emulator = self.plug('1-1', '1506', 'MS2372h', 'ttyUSB0', errors={'AT+GMM': 'ERROR'})
+        self.assertEqual(self.registry.scan()[0].modem_class, HuaweiMS2131) # The first candidate meanwhile
+        emulator.errors.clear()
+        self.assertEqual(self.registry.scan()[0].modem_class, HuaweiMS2372h)
+        self.assertEqual(self.events[-2:], [('remove', '1-1', HuaweiMS2131), ('add', '1-1', HuaweiMS2372h)])
+        self.registry.scan()
+        self.assertEqual(emulator.commands.count('AT+GMM'), 2) # Cached once it succeeded
+
+
+if __name__ == '__main__':
+    unittest.main()
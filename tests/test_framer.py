@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import fcntl
+import unittest
+
+from gsmmodem_manager.framer import LineFramer
+
+
+class LineFramerTest(unittest.TestCase):
+
+    def test_lines(self):
+        framer = LineFramer()
+        framer.feed(b'\r\n+CSQ: 17,99\r\n\r\nOK\r\n')
+        self.assertEqual(list(framer.lines()), ['+CSQ: 17,99', 'OK'])
+        self.assertEqual(list(framer.lines()), [])
+
+    def test_blanks(self):
+        framer = LineFramer()
+        framer.feed(b'  \t+COPS: 0 \r\r\n\n \r\nOK\n')
+        self.assertEqual(list(framer.lines()), ['+COPS: 0', 'OK'])
+
+    def test_partial_line(self):
+        framer = LineFramer()
+        framer.feed(b'+CREG: 0,1\r\nOK\r\n^RSS')
+        self.assertEqual(list(framer.lines()), ['+CREG: 0,1', 'OK'])
+        framer.feed(b'I: 21\r\n')
+        self.assertEqual(list(framer.lines()), ['^RSSI: 21'])
+
+    def test_lines_not_iterated_are_kept(self):
+        framer = LineFramer()
+        framer.feed(b'OK\r\n+CMTI: "SM",1\r\n')
+        lines = framer.lines()
+        self.assertEqual(next(lines), 'OK')
+        lines.close() # The caller stops at the final result code
+        self.assertEqual(list(framer.lines()), ['+CMTI: "SM",1'])
+
+    def test_prompt(self):
+        framer = LineFramer()
+        framer.feed(b'\r\n> ')
+        self.assertEqual(list(framer.lines()), ['>'])
+        framer.feed(b'>abc')
+        self.assertEqual(list(framer.lines()), [])
+
+    def test_pop_partial(self):
+        framer = LineFramer()
+        framer.feed(b'OK\r\n +CME ERR')
+        self.assertEqual(list(framer.lines()), ['OK'])
+        self.assertEqual(framer.pop_partial(), '+CME ERR')
+        self.assertEqual(framer.pop_partial(), '')
+
+    def test_long_data(self):
+        framer = LineFramer()
+        lines = ['+CMGL: ' + str(i) + ',1,,24' for i in range(2000)] # Well over CHUNK
+        data = ('\r\n'.join(lines) + '\r\n').encode('ascii')
+        for i in range(0, len(data), 1000):
+            framer.feed(data[i:i + 1000])
+        self.assertEqual(list(framer.lines()), lines)
+
+    def test_read(self):
+        r, w = os.pipe()
+        fcntl.fcntl(r, fcntl.F_SETFL, fcntl.fcntl(r, fcntl.F_GETFL) | os.O_NONBLOCK)
+        try:
+            framer = LineFramer()
+            self.assertEqual(framer.read(r), None) # Nothing to read
+            os.write(w, b'\r\nOK\r\n')
+            self.assertEqual(framer.read(r), 6)
+            self.assertEqual(list(framer.lines()), ['OK'])
+            os.close(w)
+            w = None
+            self.assertEqual(framer.read(r), 0)
+        finally:
+            os.close(r)
+            if w is not None:
+                os.close(w)
+
+
+if __name__ == '__main__':
+    unittest.main()
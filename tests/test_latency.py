@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import unittest
+
+from gsmmodem_manager import HuaweiE3372
+from gsmmodem_manager.latency import LatencyProfiles, command_key, MESSAGE_KEY
+
+
+class CommandKeyTest(unittest.TestCase):
+
+    def test_keys(self):
+        self.assertEqual(command_key('AT+CSQ'), 'AT+CSQ')
+        self.assertEqual(command_key('AT+COPS=?'), 'AT+COPS=?')
+        self.assertEqual(command_key('AT+CGATT=1'), 'AT+CGATT=1') # Not the same as detaching
+        self.assertEqual(command_key('AT+COPS=1,2,"21401"'), 'AT+COPS=1')
+        self.assertEqual(command_key('AT+CPIN="1234"'), 'AT+CPIN=')
+        self.assertEqual(command_key('AT+CSQ;+CGATT=0'), 'AT+CSQ;+CGATT=0')
+        self.assertEqual(command_key('AT+COPS=1,2,"21401"', argument=False), 'AT+COPS=')
+        self.assertEqual(command_key('0011000B914306' + '\x1a'), MESSAGE_KEY)
+
+
+class LatencyProfilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.profiles = LatencyProfiles()
+
+    def record(self, command, seconds, count=LatencyProfiles.MIN_SAMPLES):
+        for _ in range(count):
+            self.profiles.record(HuaweiE3372, '22.200.15.00.00', command, seconds)
+
+    def test_deadline(self):
+        self.record('AT+CSQ', 0.5, LatencyProfiles.MIN_SAMPLES - 1)
+        self.assertEqual(self.profiles.deadline(HuaweiE3372, '22.200.15.00.00', 'AT+CSQ', 2), 2) # Too few samples
+        self.record('AT+CSQ', 0.5)
+        self.assertAlmostEqual(self.profiles.deadline(HuaweiE3372, None, 'AT+CSQ', 2), 0.5 * LatencyProfiles.MARGIN)
+        self.assertEqual(self.profiles.deadline(HuaweiE3372, None, 'AT+CGATT=0', 2), 2)
+
+    def test_deadline_capped(self):
+        self.record('AT+CGATT=1', 1000)
+        self.assertEqual(self.profiles.deadline(HuaweiE3372, None, 'AT+CGATT=1', 10), LatencyProfiles.MAX_DEADLINE)
+
+    def test_long_default_kept(self):
+        # Timeouts are recorded as twice the deadline, it must not be cut below the default
+        self.record('AT+COPS=?', 360)
+        self.assertEqual(self.profiles.deadline(HuaweiE3372, None, 'AT+COPS=?', 180), 180)
+
+
+if __name__ == '__main__':
+    unittest.main()
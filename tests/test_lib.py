@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import sys
+import time
+import threading
+import unittest
+
+import serial
+
+from gsmmodem_manager import HuaweiE3372
+from gsmmodem_manager.emulator import ModemEmulator
+
+
+class LateResponseTest(unittest.TestCase):
+    """AT+COPS=? is answered after its deadline. Its late answer must not be taken
+    for the response of the next commands."""
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01, latencies={'AT+COPS=?': 1})
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+
+    def tearDown(self):
+        self.modem.close_connection()
+        self.emulator.close()
+
+    def check(self):
+        self.assertFalse(self.modem.scan_networks(sleeptime=0.3)[0])
+        time.sleep(1) # The late answer arrives meanwhile
+        self.assertEqual(self.modem.get_signal_quality(), (True, 'AT+CSQ', '17,99'))
+        self.assertEqual(self.modem.get_imsi(), (True, 'AT+CIMI', self.emulator.imsi))
+        self.assertEqual(self.modem.get_imei(), (True, 'AT+GSN', self.emulator.imei))
+
+    def test_late_response(self):
+        self.check()
+
+    def test_late_response_reader(self):
+        self.modem.start_reader()
+        self.check()
+
+    def test_still_running(self):
+        # The next command waits for the final result code of the one which timed out
+        self.assertFalse(self.modem.scan_networks(sleeptime=0.3)[0])
+        self.assertEqual(self.modem.get_signal_quality(), (True, 'AT+CSQ', '17,99'))
+        self.assertEqual(self.modem.get_imsi(), (True, 'AT+CIMI', self.emulator.imsi))
+
+    def check_waiting_urc(self):
+        # The late answer is read while another thread waits for the registration
+        self.emulator.set_registration('0')
+        waiter = threading.Thread(target=self.modem.wait_for_registration, kwargs={'timeout': 2, 'poll_interval': 5})
+        waiter.start()
+        time.sleep(0.2)
+        self.assertFalse(self.modem.scan_networks(sleeptime=0.3)[0])
+        waiter.join()
+        start = time.time()
+        self.assertEqual(self.modem.get_signal_quality(), (True, 'AT+CSQ', '17,99'))
+        self.assertLess(time.time() - start, 1) # Not waiting for an answer already read
+
+    def test_late_response_waiting_urc(self):
+        self.check_waiting_urc()
+
+    def test_late_response_waiting_urc_reader(self):
+        self.modem.start_reader()
+        self.check_waiting_urc()
+
+
+class CacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01)
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+
+    def tearDown(self):
+        self.modem.close_connection()
+        self.emulator.close()
+
+    def swap(self, urc):
+        self.assertEqual(self.modem.get_imsi(), (True, 'AT+CIMI', self.emulator.imsi))
+        self.emulator.imsi = '214079876543210'
+        self.emulator.emit(urc)
+        time.sleep(0.1) # Not read yet, no command was sent since
+        self.assertEqual(self.modem.get_imsi(), (True, 'AT+CIMI', '214079876543210'))
+
+    def test_cached(self):
+        self.assertEqual(self.modem.get_imei(), (True, 'AT+GSN', self.emulator.imei))
+        sent = len(self.emulator.commands)
+        self.assertEqual(self.modem.get_imei(), (True, 'AT+GSN', self.emulator.imei))
+        self.assertEqual(len(self.emulator.commands), sent)
+
+    def test_sim_status_urc(self):
+        self.swap('^SIMST: 1')
+
+    def test_cpin_urc(self):
+        self.swap('+CPIN: READY')
+
+
+class ApplyConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01, registration_delay=0.05)
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+
+    def tearDown(self):
+        self.modem.close_connection()
+        self.emulator.close()
+
+    def test_unchanged_skipped(self):
+        desired = {'act': HuaweiE3372.ACT_LTE, 'apn': 'movistar.es', 'operator': '21407', 'creg': 2}
+        status, commands, report = self.modem.apply_config(desired)
+        self.assertTrue(status)
+        self.assertEqual(sorted(report['changed']), ['act', 'apn', 'creg', 'operator'])
+
+        sent = len(self.emulator.commands)
+        self.assertEqual(self.modem.apply_config(desired),
+                         (True, [], {'changed': {}, 'unchanged': ['act', 'apn', 'operator', 'creg'], 'failed': {}}))
+        self.assertEqual(len(self.emulator.commands) - sent, 1) # Only the concatenated queries
+
+    def test_automatic_selection(self):
+        # Registered on the operator, but it may roam elsewhere until it is selected
+        self.assertTrue(self.modem.wait_for_registration(timeout=2)[0])
+        self.assertEqual(self.modem.get_operator(), (True, 'AT+COPS?', '21401'))
+        status, commands, report = self.modem.apply_config({'operator': '21401'})
+        self.assertEqual((status, commands, report['changed']), (True, ['AT+COPS=1,2,"21401"'], {'operator': (None, '21401')}))
+        self.assertEqual(self.modem.apply_config({'operator': '21401'})[2]['unchanged'], ['operator'])
+
+
+if sys.version_info >= (3, 5): # asyncio modems
+    import asyncio
+    from gsmmodem_manager import AsyncHuaweiE3372
+
+    class AsyncLateResponseTest(unittest.TestCase):
+
+        def setUp(self):
+            self.emulator = ModemEmulator('E3372', latency=0.01, latencies={'AT+COPS=?': 1})
+            self.loop = asyncio.new_event_loop()
+            self.modem = AsyncHuaweiE3372(self.emulator.devicefile, 115200)
+            self.loop.run_until_complete(self.modem.connect())
+
+        def tearDown(self):
+            self.modem.close_connection()
+            self.loop.close()
+            self.emulator.close()
+
+        def test_late_response(self):
+            run = self.loop.run_until_complete
+            self.assertFalse(run(self.modem.scan_networks(sleeptime=0.3))[0])
+            run(asyncio.sleep(1))
+            self.assertEqual(run(self.modem.get_signal_quality()), (True, 'AT+CSQ', '17,99'))
+            self.assertEqual(run(self.modem.get_imsi()), (True, 'AT+CIMI', self.emulator.imsi))
+
+    class AsyncHangUpTest(unittest.TestCase):
+
+        def test_hang_up(self):
+            # The port is closed as soon as it fails, the awaiting command with it
+            emulator = ModemEmulator('E3372', latency=0.01, latencies={'AT+CSQ': 5})
+            loop = asyncio.new_event_loop()
+            modem = AsyncHuaweiE3372(emulator.devicefile, 115200)
+            try:
+                loop.run_until_complete(modem.connect())
+                loop.call_later(0.2, emulator.close) # Like the modem being unplugged
+                start = loop.time()
+                self.assertRaises(serial.SerialException, loop.run_until_complete, modem.get_signal_quality())
+                self.assertLess(loop.time() - start, 2)
+                self.assertFalse(modem._transport.is_open())
+            finally:
+                modem.close_connection()
+                loop.close()
+                emulator.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import unittest
+
+from gsmmodem_manager.parsers import (Csq, Creg, Cops, Network, SysCfg, Cgdcont, Hcsq, Cmgl, Cmgr, Cmti, as_dict,
+                                      parse_csq, parse_creg, parse_cops, parse_cops_list, parse_cgdcont, parse_cmgl,
+                                      parse_cmgr, parse_cmti, parse_cmgs, parse_syscfg, parse_rssi, parse_hcsq, parse_iccid)
+
+
+class ParsersTest(unittest.TestCase):
+
+    def test_csq(self):
+        self.assertEqual(parse_csq('+CSQ: 17,99'), Csq('17', '99'))
+        self.assertEqual(parse_csq('+CSQ:5 , 0'), Csq('5', '0'))
+        self.assertEqual(parse_csq('+CREG: 0,1'), None)
+
+    def test_creg(self):
+        self.assertEqual(parse_creg('+CREG: 2,1,"00C3","0000B1A7",2'), Creg('2', '1', '00C3', '0000B1A7', '2'))
+        self.assertEqual(parse_creg('+CGREG: 0,5'), Creg('0', '5', None, None, None))
+        self.assertEqual(parse_creg('+CEREG: 2,1,"00C3","0000B1A7",7,,'), Creg('2', '1', '00C3', '0000B1A7', '7'))
+        self.assertEqual(parse_creg('+CSQ: 17,99'), None)
+
+    def test_creg_unsolicited(self):
+        self.assertEqual(parse_creg('+CREG: 1', solicited=False), Creg(None, '1', None, None, None))
+        self.assertEqual(parse_creg('+CGREG: 5,"00C3","0000B1A7"', solicited=False), Creg(None, '5', '00C3', '0000B1A7', None))
+        # Solicited lines have one field more, not to be taken as <stat>,<lac>
+        self.assertEqual(parse_creg('+CREG: 1', solicited=True), None)
+
+    def test_cops(self):
+        self.assertEqual(parse_cops('+COPS: 0,2,"21401",2'), Cops('0', '2', '21401', '2'))
+        self.assertEqual(parse_cops('+COPS: 1,0,"vodafone ES"'), Cops('1', '0', 'vodafone ES', None))
+        self.assertEqual(parse_cops('+COPS: 0'), Cops('0', None, None, None))
+
+    def test_cops_list(self):
+        line = '+COPS: (2,"vodafone ES","voda ES","21401",2),(3,"Orange","ORG","21403",0),(1,"Yoigo","Yoigo","21404"),,(0-4),(0-2)'
+        self.assertEqual(parse_cops_list(line), [Network('2', 'vodafone ES', 'voda ES', '21401', '2'),
+                                                 Network('3', 'Orange', 'ORG', '21403', '0'),
+                                                 Network('1', 'Yoigo', 'Yoigo', '21404', None)])
+        self.assertEqual(parse_cops_list('+COPS: ,,(0-4),(0-2)'), [])
+        self.assertEqual(parse_cops_list('OK'), None)
+
+    def test_cgdcont(self):
+        self.assertEqual(parse_cgdcont('+CGDCONT: 1,"IP","internet","0.0.0.0",0,0'), Cgdcont('1', 'IP', 'internet'))
+        self.assertEqual(parse_cgdcont('+CGDCONT: 2,"IPV6",""'), Cgdcont('2', 'IPV6', ''))
+
+    def test_sms_lines(self):
+        self.assertEqual(parse_cmgl('+CMGL: 3,1,,24'), Cmgl('3', '1', None, '24'))
+        self.assertEqual(parse_cmgl('+CMGL: 4,0,"Bob",30'), Cmgl('4', '0', 'Bob', '30'))
+        self.assertEqual(parse_cmgr('+CMGR: 1,,24'), Cmgr('1', None, '24'))
+        self.assertEqual(parse_cmti('+CMTI: "SM",5'), Cmti('SM', '5'))
+        self.assertEqual(parse_cmgs('+CMGS: 42'), '42')
+        self.assertEqual(parse_cmgs('+CMS ERROR: 304'), None)
+
+    def test_syscfg(self):
+        self.assertEqual(parse_syscfg('^SYSCFG: 2,2,3FFFFFFF,1,2'), SysCfg('2', '2', '3FFFFFFF', '1', '2', None))
+        self.assertEqual(parse_syscfg('^SYSCFGEX: "00",3FFFFFFF,1,2,7FFFFFFFFFFFFFFF'),
+                         SysCfg(None, '00', '3FFFFFFF', '1', '2', '7FFFFFFFFFFFFFFF'))
+        self.assertEqual(parse_syscfg('^SYSCFGEX: "0302",3FFFFFFF,0,2'), SysCfg(None, '0302', '3FFFFFFF', '0', '2', None))
+
+    def test_huawei_lines(self):
+        self.assertEqual(parse_rssi('^RSSI: 21'), '21')
+        self.assertEqual(parse_hcsq('^HCSQ: "LTE",52,44,154,25'), Hcsq('LTE', ('52', '44', '154', '25')))
+        self.assertEqual(parse_hcsq('^HCSQ: "NOSERVICE"'), Hcsq('NOSERVICE', ()))
+        self.assertEqual(parse_iccid('^ICCID: 8934011234567890123F'), '8934011234567890123')
+        self.assertEqual(parse_iccid('+CSQ: 17,99'), None)
+
+    def test_as_dict(self):
+        self.assertEqual(as_dict(Creg('0', '1', None, None, None)), {'n': '0', 'stat': '1'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import time
+import threading
+import unittest
+
+from gsmmodem_manager import HuaweiE3372
+from gsmmodem_manager.pool import ModemPool, PoolTimeout
+from gsmmodem_manager.emulator import ModemEmulator
+
+
+class ModemPoolTest(unittest.TestCase):
+
+    def test_emulators(self):
+        emulators = [ModemEmulator('E3372', latency=0.01, imsi='21401000000000' + str(i)) for i in range(3)]
+        try:
+            with ModemPool.from_devicefiles(HuaweiE3372, [emulator.devicefile for emulator in emulators], 115200) as pool:
+                results = pool.collect('get_imsi')
+            self.assertEqual([res.result for res in results],
+                             [(True, 'AT+CIMI', emulator.imsi) for emulator in emulators])
+        finally:
+            for emulator in emulators:
+                emulator.close()
+
+    def test_hung_modem(self):
+        # Once the hung modem is released, its thread must not take the rest of the modems
+        release, lock = threading.Event(), threading.Lock()
+        running, peak = [0], [0]
+
+        def operation(modem):
+            if modem == 'hung':
+                release.wait(5)
+                return 'late'
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.15)
+            with lock:
+                running[0] -= 1
+            return modem
+
+        results = {}
+        for res in ModemPool(['hung', 'a', 'b', 'c', 'd'], max_workers=2).run(operation, timeout=0.25):
+            results[res.modem] = res
+            if res.modem == 'hung':
+                release.set()
+        self.assertTrue(isinstance(results.pop('hung').error, PoolTimeout))
+        self.assertEqual(sorted(res.result for res in results.values()), ['a', 'b', 'c', 'd'])
+        self.assertEqual(peak[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from gsmmodem_manager import HuaweiE3372
+from gsmmodem_manager.emulator import ModemEmulator
+from gsmmodem_manager.recorder import Recorder, Recording, Replayer, TX, RX
+
+
+class RecorderTest(unittest.TestCase):
+    """The traffic with an emulated modem is recorded, and replayed to another modem object"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'e3372.rec')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def session(self, devicefile, recorder=None):
+        modem = HuaweiE3372(devicefile, 115200, lazy=True)
+        modem.set_recorder(recorder)
+        try:
+            return [modem.get_imei(), modem.get_signal_quality(), modem.get_apn()]
+        finally:
+            modem.close_connection()
+
+    def record(self):
+        with ModemEmulator('E3372', latency=0.01) as emulator:
+            with Recorder(self.path) as recorder:
+                return self.session(emulator.devicefile, recorder)
+
+    def test_round_trip(self):
+        results = self.record()
+        self.assertTrue(all(result[0] for result in results))
+
+        with Recording(self.path) as recording:
+            stats = recording.stats()
+            sent = b''.join(bytes(frame.data) for frame in recording.frames(TX))
+            received = b''.join(bytes(frame.data) for frame in recording.frames(RX))
+        self.assertEqual(stats['tx_frames'], sent.count(b'\r'))
+        self.assertIn(b'AT+CSQ\r\n', sent)
+        self.assertIn(b'+CSQ: 17,99\r\n', received)
+        self.assertEqual(stats['rx_bytes'], len(received))
+
+        replayer = Replayer(self.path, speed=None)
+        try:
+            self.assertEqual(self.session(replayer.devicefile), results)
+            self.assertTrue(replayer.done.wait(5))
+            self.assertEqual(replayer.mismatches, [])
+        finally:
+            replayer.close()
+
+    def test_truncated(self):
+        # The last frame of a crashed recorder is left out
+        self.record()
+        with Recording(self.path) as recording:
+            frames = recording.stats()['tx_frames'] + recording.stats()['rx_frames']
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00' * 5)
+        with Recording(self.path) as recording:
+            self.assertEqual(len(list(recording)), frames)
+
+
+if __name__ == '__main__':
+    unittest.main()
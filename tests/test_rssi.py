@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import unittest
+from array import array
+
+from gsmmodem_manager import GSMModem
+from gsmmodem_manager import rssi
+
+INDEXES = list(range(32)) + [99]
+
+
+class ArrayRssiTest(unittest.TestCase):
+    """array.array fallback, whether NumPy is installed or not"""
+
+    def setUp(self):
+        self.numpy, rssi.numpy = rssi.numpy, None
+        self.modem = GSMModem('/dev/null', 115200, lazy=True) # The port is never opened
+
+    def tearDown(self):
+        rssi.numpy = self.numpy
+
+    def expected(self, rssis):
+        return [self.modem.sq_to_rssidBm(sq) for sq in rssis]
+
+    def check(self, rssis, dbm, quality, percent):
+        expected = self.expected(rssis)
+        self.assertEqual(list(dbm), [value[0] for value in expected])
+        self.assertEqual([rssi.QUALITIES[code] for code in quality], [value[1] for value in expected])
+        self.assertEqual(list(percent), [value[2] for value in expected])
+
+    def test_convert(self):
+        dbm, quality, percent = rssi.convert(INDEXES)
+        self.assertTrue(all(isinstance(converted, array) for converted in (dbm, quality, percent)))
+        self.check(INDEXES, dbm, quality, percent)
+
+    def test_inputs(self):
+        for rssis in (iter(INDEXES), tuple(INDEXES), bytearray(INDEXES), array('i', INDEXES)):
+            self.assertEqual(list(rssi.to_dbm(rssis)), [value[0] for value in self.expected(INDEXES)])
+
+    def test_out_of_range(self):
+        self.assertEqual(list(rssi.to_dbm([-1, 256, 1000, 31])), [value[0] for value in self.expected([99, 99, 99, 31])])
+
+    def test_quality_histogram(self):
+        histogram = rssi.quality_histogram([99, 0, 31, 31])
+        self.assertEqual(sum(histogram.values()), 4)
+        self.assertEqual(histogram[self.modem.sq_to_rssidBm(31)[1]], 2)
+
+    def test_cell_averages(self):
+        averages = rssi.cell_averages(['a', 'a', 'b', 'c'], [10, 20, 31, 99])
+        self.assertEqual(averages, {'a': (self.modem.sq_to_rssidBm(10)[0] + self.modem.sq_to_rssidBm(20)[0]) / 2.0,
+                                    'b': float(self.modem.sq_to_rssidBm(31)[0])})
+
+
+@unittest.skipIf(rssi.numpy is None, 'NumPy is not installed')
+class NumpyRssiTest(ArrayRssiTest):
+
+    def setUp(self):
+        self.modem = GSMModem('/dev/null', 115200, lazy=True)
+
+    def tearDown(self):
+        pass
+
+    def test_convert(self):
+        dbm, quality, percent = rssi.convert(INDEXES)
+        self.assertTrue(all(isinstance(converted, rssi.numpy.ndarray) for converted in (dbm, quality, percent)))
+        self.check(INDEXES, dbm, quality, percent)
+
+
+if __name__ == '__main__':
+    unittest.main()
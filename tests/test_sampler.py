@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import unittest
+
+from gsmmodem_manager.sampler import RingBuffer, Sample, UNKNOWN, hcsq_to_rssi
+from gsmmodem_manager.parsers import parse_hcsq
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_append(self):
+        buffer = RingBuffer(4)
+        buffer.append(10.5, '17', '99', '1', '00C3', '0000B1A7', '2')
+        buffer.append(11.5, 20, 0)
+        self.assertEqual(len(buffer), 2)
+        self.assertEqual(list(buffer), [Sample(10.5, 17, 99, 1, 0xC3, 0xB1A7, 2),
+                                        Sample(11.5, 20, 0, None, None, None, None)])
+
+    def test_overwrite_oldest(self):
+        buffer = RingBuffer(3)
+        for ts in range(7):
+            buffer.append(ts, ts, 0)
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual([sample.ts for sample in buffer], [4, 5, 6])
+        self.assertEqual([sample.ts for sample in buffer.samples(since=5)], [5, 6])
+
+    def test_clear(self):
+        buffer = RingBuffer(2)
+        buffer.append(1, 10, 0)
+        buffer.clear()
+        self.assertEqual((len(buffer), list(buffer)), (0, []))
+
+    def test_downsample(self):
+        buffer = RingBuffer(10)
+        for ts, rssi, ber, stat in ((0, 10, 0, '1'), (30, 20, UNKNOWN, '1'), (59, UNKNOWN, UNKNOWN, '5'),
+                                    (60, UNKNOWN, UNKNOWN, '2'), (125, 31, 7, None)):
+            buffer.append(ts, rssi, ber, stat)
+        buckets = list(buffer.downsample(60))
+        self.assertEqual([(bucket.ts, bucket.count) for bucket in buckets], [(0, 3), (60, 1), (120, 1)])
+        self.assertEqual(buckets[0][2:9], (10, 20, 15.0, 0, 0, 0.0, 5)) # Unknown ones left out, latest stat
+        self.assertEqual(buckets[1][2:9], (None, None, None, None, None, None, 2))
+        self.assertEqual(buckets[2].rssi_mean, 31.0)
+
+    def test_hcsq_to_rssi(self):
+        self.assertEqual(hcsq_to_rssi(parse_hcsq('^HCSQ: "LTE",52,44,154,25')), 22) # -69 dBm
+        self.assertEqual(hcsq_to_rssi(parse_hcsq('^HCSQ: "NOSERVICE"')), UNKNOWN)
+
+
+if __name__ == '__main__':
+    unittest.main()
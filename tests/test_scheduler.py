@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import time
+import threading
+import unittest
+
+from gsmmodem_manager import HuaweiE3372, ModemScheduler, SchedulerTimeout, SchedulerCancelled
+from gsmmodem_manager.emulator import ModemEmulator
+
+
+class ModemSchedulerTest(unittest.TestCase):
+    """Requests are submitted while AT+GMI, which takes 0.3 seconds, is being answered"""
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01, latencies={'AT+GMI': 0.3})
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+        self.scheduler = ModemScheduler(self.modem)
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.modem.close_connection()
+        self.emulator.close()
+
+    def busy(self):
+        request = self.scheduler.submit('get_manufacturer')
+        time.sleep(0.1)
+        return request
+
+    def commands(self, since):
+        return self.emulator.commands[self.emulator.commands.index(since) + 1:]
+
+    def test_priority(self):
+        busy = self.busy()
+        requests = [self.scheduler.submit('get_signal_quality', priority=ModemScheduler.PRIORITY_TELEMETRY),
+                    self.scheduler.submit('get_imsi'),
+                    self.scheduler.submit('get_operator', priority=ModemScheduler.PRIORITY_CONTROL)]
+        self.assertTrue(busy.result()[0])
+        self.assertEqual([request.result()[1] for request in requests], ['AT+CSQ', 'AT+CIMI', 'AT+COPS?'])
+        self.assertEqual(self.commands('AT+GMI'), ['AT+COPS?', 'AT+CIMI', 'AT+CSQ'])
+
+    def test_coalesced(self):
+        busy = self.busy()
+        requests = [self.scheduler.submit('get_signal_quality') for _ in range(3)]
+        busy.result()
+        self.assertEqual([request.result() for request in requests], [(True, 'AT+CSQ', '17,99')] * 3)
+        self.assertEqual(self.commands('AT+GMI'), ['AT+CSQ'])
+
+    def test_deadline(self):
+        busy = self.busy()
+        request = self.scheduler.submit('get_imsi', timeout=0.05)
+        self.assertRaises(SchedulerTimeout, request.result)
+        busy.result()
+        self.assertEqual(self.scheduler.call('get_signal_quality')[1], 'AT+CSQ')
+        self.assertEqual(self.commands('AT+GMI'), ['AT+CSQ'])
+
+    def test_cancel(self):
+        busy = self.busy()
+        request = self.scheduler.submit('get_imsi')
+        self.assertTrue(request.cancel())
+        self.assertRaises(SchedulerCancelled, request.result)
+        busy.result()
+        self.scheduler.call('get_signal_quality')
+        self.assertEqual(self.commands('AT+GMI'), ['AT+CSQ'])
+
+    def test_stop_cancels_pending(self):
+        busy = self.busy()
+        request = self.scheduler.submit('get_imsi')
+        self.scheduler.stop()
+        self.assertTrue(busy.result()[0]) # The command being sent is finished
+        self.assertRaises(SchedulerCancelled, request.result)
+
+    def test_with_direct_callers(self):
+        # Commands of threads using the modem directly never get between a prompt and its message
+        results = []
+        def poll():
+            for _ in range(50):
+                results.append(self.modem.get_signal_quality()[0])
+        poller = threading.Thread(target=poll)
+        poller.start()
+        status, command, references = self.scheduler.submit('send_sms', ('+34600111222', u'q' * 400)).result()
+        poller.join()
+        self.assertTrue(status)
+        self.assertEqual(len(self.emulator.sent), 3)
+        self.assertTrue(all(results))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import sys
+import threading
+import unittest
+
+from gsmmodem_manager import HuaweiE3372, SmsSender
+from gsmmodem_manager.emulator import ModemEmulator
+from gsmmodem_manager.sms import (pack_septets, unpack_septets, encode_sms, encode_deliver, decode_pdu,
+                                  Reassembler, iter_messages)
+
+
+class SeptetsTest(unittest.TestCase):
+
+    def test_pack(self):
+        # 'hellohello' as per the 3GPP TS 23.040 examples
+        self.assertEqual(bytes(pack_septets(bytearray(b'hellohello'))), bytes(bytearray.fromhex('E8329BFD4697D9EC37')))
+
+    def test_round_trip_with_padding(self):
+        septets = list(range(128)) * 2
+        for padding in range(7):
+            octets = pack_septets(septets, padding)
+            self.assertEqual(list(unpack_septets(octets, len(septets), padding)), septets)
+
+
+class PduTest(unittest.TestCase):
+
+    def test_decode_reference_submit(self):
+        sms = decode_pdu('0011000B916407281553F80000AA0AE8329BFD4697D9EC37')
+        self.assertEqual((sms.number, sms.smsc, sms.text, sms.concat), ('+46708251358', None, u'hellohello', None))
+
+    def test_decode_reference_deliver(self):
+        sms = decode_pdu('07911326040000F0040B911346610089F60000208062917314080CC8F71D14969741F977FD07', 3, 1)
+        self.assertEqual((sms.index, sms.stat, sms.number, sms.smsc, sms.text),
+                         (3, 1, '+31641600986', '+31624000000', u'How are you?'))
+
+    def test_encode_single(self):
+        self.assertEqual(encode_sms('+46708251358', 'hellohello'), [(22, '0001000B916407281553F800000AE8329BFD4697D9EC37')])
+
+    def test_round_trip_alphabets(self):
+        for text in (u'Hello [world] €5', u'héllo ☺', u''):
+            parts = encode_sms('+34600111222', text)
+            self.assertEqual(len(parts), 1)
+            self.assertEqual(decode_pdu(parts[0][1]).text, text)
+
+    def test_tpdu_length(self):
+        for length, pdu in encode_sms('+34600111222', u'x' * 400, smsc='+34609090909'):
+            self.assertEqual(len(pdu) // 2 - 1 - int(pdu[:2], 16), length) # After the SMSC information
+
+    def test_concatenated(self):
+        text = u'☺' * 300 # UCS2, 67 characters per part
+        parts = encode_sms('+34600111222', text, reference=7)
+        self.assertEqual([decode_pdu(pdu).concat for _, pdu in parts], [(7, 5, 1), (7, 5, 2), (7, 5, 3), (7, 5, 4), (7, 5, 5)])
+        self.assertEqual(u''.join(decode_pdu(pdu).text for _, pdu in parts), text)
+
+    def test_deliver_round_trip(self):
+        pdu = encode_deliver('+34600111222', u'hey', '18/03/01,10:20:30+04', smsc='+34609090909')[0]
+        sms = decode_pdu(pdu)
+        self.assertEqual((sms.number, sms.smsc, sms.timestamp, sms.text), ('+34600111222', '+34609090909', '18/03/01,10:20:30+04', u'hey'))
+
+    def test_malformed(self):
+        for pdu in ('', '00', 'ZZ', 'AT+CSQ', '0011000B916407281553F80000AA'):
+            self.assertRaises(ValueError, decode_pdu, pdu)
+
+
+class ReassemblerTest(unittest.TestCase):
+
+    def parts(self, sender, text, reference, first_index):
+        return [decode_pdu(pdu, first_index + i, 0) for i, pdu in enumerate(encode_deliver(sender, text, reference=reference))]
+
+    def test_any_order(self):
+        reassembler = Reassembler()
+        parts = self.parts('+34600111222', u'a' * 400, 9, 1)
+        self.assertEqual([reassembler.add(part) for part in parts[:0:-1]], [None] * (len(parts) - 1))
+        sms = reassembler.add(parts[0])
+        self.assertEqual((sms.text, sms.index, sms.concat), (u'a' * 400, (1, 2, 3), None))
+        self.assertEqual(len(reassembler), 0)
+
+    def test_same_reference_other_sender(self):
+        reassembler = Reassembler()
+        first, second = self.parts('+34600111222', u'a' * 200, 1, 1), self.parts('+34600333444', u'b' * 200, 1, 3)
+        self.assertEqual(reassembler.add(first[0]), None)
+        self.assertEqual(reassembler.add(second[1]), None)
+        self.assertEqual(reassembler.add(first[1]).text, u'a' * 200)
+        self.assertEqual(len(reassembler), 1)
+        self.assertEqual([sms.index for sms in reassembler.expire(0)], [4])
+
+    def test_iter_messages(self):
+        lines = []
+        for index, pdu in enumerate(encode_deliver('+34600111222', u'z' * 200) + ['NOTAPDU'] + encode_deliver('+1', u'ok'), 1):
+            lines += ['+CMGL: ' + str(index) + ',1,,' + str(len(pdu) // 2 - 1), pdu]
+        lines += ['+CMGL: 9,0,,20', encode_deliver('+34600111222', u'y' * 200, reference=5)[1]] # One part only
+        messages = list(iter_messages(lines))
+        self.assertEqual([(sms.index, sms.text) for sms in messages], [((1, 2), u'z' * 200), (4, u'ok'), (9, u'y' * 47)])
+        self.assertEqual(messages[2].concat, (5, 2, 2))
+
+
+class PromptTest(unittest.TestCase):
+    """No command of another thread gets between AT+CMGS and its PDU"""
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01)
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+
+    def tearDown(self):
+        self.modem.close_connection()
+        self.emulator.close()
+
+    def poll(self, results):
+        for _ in range(50):
+            results.append(self.modem.get_signal_quality()[0])
+
+    def test_threads(self):
+        results = []
+        poller = threading.Thread(target=self.poll, args=(results,))
+        poller.start()
+        status, command, references = self.modem.send_sms('+34600111222', u'q' * 400)
+        poller.join()
+        self.assertTrue(status)
+        self.assertEqual(len(references), 3)
+        self.assertEqual(len(self.emulator.sent), 3)
+        self.assertTrue(all(results))
+
+    def test_sender(self):
+        with SmsSender(self.modem) as sender:
+            requests = [sender.send('+3460011122' + str(i), u'x' * 170) for i in range(4)]
+            results = []
+            self.poll(results)
+            self.assertEqual([request.result()[0] for request in requests], [True] * 4)
+        self.assertTrue(all(results))
+        self.assertEqual(len(self.emulator.sent), 8)
+
+
+if sys.version_info >= (3, 5): # asyncio modems
+    import asyncio
+    from gsmmodem_manager import AsyncHuaweiE3372
+
+    class AsyncPromptTest(unittest.TestCase):
+        """No coroutine gets its command between AT+CMGS and its PDU"""
+
+        def setUp(self):
+            self.emulator = ModemEmulator('E3372', latency=0.02)
+            self.loop = asyncio.new_event_loop()
+            self.modem = AsyncHuaweiE3372(self.emulator.devicefile, 115200)
+            self.loop.run_until_complete(self.modem.connect())
+
+        def tearDown(self):
+            self.modem.close_connection()
+            self.loop.close()
+            self.emulator.close()
+
+        def test_coroutines(self):
+            polls = []
+            for i in range(40): # Requested all along the prompt sequences
+                self.loop.call_later(0.005 * i, lambda: polls.append(self.loop.create_task(self.modem.get_signal_quality())))
+            send = self.modem.send_sms('+34600111222', u'q' * 200)
+            status, command, references = self.loop.run_until_complete(asyncio.wait_for(send, 20))
+            results = self.loop.run_until_complete(asyncio.wait_for(asyncio.gather(*polls), 20))
+            self.assertTrue(status)
+            self.assertEqual(len(self.emulator.sent), 2)
+            self.assertEqual([result[0] for result in results], [True] * 40)
+
+
+if __name__ == '__main__':
+    unittest.main()
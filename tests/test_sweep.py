@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import unittest
+
+from gsmmodem_manager import HuaweiE3372
+from gsmmodem_manager.emulator import ModemEmulator
+from gsmmodem_manager.sweep import sweep
+
+
+class SweepTest(unittest.TestCase):
+    """Two emulated modems seeing the 3G networks of ModemEmulator.NETWORKS"""
+
+    def setUp(self):
+        self.emulators = [ModemEmulator('E3372', latency=0.01, registration_delay=0.05) for _ in range(2)]
+        self.modems = [HuaweiE3372(emulator.devicefile, 115200) for emulator in self.emulators]
+
+    def tearDown(self):
+        for modem, emulator in zip(self.modems, self.emulators):
+            modem.close_connection()
+            emulator.close()
+
+    def test_sweep(self):
+        plmns, acts = ['21401', '21403', '21499'], [HuaweiE3372.ACT_UMTS, HuaweiE3372.ACT_LTE]
+        results = list(sweep(self.modems, plmns, acts))
+
+        self.assertEqual(sorted((result.plmn, result.act) for result in results),
+                         sorted((plmn, act) for plmn in plmns for act in acts)) # One per cell
+        skipped = [(result.plmn, result.act) for result in results if result.skipped]
+        self.assertEqual(sorted(skipped), [('21401', '03'), ('21403', '03'), ('21499', '02'), ('21499', '03')])
+        self.assertTrue(all(result.skipped for result in results[:len(skipped)])) # Skipped ones first
+        self.assertTrue(all(result.modem is None and result.result is None for result in results[:len(skipped)]))
+
+        for result in results[len(skipped):]:
+            self.assertIn(result.modem, self.modems)
+            self.assertEqual(result.error, None)
+            status, command, report = result.result
+            self.assertTrue(status)
+            self.assertIn('registration_time', report)
+            self.assertIn('pdp_attach_time', report)
+
+    def test_no_scan(self):
+        cells = lambda modem, plmn, act: (True, None, self.modems.index(modem))
+        results = list(sweep(self.modems, ['21401', '21499'], [HuaweiE3372.ACT_UMTS], cell=cells, scan=False))
+        self.assertEqual(sorted(result.plmn for result in results), ['21401', '21499'])
+        self.assertFalse(any(result.skipped for result in results))
+        self.assertFalse(any('AT+COPS=?' in emulator.commands for emulator in self.emulators))
+
+
+if __name__ == '__main__':
+    unittest.main()
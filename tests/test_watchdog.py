@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim: ts=4
+###
+#
+# Copyright (c) 2016-2018 Pod Group Ltd
+# Authors : J. Félix Ontañón <felix.ontanon@podgroup.com>
+
+import unittest
+
+from gsmmodem_manager import HuaweiE3372, ModemWatchdog
+from gsmmodem_manager.emulator import ModemEmulator
+
+
+class ModemWatchdogTest(unittest.TestCase):
+    """The emulated modem loses its registration, and the stages which would
+    bring it back fail as told"""
+
+    def setUp(self):
+        self.emulator = ModemEmulator('E3372', latency=0.01, registration_delay=0.05)
+        self.modem = HuaweiE3372(self.emulator.devicefile, 115200)
+        self.assertTrue(self.modem.wait_for_registration(timeout=2)[0])
+        self.watchdog = ModemWatchdog(self.modem, config={'operator': '21401'})
+        self.watchdog.REGISTRATION_TIMEOUT, self.watchdog.DETACH_TIMEOUT = 1, 0.1
+
+    def tearDown(self):
+        self.watchdog.stop()
+        self.modem.close_connection()
+        self.emulator.close()
+
+    def test_healthy(self):
+        self.assertEqual(self.watchdog.check(), None)
+
+    def test_soft_reset(self):
+        self.emulator.select_operator(None)
+        reason = self.watchdog.check()
+        self.assertEqual(reason, 'Not registered, status 0')
+        recovery = self.watchdog.recover(reason)
+        self.assertEqual((recovery.recovered, recovery.stage), (True, 'soft_reset')) # ATZ selects it again
+        self.assertEqual([(stage, healthy) for stage, seconds, healthy in recovery.stages],
+                         [('reopen', False), ('soft_reset', True)])
+
+    def test_escalation(self):
+        self.emulator.errors.update({'ATZ': 'ERROR', 'AT^RESET': 'ERROR'})
+        self.emulator.select_operator(None)
+        recovery = self.watchdog.recover(self.watchdog.check())
+        self.assertEqual((recovery.recovered, recovery.stage), (True, 'reconfigure'))
+        self.assertEqual([(stage, healthy) for stage, seconds, healthy in recovery.stages],
+                         [('reopen', False), ('soft_reset', False), ('reset', False), ('reconfigure', True)])
+        self.assertIn('AT+COPS=1,2,"21401"', self.emulator.commands)
+        self.assertEqual(self.watchdog.stats()['recovered_by_stage']['reconfigure'], 1)
+
+    def test_not_recovered(self):
+        self.emulator.errors.update({'ATZ': 'ERROR', 'AT^RESET': 'ERROR', 'AT+COPS=': '+CME ERROR: 30'})
+        self.emulator.select_operator(None)
+        recovery = self.watchdog.recover(self.watchdog.check())
+        self.assertEqual((recovery.recovered, recovery.stage, len(recovery.stages)), (False, None, 4))
+        self.assertEqual(self.watchdog.stats()['failed'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()